@@ -0,0 +1,90 @@
+"""
+Benchmarks of resticrc hot paths.
+
+Run with 'make bench': results are saved to .benchmarks/ as JSON
+and compared with the previous run.
+Size of synthetic trees is set with RESTICRC_BENCH_ENTRIES (20000 by default).
+"""
+
+import os
+import stat
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from resticrc.executor import executor  # noqa: E402
+
+ENTRIES = int(os.environ.get("RESTICRC_BENCH_ENTRIES", 20000))
+
+STUBS = {
+    # consumes stdin of stdin/files-from backups, prints the summary like restic does
+    "restic": """#!/bin/sh
+size=0
+for arg in "$@"; do
+    case "$arg" in
+        --stdin|--files-from-raw) size=$(wc -c) ;;
+    esac
+done
+echo '{"message_type":"summary","total_bytes_processed":'"$size"',"snapshot_id":"00000000"}'
+""",
+    "zstd": """#!/bin/sh
+exec cat
+""",
+    "zfs": """#!/bin/sh
+[ -n "$STUB_LOG" ] && echo "zfs $*" >> "$STUB_LOG"
+exit 0
+""",
+}
+
+
+@pytest.fixture(scope="session")
+def stub_bin(tmp_path_factory):
+    """ Directory with fake restic, zstd and zfs, placed first in PATH. """
+    bindir = tmp_path_factory.mktemp("bin")
+    for name, script in STUBS.items():
+        path = bindir / name
+        path.write_text(script)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    old_path = os.environ["PATH"]
+    os.environ["PATH"] = f"{bindir}{os.pathsep}{old_path}"
+    yield bindir
+    os.environ["PATH"] = old_path
+
+
+@pytest.fixture(autouse=True)
+def real_executor(monkeypatch, tmp_path):
+    monkeypatch.setattr(executor, "dry_run", False)
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+
+
+def make_tree(root: Path, entries: int, fanout: int = 20) -> int:
+    """
+    Creates a tree of home directories with approximately 'entries' files,
+    a quarter of them in directories usually excluded (caches, node_modules etc).
+    Returns number of created files.
+    """
+    noise = ["node_modules", "__pycache__", ".cache", ".venv"]
+    created = 0
+    project = 0
+    while created < entries:
+        user = root / "home" / f"user{project % 10}"
+        base = user / "projects" / f"project{project}"
+        for i in range(fanout):
+            directory = base / f"src{i % 4}" / f"pkg{i}"
+            if i % 4 == 3:
+                directory = base / noise[(i // 4) % len(noise)] / f"pkg{i}"
+            directory.mkdir(parents=True, exist_ok=True)
+            for j in range(fanout):
+                (directory / f"file{j}.py").write_bytes(b"x" * (j % 7))
+                created += 1
+        project += 1
+    return created
+
+
+@pytest.fixture(scope="session")
+def tree(tmp_path_factory):
+    root = tmp_path_factory.mktemp("tree")
+    count = make_tree(root, ENTRIES)
+    return root, count
@@ -0,0 +1,53 @@
+import copy
+
+import yaml
+
+from resticrc.filtering import process_filters
+from resticrc.parser import Parser
+
+PLUGINS = {
+    "logs": True,
+    "caches": True,
+    "dev-caches": True,
+    "trash": True,
+    "telegram": True,
+    "golang": False,
+}
+
+
+def make_config(jobs: int) -> dict:
+    return {
+        "repos": {"host": "/backups/host", "db": {"path": "/backups/db"}},
+        "global": {"repo": "host", "exclude": dict(PLUGINS, paths=[".bash_history"])},
+        "jobs": {
+            f"job{i}": {
+                "path": [f"/srv/job{i}", f"/home/*/job{i}"],
+                "exclude": {"paths": [f"/srv/job{i}/tmp"], "python": True},
+            }
+            for i in range(jobs)
+        },
+    }
+
+
+def test_parser_load(benchmark, tmp_path):
+    path = tmp_path / "config.yml"
+    path.write_text(yaml.safe_dump(make_config(500)))
+    parser = benchmark(Parser, str(path))
+    assert len(parser.jobs) == 500
+
+
+def test_parser_exclusions(benchmark):
+    conf = make_config(500)
+
+    def run():
+        parser = Parser(copy.deepcopy(conf))
+        for job in parser.jobs.values():
+            job.exclude  # pylint: disable=pointless-statement
+        return parser
+
+    benchmark(run)
+
+
+def test_process_filters(benchmark):
+    settings = benchmark(process_filters, dict(PLUGINS, paths=["/srv/tmp"] * 50))
+    assert settings.exclude
@@ -0,0 +1,147 @@
+"""
+Bytes a zstd job adds to the repository per run, for every tar mode,
+while a small part of the tree changes between runs.
+
+Fake restic splits its stdin into content-defined chunks (gear hash, like
+restic's chunker but with 8KiB chunks instead of 1MiB, the tree is small)
+and counts bytes of chunks it has not seen in previous runs.
+Results are in 'extra_info': bytes added by every run and
+the ratio of added to processed bytes after the first run.
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+
+import pytest
+
+from resticrc.executor import OutputBuffer, executor
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+
+# resolved before the fake zstd of other benchmarks is put into PATH
+ZSTD = shutil.which("zstd")
+FILES = int(os.environ.get("RESTICRC_BENCH_ENTRIES", 20000)) // 20
+RUNS = 5
+# part of files changed between runs
+CHANGED = 0.002
+
+RESTIC = """#!{python}
+import hashlib, json, os, random, sys
+
+MIN, MAX, MASK = 2 * 1024, 64 * 1024, (1 << 13) - 1
+rng = random.Random(0)
+GEAR = [rng.getrandbits(64) for _ in range(256)]
+BITS = (1 << 64) - 1
+
+data = sys.stdin.buffer.read()
+store = os.environ["CHUNK_STORE"]
+seen = set()
+if os.path.exists(store):
+    with open(store) as fd:
+        seen = set(fd.read().split())
+added, start, size = 0, 0, len(data)
+new = []
+while start < size:
+    end = min(start + MAX, size)
+    h = 0
+    i = start + MIN
+    while i < end:
+        h = ((h << 1) + GEAR[data[i]]) & BITS
+        if not h & MASK:
+            end = i + 1
+            break
+        i += 1
+    digest = hashlib.sha256(data[start:end]).hexdigest()
+    if digest not in seen:
+        seen.add(digest)
+        new.append(digest)
+        added += end - start
+    start = end
+with open(store, "a") as fd:
+    fd.write("".join(x + "\\n" for x in new))
+summary = dict(
+    message_type="summary",
+    snapshot_id="00000000",
+    data_added=added,
+    total_bytes_processed=size,
+)
+print(json.dumps(summary))
+with open(os.environ["RESTIC_SUMMARIES"], "a") as fd:
+    fd.write(json.dumps(summary) + "\\n")
+"""
+
+MODES = {
+    "zstd": {},
+    "zstd-rsyncable": {"rsyncable": True, "sort": True},
+    "zstd-rsyncable-b512k": {"rsyncable": True, "sort": True, "block": "512K"},
+    "tar": {"compress": False, "sort": True},
+}
+
+WORDS = [f"word{i}" for i in range(500)]
+
+
+def text(rng: random.Random) -> str:
+    """ Compressible text of a few KiB. """
+    lines = rng.randint(20, 120)
+    return "".join(" ".join(rng.choices(WORDS, k=8)) + "\n" for _ in range(lines))
+
+
+@pytest.fixture
+def chunking_restic(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "restic").write_text(RESTIC.format(python=sys.executable))
+    (bindir / "restic").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("CHUNK_STORE", str(tmp_path / "chunks"))
+    monkeypatch.setenv("RESTIC_SUMMARIES", str(tmp_path / "summaries"))
+    return tmp_path / "summaries"
+
+
+@pytest.mark.skipif(ZSTD is None, reason="zstd is not installed")
+@pytest.mark.parametrize("mode", MODES)
+def test_added_bytes(benchmark, chunking_restic, tmp_path, mode):
+    rng = random.Random(1)
+    root = tmp_path / "tree"
+    files = []
+    for i in range(FILES):
+        path = root / f"dir{i % 25}" / f"file{i}.txt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text(rng))
+        files.append(path)
+    job = Job(
+        repo=Repository("bench", "/backups/bench"),
+        tags=["bench"],
+        runner=FileRunner([str(root)]),
+        conf={"zstd": dict(MODES[mode], executable=ZSTD)},
+    )
+    runs = iter(range(RUNS))
+
+    def change():
+        if next(runs) == 0:
+            return
+        # a few lines of some files are edited, a new file appears
+        for path in rng.sample(files, max(1, int(len(files) * CHANGED))):
+            lines = path.read_text().splitlines(keepends=True)
+            lines[rng.randrange(len(lines))] = text(rng).partition("\n")[0] + "\n"
+            path.write_text("".join(lines))
+        path = root / "new" / f"file{len(files)}.txt"
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(text(rng))
+        files.append(path)
+
+    def run():
+        with executor.capture(OutputBuffer(echo=False)):
+            job.run()
+
+    benchmark.pedantic(run, setup=change, rounds=RUNS)
+    summaries = [json.loads(x) for x in chunking_restic.read_text().splitlines()]
+    added = [x["data_added"] for x in summaries]
+    processed = [x["total_bytes_processed"] for x in summaries]
+    benchmark.extra_info["added_bytes"] = added
+    benchmark.extra_info["added_ratio"] = sum(added[1:]) / sum(processed[1:])
+    # the first run adds everything
+    assert added[0] == processed[0]
@@ -0,0 +1,83 @@
+import glob
+import sys
+import time
+
+import pytest
+
+from resticrc.commands import exclude_paths, unglob
+from resticrc.filtering.matcher import ExclusionMatcher
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+from resticrc.walker import Walker
+
+
+def make_job(root):
+    return Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["home"],
+        runner=FileRunner([f"{root}/home/*/projects/*/*/*"]),
+        exclude={"dev-caches": True, "caches": True, "logs": True},
+    )
+
+
+def test_unglob(benchmark, tree):
+    root, _ = tree
+    paths = benchmark(lambda: list(unglob([f"{root}/home/*/projects/*/*/*"])))
+    assert paths
+
+
+def test_unglob_stdlib(benchmark, tree):
+    """ Baseline for test_unglob: glob.glob() lists directories in one thread. """
+    root, _ = tree
+    paths = benchmark(glob.glob, f"{root}/home/*/projects/*/*/*")
+    assert paths
+
+
+def test_unglob_not_slower_than_stdlib(tree):
+    """ Threads are used only for wide levels, so small trees do not pay for them. """
+    if sys.gettrace() is not None:
+        pytest.skip("coverage slows down only the Python engine, run with --no-cov")
+    root, _ = tree
+    pattern = f"{root}/home/*/projects/*/*/*"
+    runs = {
+        "unglob": lambda: list(unglob([pattern])),
+        "stdlib": lambda: glob.glob(pattern),
+    }
+    best = dict.fromkeys(runs, float("inf"))
+    # interleaved, so both see the same changes of the CPU frequency
+    for _ in range(50):
+        for name, run in runs.items():
+            start = time.perf_counter()
+            run()
+            best[name] = min(best[name], time.perf_counter() - start)
+    assert best["unglob"] <= best["stdlib"], best
+
+
+def test_exclude_paths(benchmark, tree):
+    root, _ = tree
+    job = make_job(root)
+    paths = set(unglob([f"{root}/home/*/projects/*/*/*/*"]))
+    job.exclude.matcher  # pylint: disable=pointless-statement
+
+    def run():
+        kept = set(paths)
+        exclude_paths(job, kept)
+        return kept
+
+    kept = benchmark(run)
+    assert 0 < len(kept) < len(paths)
+
+
+def test_matcher_compile(benchmark):
+    patterns = [f"/srv/job{i}/tmp" for i in range(1000)]
+    patterns += [f".config/*/Cache{i}" for i in range(1000)]
+    matcher = benchmark(ExclusionMatcher, patterns)
+    assert matcher.match("/srv/job10/tmp/x")
+
+
+def test_walker(benchmark, tree):
+    root, count = tree
+    job = make_job(root)
+    walker = Walker(job.exclude.matcher, threads=8)
+    found = benchmark(lambda: sum(1 for _ in walker.walk([str(root / "home")])))
+    assert 0 < found < count
@@ -0,0 +1,34 @@
+import pytest
+
+from resticrc.executor import OutputBuffer, executor
+
+SIZE = 256 * 1024 * 1024
+
+
+@pytest.mark.parametrize("pump", [None, {"splice": True}, {"splice": False}])
+def test_stdin_pipeline(benchmark, stub_bin, pump):
+    producer = ["head", "-c", str(SIZE), "/dev/zero"]
+    restic = ["restic", "backup", "--stdin"]
+
+    def run():
+        with executor.capture(OutputBuffer(echo=False)) as output:
+            executor.pipeline([producer, restic], pump=pump)
+        return output
+
+    output = benchmark.pedantic(run, rounds=3)
+    assert f'"total_bytes_processed":{SIZE}' in output.text("stdout")
+    benchmark.extra_info["bytes"] = SIZE
+
+
+def test_files_from_pipeline(benchmark, stub_bin, tree):
+    root, _ = tree
+    paths = [str(x).encode() + b"\0" for x in root.rglob("*")]
+
+    def run():
+        with executor.capture(OutputBuffer(echo=False)):
+            return executor.run(
+                ["restic", "backup", "--files-from-raw", "-"], stdin=paths
+            )
+
+    result = benchmark(run)
+    assert result.fed == len(paths)
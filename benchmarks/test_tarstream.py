@@ -0,0 +1,68 @@
+"""
+Throughput of the zstd job producers: GNU tar process against the tar
+written in-process by resticrc with prefetch, on the synthetic tree of
+small files and on a tree of bigger files. zstd and restic are fakes,
+so only reading the files and writing the archive is measured.
+
+Files in the page cache are read without waiting, so prefetch wins
+only on a real source: set RESTICRC_BENCH_SOURCE to a directory on NFS
+or a disk (drop caches between runs) to measure it there.
+"""
+
+import os
+
+import pytest
+
+from resticrc.executor import OutputBuffer, executor
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+
+MODES = {
+    "tar": {"compress": True},
+    "prefetch": {"compress": True, "prefetch": {"threads": 8}},
+}
+BIG_FILES = 256
+BIG_SIZE = 256 * 1024
+SOURCE = os.environ.get("RESTICRC_BENCH_SOURCE")
+
+
+@pytest.fixture(scope="session")
+def big_tree(tmp_path_factory):
+    root = tmp_path_factory.mktemp("big")
+    for i in range(BIG_FILES):
+        directory = root / f"dir{i % 16}"
+        directory.mkdir(exist_ok=True)
+        (directory / f"file{i}.bin").write_bytes(bytes([i % 256]) * BIG_SIZE)
+    return root
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize(
+    "files",
+    [
+        "small",
+        "big",
+        pytest.param(
+            "source",
+            marks=pytest.mark.skipif(not SOURCE, reason="RESTICRC_BENCH_SOURCE"),
+        ),
+    ],
+)
+def test_producer(benchmark, stub_bin, tree, big_tree, mode, files):
+    root = {"small": tree[0], "big": big_tree, "source": SOURCE}[files]
+    job = Job(
+        repo=Repository("bench", "/backups/bench"),
+        tags=["bench"],
+        # the stub zstd is found in PATH, not the zstandard package
+        runner=FileRunner([str(root)]),
+        conf={"zstd": dict(MODES[mode], executable="zstd")},
+    )
+
+    def run():
+        with executor.capture(OutputBuffer(echo=False)):
+            job.run()
+
+    benchmark.pedantic(run, rounds=3)
+    if files == "big":
+        size = BIG_FILES * BIG_SIZE
+        benchmark.extra_info["bytes_per_second"] = size / benchmark.stats["mean"]
@@ -0,0 +1,111 @@
+"""
+Long lists of patterns and paths passed to commands through files.
+
+Every exec copies argv and the size of it is limited (ARG_MAX),
+so lists longer than a threshold are written into a private temporary
+directory (mode 0700) instead, e.g. '--exclude-file' for restic or '-T' for tar.
+The directory is removed when the block ends; dry runs print the content.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import typing as ty
+
+from .executor import executor
+
+log = logging.getLogger(__name__)
+
+# lists up to this size are kept in argv, they are readable in dry runs and logs
+THRESHOLD = 16
+
+
+def restic_safe(pattern: str) -> bool:
+    """
+    Returns True if restic reads the pattern from a file as is:
+    lines are stripped, '#' starts a comment and environment variables are expanded.
+    """
+    return (
+        bool(pattern)
+        and pattern == pattern.strip()
+        and not pattern.startswith("#")
+        and "$" not in pattern
+        and "\n" not in pattern
+    )
+
+
+def tar_safe(pattern: str) -> bool:
+    return bool(pattern) and "\n" not in pattern
+
+
+class ArgFiles:
+    """ Temporary files with arguments, used as a context manager. """
+
+    def __init__(self, threshold: ty.Optional[int] = THRESHOLD):
+        # None keeps everything in argv, e.g. for commands on remote hosts
+        self.threshold = threshold
+        self.directory: ty.Optional[str] = None
+        self.count = 0
+
+    def __enter__(self) -> "ArgFiles":
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def write(self, name: str, items: ty.Iterable[str], separator: str = "\n") -> str:
+        """ Writes items into a new file, returns its path. """
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="resticrc-")
+        self.count += 1
+        path = os.path.join(self.directory, f"{self.count}-{name}")
+        content = "".join(f"{x}{separator}" for x in items)
+        with open(path, "w", encoding="utf-8", errors="surrogateescape") as out:
+            out.write(content)
+        if executor.dry_run:
+            print(f"Contents of {path}:")
+            print(content.replace("\0", "\n"), end="")
+        return path
+
+    def patterns(
+        self,
+        option: str,
+        file_option: str,
+        patterns: ty.Iterable[str],
+        safe: ty.Callable[[str], bool] = restic_safe,
+        name: str = "exclude",
+    ) -> ty.List[str]:
+        """
+        Returns arguments for patterns: 'option pattern' pairs for short lists
+        and for patterns the file would change, 'file_option path' for the rest.
+        """
+        patterns = list(patterns)
+        # the last matching pattern decides, re-includes ('!') keep their order
+        negated = any(x.startswith("!") for x in patterns)
+        if not negated:
+            patterns = sorted(patterns)
+        inline = patterns
+        out: ty.List[str] = []
+        if self.threshold is not None and len(patterns) > self.threshold:
+            inline = [x for x in patterns if not safe(x)]
+            listed = [x for x in patterns if safe(x)]
+            if negated and inline:
+                # split between the file and arguments, the order would be lost
+                inline, listed = patterns, []
+            if listed:
+                out.extend([file_option, self.write(name, listed)])
+        for pattern in inline:
+            out.extend([option, pattern])
+        return out
+
+    def paths(self, paths: ty.Iterable[str], *file_options: str) -> ty.List[str]:
+        """
+        Returns paths themselves for short lists, otherwise file_options
+        followed by a file with NUL-separated paths.
+        """
+        paths = sorted(paths)
+        if self.threshold is None or len(paths) <= self.threshold:
+            return paths
+        return [*file_options, self.write("paths", paths, separator="\0")]
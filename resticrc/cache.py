@@ -0,0 +1,243 @@
+"""
+restic cache directories managed by resticrc ('cache' setting).
+
+Without --cache-dir restic keeps its cache in ~/.cache/restic of whoever
+runs it, so jobs under sudo or the daemon often start cold and download
+the index and snapshots again. With 'cache' set, every repository gets its
+own directory there (or 'cache-dir' of the repository), passed to all
+restic commands of the repository.
+
+Commands of a repository hold a shared lock of its cache, so concurrent
+jobs use one cache; warm-up and eviction take the exclusive lock, and
+eviction skips caches in use. The lock file is touched on every use:
+caches unused for 'max-age', and the least recently used ones above
+'max-size', are removed after 'resticrc all' and by 'resticrc cache evict'.
+"""
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from attr import attrs, attrib
+
+from .executor import OutputBuffer, executor
+from .pump import humanize
+from .sizefilter import parse_size
+from .state import cache_dir
+from .tracing import span
+
+if ty.TYPE_CHECKING:
+    from .models import Repository
+    from .resources import Resources
+
+log = logging.getLogger(__name__)
+
+LOCK = ".resticrc.lock"
+# loads snapshots, the index and trees of the latest snapshot into the cache,
+# which is what a backup reads to find its parent
+WARM_UP = ["--no-lock", "stats", "--json", "--mode", "raw-data", "latest"]
+
+
+def repo_dir(base, name: str, path: str) -> str:
+    """ Returns cache directory of the repository, a new one if its path changes. """
+    digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+    return os.path.join(base, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}-{digest}")
+
+
+@contextlib.contextmanager
+def locked(directory, exclusive=False, blocking=True):
+    """
+    Holds the lock of the cache directory, yields False if it is busy
+    and not 'blocking'. The directory is created if it is missing.
+    """
+    path = os.path.join(directory, LOCK)
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+    while True:
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            yield False
+            return
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            current = None
+        if current is not None and current.st_ino == os.fstat(fd).st_ino:
+            break
+        # evicted while we waited, the lock is of a removed file
+        os.close(fd)
+    try:
+        yield True
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def using(repos: ty.Iterable["Repository"]):
+    """ Holds shared locks of caches of the repositories, marks them used. """
+    directories = sorted({x.cache_dir for x in repos if x.cache_dir})
+    if executor.dry_run or not directories:
+        yield
+        return
+    with contextlib.ExitStack() as stack:
+        for directory in directories:
+            stack.enter_context(locked(directory))
+            os.utime(os.path.join(directory, LOCK))
+        yield
+
+
+@attrs
+class CacheEntry:
+    path: Path = attrib()
+    size: int = attrib()
+    # time of the last use
+    used: float = attrib()
+
+
+def du(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+@attrs
+class CacheManager:
+    """ Directory with caches of repositories, eviction and warm-up. """
+
+    base: Path = attrib(converter=Path)
+    max_size: ty.Optional[int] = attrib(default=None)
+    # seconds since the last use
+    max_age: ty.Optional[float] = attrib(default=None)
+    # warm caches up before 'resticrc all'
+    warm: bool = attrib(default=False)
+    warm_up_args: ty.List[str] = attrib(factory=lambda: list(WARM_UP))
+
+    @classmethod
+    def from_conf(cls, conf: dict) -> ty.Optional["CacheManager"]:
+        """ Returns manager of the 'cache' setting: a directory or a mapping. """
+        value = conf.get("cache")
+        if not value:
+            return None
+        if isinstance(value, str):
+            value = {"dir": value}
+        # cleanup holds locks of the caches too
+        from .cleanup import parse_interval  # pylint: disable=import-outside-toplevel
+
+        value = dict(value)
+        warm = value.pop("warm-up", False)
+        manager = cls(
+            base=value.pop("dir", None) or cache_dir() / "restic",
+            max_size=parse_size(value["max-size"]) if "max-size" in value else None,
+            max_age=parse_interval(value.get("max-age")),
+            warm=bool(warm),
+        )
+        if isinstance(warm, (list, str)):
+            manager.warm_up_args = warm.split() if isinstance(warm, str) else warm
+        unknown = set(value) - {"max-size", "max-age"}
+        if unknown:
+            raise ValueError(f"Unknown cache settings: {', '.join(sorted(unknown))}")
+        return manager
+
+    def repo_dir(self, name: str, path: str) -> str:
+        return repo_dir(self.base, name, path)
+
+    def entries(self) -> ty.List[CacheEntry]:
+        if not self.base.is_dir():
+            return []
+        out = []
+        for path in sorted(self.base.iterdir()):
+            # other directories could share the base, they are never removed
+            if path.is_symlink() or not (path / LOCK).is_file():
+                continue
+            used = (path / LOCK).stat().st_mtime
+            out.append(CacheEntry(path, du(path), used))
+        return out
+
+    def evict(self, now: ty.Optional[float] = None) -> ty.List[CacheEntry]:
+        """
+        Removes caches unused for max-age, then the least recently used ones
+        until the rest fits into max-size. Returns removed caches.
+        """
+        if self.max_size is None and self.max_age is None:
+            return []
+        now = time.time() if now is None else now
+        entries = sorted(self.entries(), key=lambda x: x.used)
+        total = sum(x.size for x in entries)
+        removed = []
+        for entry in entries:
+            stale = self.max_age is not None and now - entry.used > self.max_age
+            over = self.max_size is not None and total > self.max_size
+            if not stale and not over:
+                continue
+            with locked(entry.path, exclusive=True, blocking=False) as acquired:
+                if not acquired:
+                    log.info("Cache %s is in use, not evicted", entry.path)
+                    continue
+                if executor.dry_run:
+                    log.info("Would evict cache %s", entry.path)
+                else:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            total -= entry.size
+            removed.append(entry)
+            log.info(
+                "Evicted cache %s (%s, %s)",
+                entry.path.name,
+                humanize(entry.size),
+                "unused" if stale else "over max-size",
+            )
+        return removed
+
+    def _warm_up(self, repo: "Repository", resources) -> ty.Optional[Exception]:
+        name = f"cache:{repo.name}"
+        try:
+            # jobs wait for the cache instead of downloading the same
+            lock = (
+                contextlib.nullcontext()
+                if executor.dry_run
+                else locked(repo.cache_dir, exclusive=True)
+            )
+            with executor.capture(OutputBuffer(name)), span(name):
+                with executor.limit(resources, name), lock:
+                    command = ["restic"] + repo.get_args() + self.warm_up_args
+                    executor.run(command, on_output=lambda _: None)
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("Warm-up of %s cache failed: %s", repo.name, e)
+            return e
+        return None
+
+    def warm_up(
+        self,
+        repos: ty.Iterable["Repository"],
+        resources: ty.Optional["Resources"] = None,
+    ) -> ty.Dict[str, Exception]:
+        """ Fills caches of the repositories concurrently, returns errors. """
+        repos = {x.name: x for x in repos if x.cache_dir}
+        if not repos:
+            return {}
+        started = time.monotonic()
+        with ThreadPoolExecutor(len(repos), thread_name_prefix="warm-up") as pool:
+            results = pool.map(lambda x: self._warm_up(x, resources), repos.values())
+            errors = {
+                name: error for name, error in zip(repos, results) if error is not None
+            }
+        log.info(
+            "Caches of %s repositories warmed up in %.1fs",
+            len(repos),
+            time.monotonic() - started,
+        )
+        return errors
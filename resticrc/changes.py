@@ -0,0 +1,182 @@
+"""
+Detection of unchanged jobs.
+
+After a successful backup the state of the job tree is saved into an index:
+fixed-size records (path hash, inode, size, mtime, ctime) sorted by path hash.
+Next run walks the tree again with the job exclusions applied and skips
+the backup if it produces exactly the same records.
+The index is memory-mapped, so comparing it costs no parsing
+and ~40 bytes per file on disk.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import typing as ty
+from pathlib import Path
+from urllib.parse import quote
+
+from attr import attrs, attrib
+
+from .state import state_dir
+from .walker import Walker
+
+if ty.TYPE_CHECKING:
+    from .models import Job
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"RRCIDX1\0"
+# magic, key of the job settings
+HEADER = struct.Struct(">8s16s")
+# path hash, inode, size, mtime and ctime in ns; big-endian for sorting as bytes
+RECORD = struct.Struct(">QQqqq")
+
+
+def path_hash(path: str) -> int:
+    digest = hashlib.blake2b(os.fsencode(path), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class StatIndex:
+    """ Sorted records of files, backed by bytes or a memory-mapped file. """
+
+    def __init__(self, key: bytes, records: ty.Union[bytes, memoryview]):
+        self.key = key
+        self.records = records
+
+    @classmethod
+    def build(
+        cls, key: bytes, entries: ty.Iterable[ty.Tuple[str, os.stat_result]]
+    ) -> "StatIndex":
+        records = [
+            RECORD.pack(
+                path_hash(path), st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+            )
+            for path, st in entries
+        ]
+        records.sort()
+        return cls(key, b"".join(records))
+
+    @classmethod
+    def load(cls, path: Path) -> ty.Optional["StatIndex"]:
+        try:
+            with open(path, "rb") as fd:
+                if os.fstat(fd.fileno()).st_size < HEADER.size:
+                    return None
+                mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        magic, key = HEADER.unpack_from(mapped)
+        if magic != MAGIC:
+            return None
+        return cls(key, memoryview(mapped)[HEADER.size :])
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as out:
+            out.write(HEADER.pack(MAGIC, self.key))
+            out.write(self.records)
+        os.replace(tmp, path)
+
+    def __len__(self):
+        return len(self.records) // RECORD.size
+
+    def __eq__(self, other):
+        if not isinstance(other, StatIndex):
+            return NotImplemented
+        return self.key == other.key and self.records == other.records
+
+    def changes(self, other: "StatIndex") -> int:
+        """ Returns how many files are added, removed or changed. """
+        ours = dict(self._unpack())
+        count = 0
+        for key, value in other._unpack():
+            if ours.pop(key, None) != value:
+                count += 1
+        return count + len(ours)
+
+    def _unpack(self) -> ty.Iterator[ty.Tuple[int, ty.Tuple[int, ...]]]:
+        for record in RECORD.iter_unpack(self.records):
+            yield record[0], record[1:]
+
+
+@attrs
+class Scan:
+    """ State of the job tree before backup. """
+
+    path: Path = attrib()
+    index: StatIndex = attrib()
+    previous: ty.Optional[StatIndex] = attrib(default=None)
+
+    @property
+    def unchanged(self) -> bool:
+        return self.previous is not None and self.previous == self.index
+
+    @property
+    def changes(self) -> ty.Optional[int]:
+        """ How many files changed, None if there is no previous index. """
+        if self.previous is None or self.previous.key != self.index.key:
+            return None
+        return self.previous.changes(self.index)
+
+    def commit(self):
+        """ Saves state of the tree, called after a successful backup. """
+        self.index.save(self.path)
+
+
+@attrs
+class ChangeDetector:
+    """ Finds jobs which files did not change since the last backup. """
+
+    # backup even unchanged jobs
+    force: bool = attrib(default=False)
+    threads: int = attrib(default=8)
+
+    @staticmethod
+    def index_path(name: str) -> Path:
+        """ Index of the job, or of its part, e.g. 'job:pool/data' for a dataset. """
+        return state_dir() / "index" / f"{quote(name, safe=':')}.idx"
+
+    @staticmethod
+    def key(job: "Job", paths: ty.Iterable[str], root=None) -> bytes:
+        """ Digest of job settings which change the set of files. """
+        exclude = job.exclude
+        settings = (
+            sorted(paths),
+            root,
+            # in order, re-including patterns depend on it
+            exclude.exclude,
+            exclude.iexclude,
+            exclude.larger,
+            sorted(x.path for x in job.repos),
+            job.tags,
+            sorted(repr(x) for x in job.conf.items()),
+        )
+        return hashlib.blake2b(repr(settings).encode(), digest_size=16).digest()
+
+    def scan(
+        self, job: "Job", paths: ty.Iterable[str], cwd=None, name=None, root=None
+    ) -> Scan:
+        """
+        Walks the tree of the job, or of its part with 'name'.
+        'root' identifies cwd if it changes between runs, e.g. a snapshot
+        of a dataset: relative paths are the same, so the index is too.
+        """
+        paths = sorted(paths)
+        walker = Walker(job.exclude.matcher, threads=self.threads, cwd=cwd, stat=True)
+        key = self.key(job, paths, cwd if root is None else root)
+        index = StatIndex.build(key, walker.walk(paths))
+        path = self.index_path(name or job.name)
+        scan = Scan(path, index, None if self.force else StatIndex.load(path))
+        if log.isEnabledFor(logging.DEBUG):
+            # counting unpacks both indexes
+            log.debug(
+                "[%s] %s files scanned, %s changed", job.name, len(index), scan.changes
+            )
+        return scan
+
+
+detector = ChangeDetector()
@@ -0,0 +1,160 @@
+import logging
+import re
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+
+from attr import attrs, attrib
+
+from .cache import using
+from .executor import OutputBuffer, executor
+from .history import History
+from .tracing import span
+
+if ty.TYPE_CHECKING:
+    from .models import Job, Repository
+    from .resources import Resources
+
+log = logging.getLogger(__name__)
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+INTERVAL = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$")
+
+
+def parse_interval(value) -> ty.Optional[float]:
+    """
+    Returns interval in seconds: numbers are days, strings could have
+    a unit ('12h', '2w'). True means 'every time', false or None - never.
+    """
+    if value is None or value is False:
+        return None
+    if value is True:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value) * UNITS["d"]
+    match = INTERVAL.match(str(value))
+    if not match:
+        raise ValueError(f"Invalid interval {value!r}, expected e.g. 7d or 12h.")
+    number, unit = match.groups()
+    return float(number) * UNITS[unit or "d"]
+
+
+@attrs
+class CleanupTask:
+    """ What should be done with one repository. """
+
+    repo: "Repository" = attrib()
+    # snapshots of these tags are forgotten, None means no forget at all
+    keep_daily: ty.Optional[int] = attrib(default=None)
+    tags: ty.List[str] = attrib(factory=list)
+    prune: bool = attrib(default=False)
+
+    def __bool__(self):
+        return bool(self.keep_daily) or self.prune
+
+
+class CleanupPlanner:
+    """
+    Plans cleanup of repositories after a run: one 'forget' per repository
+    for all tags backed up to it, 'prune' only if the last one was long ago.
+    Repositories are cleaned concurrently.
+    """
+
+    def __init__(
+        self,
+        keep_daily: ty.Optional[int] = None,
+        prune_after=None,
+        history: ty.Optional[History] = None,
+        resources: ty.Optional["Resources"] = None,
+    ):
+        self.keep_daily = keep_daily
+        self.prune_after = prune_after
+        self.history = history or History()
+        self.resources = resources
+        self.repos: ty.Dict[str, "Repository"] = {}
+        self.tags: ty.Dict[str, ty.List[str]] = {}
+
+    def add(self, job: "Job"):
+        """ Adds repositories and tags of a job that has been backed up. """
+        for repo in job.repos:
+            self.repos.setdefault(repo.name, repo)
+            tags = self.tags.setdefault(repo.name, [])
+            tags.extend(x for x in job.tags if x not in tags)
+
+    def prune_due(self, repo: "Repository", now=None) -> bool:
+        interval = parse_interval(
+            repo.prune_after if repo.prune_after is not None else self.prune_after
+        )
+        if interval is None:
+            return False
+        last = self.history.last_prune(repo.name)
+        now = time.time() if now is None else now
+        if last is not None and now - last < interval:
+            log.info(
+                "Prune of %s is not due: last one was %.1f hours ago",
+                repo.name,
+                (now - last) / 3600,
+            )
+            return False
+        return True
+
+    def plan(self, now=None) -> ty.List[CleanupTask]:
+        tasks = []
+        for name, repo in self.repos.items():
+            keep_daily = (
+                repo.keep_daily if repo.keep_daily is not None else self.keep_daily
+            )
+            task = CleanupTask(
+                repo,
+                keep_daily=keep_daily,
+                tags=self.tags[name],
+                prune=self.prune_due(repo, now),
+            )
+            if task:
+                tasks.append(task)
+        return tasks
+
+    def execute(self, task: CleanupTask):
+        repo = task.repo
+        if task.keep_daily:
+            with using([repo]):
+                executor.run(repo.forget_args(task.keep_daily, task.tags))
+        if not task.prune:
+            return
+        started = time.time()
+        status = 0
+        try:
+            with using([repo]):
+                executor.run(repo.prune_args())
+        except Exception:
+            status = 1
+            raise
+        finally:
+            if not executor.dry_run:
+                duration = time.time() - started
+                self.history.record_prune(repo.name, started, duration, status)
+
+    def _execute(self, task: CleanupTask) -> ty.Optional[Exception]:
+        name = f"cleanup:{task.repo.name}"
+        try:
+            with executor.capture(OutputBuffer(name)), span(name):
+                with executor.limit(self.resources, name):
+                    self.execute(task)
+        except Exception as e:  # pylint: disable=broad-except
+            log.error("Cleanup of %s failed: %s", task.repo.name, e)
+            return e
+        return None
+
+    def run(self) -> ty.Dict[str, Exception]:
+        """ Cleans repositories concurrently, returns errors of failed ones. """
+        tasks = self.plan()
+        if not tasks:
+            return {}
+        with ThreadPoolExecutor(len(tasks), thread_name_prefix="cleanup") as pool:
+            results = pool.map(self._execute, tasks)
+            errors = {
+                task.repo.name: error
+                for task, error in zip(tasks, results)
+                if error is not None
+            }
+        return errors
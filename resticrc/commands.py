@@ -1,9 +1,23 @@
-import glob
+import json
 import logging
+import os
+import shlex
 import subprocess
+import sys
+import time
 import typing as ty
 
-from .executor import executor
+from .argfiles import THRESHOLD, ArgFiles, tar_safe
+from .cache import using
+from .changes import detector
+from .executor import executor, job_output
+from .globber import globber
+from .metrics import add_phase, add_summary
+from .pump import humanize
+from .sizefilter import SizeReport, parse_size, scan_larger
+from .tarstream import BUFFER, TarStream, compress, zstandard_available
+from .tracing import span
+from .walker import Walker
 
 if ty.TYPE_CHECKING:
     from .models import Job
@@ -12,90 +26,407 @@ log = logging.getLogger(__name__)
 
 
 class Command:
-    def __init__(self, job: "Job", runner):
+    def __init__(self, job: "Job", runner, name=None, args=()):
         self.job = job
         log.info("Using runner: %s", runner)
         self.runner = runner
+        # a part of the job, e.g. a dataset, is logged as 'job:part'
+        self.name = name or job.name
+        # added to every restic command, e.g. tags of the part
+        self.args = list(args)
+
+
+class BackupStatus:
+    """ Parses output of 'restic backup --json'. """
+
+    # how often progress is logged, in seconds
+    interval = 30.0
+
+    def __init__(self, name):
+        self.name = name
+        self.summary: ty.Optional[dict] = None
+        self._logged = time.monotonic()
+
+    def __call__(self, line: bytes):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            output = job_output.get()
+            if output:
+                output.append("stdout", line)
+            else:
+                sys.stdout.write(line.decode(errors="replace"))
+            return
+        kind = message.get("message_type")
+        if kind == "summary":
+            self.summary = message
+            log.info("[%s] %s", self.name, self.describe(message))
+        elif kind == "error":
+            error = message.get("error") or {}
+            log.warning(
+                "[%s] %s: %s", self.name, message.get("item"), error.get("message")
+            )
+        elif kind == "status" and time.monotonic() - self._logged >= self.interval:
+            self._logged = time.monotonic()
+            log.info(
+                "[%s] %.0f%% done, %s/%s files, %s/%s",
+                self.name,
+                message.get("percent_done", 0) * 100,
+                message.get("files_done", 0),
+                message.get("total_files", 0),
+                humanize(message.get("bytes_done", 0)),
+                humanize(message.get("total_bytes", 0)),
+            )
+
+    @staticmethod
+    def describe(summary: dict) -> str:
+        return (
+            f"snapshot {summary.get('snapshot_id', '?')[:8]}: "
+            f"{summary.get('files_new', 0)} new, "
+            f"{summary.get('files_changed', 0)} changed, "
+            f"{summary.get('files_unmodified', 0)} unmodified files; "
+            f"{humanize(summary.get('data_added', 0))} added, "
+            f"{humanize(summary.get('total_bytes_processed', 0))} processed "
+            f"in {summary.get('total_duration', 0):.1f}s"
+        )
 
 
 class Restic(Command):
-    def base_args(self):
-        cmd = ["restic"] + self.job.repo.get_args() + ["backup"]
+    def base_args(self, repo=None, cache=True):
+        repo = repo or self.job.repo
+        cmd = ["restic"] + repo.get_args(cache) + ["backup", "--json"]
+        if self.job.resources:
+            cmd.extend(self.job.resources.restic_args())
         for tag in self.job.tags:
             cmd.extend(["--tag", tag])
+        cmd.extend(self.args)
         return cmd
 
-    def backup_files(self, paths, cwd=None):
+    def execute(self, args, producer=None, **kwargs):
+        """
+        Executes restic backup with args for every repository of the job
+        (with producer command for stdin backups), saves results into the history.
+        Input is read once: each restic process gets a copy of it.
+        """
+        repos = self.job.repos
+        # restic of remote file jobs runs there, without the local cache
+        local = producer is not None or not self.job.remote
+        commands = [self.base_args(x, cache=local) + list(args) for x in repos]
+        if self.job.remote:
+            # the source is read on the remote host, stdin backups are sent back
+            cwd = kwargs.pop("cwd", None)
+            if producer:
+                producer = self.job.command(producer, cwd)
+            else:
+                commands = [self.job.command(x, cwd) for x in commands]
+        if len(repos) == 1:
+            statuses = [BackupStatus(self.name)]
+        else:
+            statuses = [BackupStatus(f"{self.name}@{x.name}") for x in repos]
+        kwargs["timeout"] = self.timeout
+        started = time.time()
+        codes = [0] * len(repos)
+        try:
+            with using(repos if local else ()):
+                if len(repos) > 1:
+                    result = self._fanout(
+                        producer, commands, statuses, codes, **kwargs
+                    )
+                elif producer:
+                    result = executor.pipeline(
+                        [producer, commands[0]], on_output=statuses[0], **kwargs
+                    )
+                else:
+                    result = executor.run(commands[0], on_output=statuses[0], **kwargs)
+            if producer and result and result.durations:
+                add_phase("producer", result.durations[0])
+            return result
+        except subprocess.CalledProcessError as e:
+            if len(repos) == 1:
+                codes = [e.returncode]
+            raise
+        except subprocess.TimeoutExpired:
+            codes = [-1] * len(repos)
+            raise
+        finally:
+            # restic reads the source until its end, so it takes the whole time
+            add_phase("restic", time.time() - started)
+            if not executor.dry_run:
+                for repo, status, code in zip(repos, statuses, codes):
+                    add_summary(self.name, repo.name, status.summary)
+                    self.record(repo, status, started, code)
+
+    @staticmethod
+    def _fanout(producer, commands, statuses, codes, **kwargs):
+        """ Runs restic for all repositories at once, fills their return codes. """
+        result = executor.fanout(
+            producer, commands, on_output=statuses, check=False, **kwargs
+        )
+        if result.returncodes:
+            # restic saves truncated stream if producer failed
+            produced = result.returncodes[0] if producer else 0
+            codes[:] = [x or produced for x in result.returncodes[-len(commands) :]]
+            output = job_output.get()
+            result.check(output.text("stderr") if output else None)
+        return result
+
+    def record(self, repo, status: BackupStatus, started: float, code: int):
+        # not needed for dry runs
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        from .history import History  # pylint: disable=import-outside-toplevel
+
+        try:
+            History().record(
+                job=self.job.name,
+                repo=repo.name,
+                started=started,
+                duration=time.time() - started,
+                status=code,
+                summary=status.summary,
+            )
+        except sqlite3.Error as e:
+            log.warning("Failed to save backup results: %s", e)
+
+    def backup_files(self, paths, cwd=None, root=None):
+        """ 'root' identifies cwd which changes every run, see detector.scan(). """
+        scan = None
+        remote = self.job.remote is not None
+        # once: expanded names could contain glob characters themselves
+        paths = process_paths(paths, self.job, cwd)
+        if self.job.conf.get("skip-unchanged") and remote:
+            log.warning("[%s] skip-unchanged is ignored for remote jobs", self.name)
+        elif self.job.conf.get("skip-unchanged"):
+            with span("scan changes"):
+                scan = detector.scan(
+                    self.job, paths, cwd=cwd, name=self.name, root=root
+                )
+            if scan.unchanged:
+                log.info("[%s] Nothing changed, backup skipped", self.name)
+                return
         zstd = self.job.conf.get("zstd")
-        if zstd:
-            settings = zstd if isinstance(zstd, dict) else {}
-            log.info("ZSTD compression enabled.")
-            return self._backup_zstd(paths, settings=settings, cwd=cwd)
-        self._backup_files(paths, cwd=cwd)
-
-    def _backup_files(self, paths, cwd=None):
-        args = self.base_args()
-        paths = process_paths(paths, self.job)
-        args.extend(self.job.exclude.as_args())
-        args.extend(paths)
-        executor.run(args, cwd=cwd)
-
-    def backup_stdin(self, filename=None):
-        args = self.base_args() + ["--stdin"]
+        # long lists of exclusions and paths are passed through files
+        with ArgFiles(threshold=None if remote else THRESHOLD) as files:
+            if zstd:
+                settings = zstd if isinstance(zstd, dict) else {}
+                log.info("ZSTD compression enabled.")
+                self._backup_zstd(paths, files, settings=settings, cwd=cwd)
+            else:
+                self._backup_files(paths, files, cwd=cwd)
+        if scan and not executor.dry_run:
+            scan.commit()
+
+    def _backup_files(self, paths, files: ArgFiles, cwd=None):
+        """ Paths are processed already, like in the other _backup_* methods. """
+        args = []
+        args.extend(self.job.exclude.as_args(files))
+        prewalk = self.job.conf.get("prewalk")
+        if self.job.remote:
+            # remote files are read by restic only
+            prewalk = False
+        if prewalk is None and len(self.job.repos) > 1:
+            # the tree is walked once for all repositories
+            prewalk = True
+        if prewalk:
+            settings = prewalk if isinstance(prewalk, dict) else {}
+            log.info("Pre-walk enabled.")
+            return self._backup_prewalk(args, paths, settings=settings, cwd=cwd)
+        report = None
+        if self.job.exclude.larger_report:
+            report = self.scan_larger(paths, cwd)
+        args.extend(files.paths(paths, "--files-from-raw"))
+        self.execute(args, cwd=cwd)
+        if report:
+            report.log(self.name)
+
+    def scan_larger(self, paths, cwd=None) -> ty.Optional[SizeReport]:
+        """ Finds files skipped by the size limit of the job, if there is one. """
+        limit = self.job.exclude.larger
+        if limit is None or self.job.remote:
+            return None
+        with span("scan larger"):
+            return scan_larger(self.job.exclude.matcher, paths, limit, cwd=cwd)
+
+    def _backup_prewalk(self, args, paths, settings, cwd=None):
+        """
+        Walks the paths by itself, pruning excluded directories,
+        and sends the rest to restic through --files-from-raw.
+        """
+        args = args + ["--files-from-raw", "-"]
+        limit = self.job.exclude.larger
+        walker = Walker(
+            self.job.exclude.matcher,
+            threads=settings.get("threads", 8),
+            cwd=cwd,
+            stat=limit is not None,
+        )
+        found = walker.walk(sorted(paths))
+        report = None
+        if limit is not None:
+            # big files are dropped by the walk itself
+            report = SizeReport(limit)
+            found = report.filter(found)
+        paths = (os.fsencode(x) + b"\0" for x in found)
+        result = self.execute(args, cwd=cwd, stdin=paths)
+        log.info("Pre-walk sent %s paths to restic", result.fed)
+        if report:
+            report.log(self.name)
+
+    def stdin_args(self, filename=None):
+        args = ["--stdin"]
         if filename:
             args.extend(["--stdin-filename", filename])
-        if executor.dry_run:
-            print("Executing:", args)
-            return
-        return subprocess.Popen(args, stdin=subprocess.PIPE)
+        return args
+
+    def backup_stdin(self, producer, filename=None):
+        """ Backups output of the producer command. """
+        settings = self.job.conf.get("pump")
+        if settings is not None:
+            settings = settings if isinstance(settings, dict) else {}
+        return self.execute(self.stdin_args(filename), producer=producer, pump=settings)
+
+    @property
+    def timeout(self) -> ty.Optional[float]:
+        return self.job.conf.get("timeout")
 
-    def _backup_zstd(self, paths, settings, cwd=None):
-        filename = getattr(self.runner, "filename", "archive.tar.zst")
+    def zstd_threads(self, settings) -> int:
+        threads = settings.get("threads")
+        if threads is None:
+            # as many threads as CPUs assigned to the job
+            resources = self.job.resources
+            threads = resources.threads(2) if resources else 2
+        return threads
+
+    def zstd_command(self, settings) -> ty.List[str]:
+        threads = self.zstd_threads(settings)
+        command = [settings.get("executable", "zstd"), f"-T{threads}"]
+        if settings.get("block"):
+            command.append(f"-B{settings['block']}")
+        if settings.get("rsyncable"):
+            # resets compression at content-defined points, so changes do not
+            # propagate through the rest of the stream
+            command.append("--rsyncable")
+        return command
+
+    def tar_command(self, settings) -> ty.List[str]:
+        """
+        Returns tar command of the zstd job. Unless the archive changes little
+        when files do ('rsyncable', 'sort' or no compression at all),
+        restic finds nothing to deduplicate in it.
+        """
+        tar_args = ["tar", "-c"]
+        if settings.get("sort"):
+            # members in the same order every run, whatever readdir returns
+            tar_args.append("--sort=name")
+        if not settings.get("compress", True):
+            # restic compresses the data by itself (repository format 2)
+            return tar_args
+        return tar_args + ["-I", " ".join(self.zstd_command(settings))]
+
+    def _backup_zstd(self, paths, files: ArgFiles, settings, cwd=None):
+        default = "archive.tar.zst" if settings.get("compress", True) else "archive.tar"
+        filename = getattr(self.runner, "filename", default)
         filename = f"/{filename}"
-        threads = settings.get("threads", 2)
-        executable = settings.get("executable", "zstd")
-        restic_proc = self.backup_stdin(filename)
-        tar_args = ["tar", "-c", "-I", f"{executable} -T{threads}"]
+        if settings.get("prefetch") and self.job.remote:
+            log.warning("[%s] prefetch is ignored for remote jobs", self.name)
+        elif settings.get("prefetch"):
+            return self._backup_prefetch(paths, settings, filename, cwd=cwd)
+        tar_args = self.tar_command(settings)
         if cwd:
             tar_args.extend(["-C", cwd])
-        for item in self.job.exclude.exclude:
-            tar_args.extend(["--exclude", item])
-        tar_args.extend(paths)
-        if executor.dry_run:
-            return print("Executing:", tar_args)
-        subprocess.check_call(tar_args, stdout=restic_proc.stdin)
-        restic_proc.stdin.close()
-        restic_proc.wait()
-
-
-def process_paths(paths: ty.Iterable[str], job: "Job"):
-    # expand globs
-    paths = set(unglob(paths))
+        tar_args.extend(
+            files.patterns(
+                "--exclude", "--exclude-from", self.job.exclude.exclude, safe=tar_safe
+            )
+        )
+        # tar does not expand globs, names from the file are not options
+        report = self.scan_larger(paths, cwd)
+        if report and report.files:
+            # exact names of the big files
+            tar_args.extend(["--anchored", "--no-wildcards"])
+            tar_args.extend(
+                files.patterns(
+                    "--exclude",
+                    "--exclude-from",
+                    report.paths,
+                    safe=tar_safe,
+                    name="larger",
+                )
+            )
+        tar_args.extend(files.paths(paths, "--null", "--verbatim-files-from", "-T"))
+        self.backup_stdin(tar_args, filename)
+        if report:
+            report.log(self.name)
+
+    def _backup_prefetch(self, paths, settings, filename, cwd=None):
+        """
+        Writes the tar archive in-process, files are read by a thread pool
+        ahead of the writer. The archive is compressed by the 'zstandard' package
+        if it is installed (and zstd settings do not need the zstd command).
+        """
+        prefetch = settings["prefetch"]
+        prefetch = prefetch if isinstance(prefetch, dict) else {}
+        threads = prefetch.get("threads", 8)
+        limit = self.job.exclude.larger
+        walker = Walker(self.job.exclude.matcher, threads=threads, cwd=cwd, stat=True)
+        entries = walker.walk_sorted(paths, dirs=True)
+        report = None
+        if limit is not None:
+            report = SizeReport(limit)
+            entries = report.within(entries)
+        tar = TarStream(
+            threads=threads,
+            buffer=parse_size(prefetch.get("buffer", BUFFER)),
+            cwd=cwd,
+        )
+        stream = tar.stream(entries)
+        producer = None
+        # the package has no --rsyncable, a custom executable is run as is
+        command = any(settings.get(x) for x in ("executable", "rsyncable", "block"))
+        if not settings.get("compress", True):
+            compression = "none"
+        elif zstandard_available() and not command:
+            compression = "zstandard"
+            stream = compress(stream, threads=self.zstd_threads(settings))
+        else:
+            zstd = self.zstd_command(settings)
+            compression = " ".join(zstd)
+            producer = shlex.split(zstd[0]) + zstd[1:]
+        log.info(
+            "[%s] Prefetch: %s threads, compression: %s",
+            self.name,
+            threads,
+            compression,
+        )
+        self.execute(self.stdin_args(filename), producer=producer, stdin=stream)
+        if report:
+            report.log(self.name)
+
+
+def process_paths(paths: ty.Iterable[str], job: "Job", cwd=None):
+    # expand globs, paths of remote jobs are not on this host
+    with span("expand globs"):
+        paths = set(paths) if job.remote else set(unglob(paths, cwd))
     if not paths:
         raise ValueError("No paths left after glob expanding.")
     log.debug("Paths before exclude %s", paths)
-    exclude_paths(job, paths)
+    with span("exclude_paths"):
+        exclude_paths(job, paths)
     log.debug("After exclude: %s", paths)
     if not paths:
         raise ValueError("No paths left after exclude.")
     return paths
 
 
-def unglob(paths: ty.Iterable[str]) -> ty.Iterable[str]:
-    for path in paths:
-        result = glob.glob(path)
-        if not result:
-            log.warning("Failed to unglob %s - possible permission denied?", path)
-            result = [path]
-        yield from result
+def unglob(paths: ty.Iterable[str], cwd=None) -> ty.Iterable[str]:
+    expansion = globber.expand(paths, cwd)
+    yield from expansion
+    for path, reason in expansion.unmatched.items():
+        log.warning("Nothing matches %s (%s), passing it as is", path, reason)
+        yield path
 
 
 def exclude_paths(job, paths: set):
-    settings = job.exclude
-    for path in paths.copy():
-        for item in settings.exclude:
-            if path.startswith(item):
-                paths.remove(path)
-        for item in settings.iexclude:
-            if path.lower().startswith(item.lower()):
-                paths.remove(path)
+    paths.difference_update(job.exclude.matcher.excluded(paths))
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import typing as ty
+from pathlib import Path
+
+from . import __version__
+from .parser import JobMap, Parser, load_yaml
+from .state import cache_dir
+
+log = logging.getLogger(__name__)
+
+BUILTIN_PLUGINS = "resticrc.filtering.plugins."
+# changed when saved classes change, so old caches are not loaded
+FORMAT = 13
+
+
+def plugin_names() -> ty.List[str]:
+    """
+    Returns names of registered third-party filter plugins, stable between runs.
+    Built-in plugins are the same for the resticrc version. If filters were not
+    imported yet, nothing else could be registered: pluggy is not imported then.
+    """
+    api = sys.modules.get("resticrc.filtering.api")
+    if api is None:
+        return []
+    names = (
+        f"{type(x).__module__}.{type(x).__qualname__}"
+        for x in api.manager.get_plugins()
+    )
+    return sorted(x for x in names if not x.startswith(BUILTIN_PLUGINS))
+
+
+class ConfigCache:
+    """
+    Parsed configuration (repositories, jobs and their processed exclusions),
+    saved to a binary file to skip YAML parsing and filter processing.
+
+    Cache is valid for the same content of the config, set of plugins
+    and resticrc version. Content is hashed only if config mtime changed.
+    Jobs are added as they are used, see update(); compile() adds all of them.
+    """
+
+    def __init__(self, config, path=None):
+        self.config = Path(config).absolute()
+        if path is None:
+            name = hashlib.sha1(str(self.config).encode()).hexdigest()[:16]
+            path = cache_dir() / f"config-{name}.pickle"
+        self.path = Path(path)
+        # saved state of the config, without parsed jobs
+        self.data: ty.Optional[dict] = None
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def load(self) -> ty.Optional[Parser]:
+        """ Returns parser from cache, or None if cache is missing or stale. """
+        try:
+            stat = self.config.stat()
+            with open(self.path, "rb") as fd:
+                data = pickle.load(fd)
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug("Failed to load config cache %s: %s", self.path, e)
+            return None
+        if (data.get("version"), data.get("format")) != (__version__, FORMAT):
+            return None
+        if data["plugins"] != plugin_names():
+            return None
+        if (data["mtime"], data["size"]) != (stat.st_mtime_ns, stat.st_size):
+            if self.digest(self.config.read_bytes()) != data["digest"]:
+                return None
+            # config was touched, but not changed
+            data.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+            self.save(data)
+        log.debug("Using compiled config %s", self.path)
+        self.data = data
+        parser = Parser(data["conf"], read=False)
+        parser.path = self.config
+        parser.global_settings = data["global"]
+        parser.repos = data["repos"]
+        parser.jobs = JobMap(parser, data["jobs"])
+        return parser
+
+    def get(self) -> Parser:
+        """ Returns parser from cache if it is up to date, or parses config. """
+        return self.load() or self.parse()
+
+    def parse(self) -> Parser:
+        """ Parses config, jobs are parsed later, when they are used. """
+        stat = self.config.stat()
+        content = self.config.read_bytes()
+        parser = Parser(load_yaml(content))
+        parser.path = self.config
+        self.data = {
+            "version": __version__,
+            "format": FORMAT,
+            "plugins": [],
+            "digest": self.digest(content),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "conf": parser.conf,
+            "global": parser.global_settings,
+            "repos": parser.repos,
+            "jobs": {},
+        }
+        # new cache is saved even if no job is used
+        parser.jobs.dirty = True
+        return parser
+
+    def update(self, parser: Parser):
+        """ Saves jobs parsed since the cache was loaded. """
+        jobs = parser.jobs
+        if self.data is None or not isinstance(jobs, JobMap) or not jobs.dirty:
+            return
+        parsed = jobs.parsed()
+        for job in parsed.values():
+            job.exclude  # pylint: disable=pointless-statement
+        try:
+            self.save(dict(self.data, jobs=parsed, plugins=plugin_names()))
+        except OSError as e:
+            log.warning("Failed to save config cache %s: %s", self.path, e)
+        jobs.dirty = False
+
+    def compile(self) -> Parser:
+        """ Parses config, processes exclusions of all jobs and saves the result. """
+        parser = self.parse()
+        for name in parser.jobs:
+            parser.jobs[name]  # pylint: disable=pointless-statement
+        self.update(parser)
+        return parser
+
+    def save(self, data: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wb") as out:
+            pickle.dump(data, out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
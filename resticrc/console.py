@@ -1,23 +1,28 @@
+# Modules are imported by commands that need them: the CLI is started by cron
+# for every job, and '--version' or a dry run should not pay for all of them.
+# pylint: disable=import-outside-toplevel
 import logging
+import time
 from pathlib import Path
 
 import click
 
 from . import __version__
-from .parser import Parser
-from .executor import executor
 
 levels = [logging.WARNING, logging.INFO, logging.DEBUG]
 
-pass_parser = click.make_pass_decorator(Parser)
+# context object is resticrc.parser.Parser
+pass_parser = click.pass_obj
 
 
 @click.group()
 @click.version_option(__version__, prog_name="resticrc")
 @click.option("-v", "--verbose", count=True)
 @click.option("-c", "--config")
+@click.option("--no-cache", is_flag=True, help="Do not use compiled configuration")
 @click.pass_context
-def cli(ctx, verbose, config):
+def cli(ctx, verbose, config, no_cache):
+    started = time.perf_counter_ns()
     level = levels[min(verbose, 2)]
     logging.basicConfig(level=level)
     logging.getLogger("resticrc").setLevel(level)
@@ -26,7 +31,44 @@ def cli(ctx, verbose, config):
         config = confpath / "resticrc"
         if not config.exists():
             config = confpath / "resticrc.yml"
-    ctx.obj = Parser(config)
+    if no_cache:
+        from .parser import Parser
+
+        ctx.obj = Parser(config)
+    else:
+        from .compiled import ConfigCache
+
+        cache = ConfigCache(config)
+        ctx.obj = cache.get()
+        # jobs parsed by the command are compiled for the next runs
+        ctx.call_on_close(lambda: cache.update(ctx.obj))
+    # added to the trace of --profile, which is started later by the command
+    ctx.meta["config_loaded"] = (started, time.perf_counter_ns())
+
+
+def profiling(path):
+    """Returns context manager saving the trace of the block into path, if set."""
+    from .tracing import profile
+
+    started, loaded = click.get_current_context().meta["config_loaded"]
+    return profile(path, origin=started, before=[("load config", started, loaded)])
+
+
+@cli.group()
+def config():
+    """Manage configuration"""
+
+
+@config.command()
+@click.pass_context
+def compile(ctx):  # pylint: disable=redefined-builtin
+    """Compile configuration to speed up the next runs"""
+    from .compiled import ConfigCache
+
+    cache = ConfigCache(ctx.obj.path)
+    # compiled parser has nothing left to save when the command finishes
+    ctx.find_root().obj = cache.compile()
+    click.echo(f"Configuration compiled to {cache.path}")
 
 
 @cli.command()
@@ -34,26 +76,270 @@ def cli(ctx, verbose, config):
     "-n", "--dry-run", is_flag=True, help="Prints commands instead of executing"
 )
 @click.option("--cleanup", is_flag=True, help="Perform a cleanup after a backup")
+@click.option("--force", is_flag=True, help="Backup even if nothing changed")
+@click.option("--profile", type=click.Path(), help="Save a trace of the run (JSON)")
 @click.argument("jobname")
 @pass_parser
-def run(parser, jobname, dry_run, cleanup):
+def run(parser, jobname, dry_run, cleanup, force, profile):
+    from .changes import detector
+    from .executor import executor
+    from .metrics import exporting
+
     executor.dry_run = dry_run
-    job = parser.jobs[jobname]
-    job.run()
-    if cleanup:
-        job.repo.cleanup(
-            keep_daily=parser.conf.get("keep-daily"),
-            prune=parser.conf.get("prune-after"),
-        )
+    detector.force = force
+    with profiling(profile):
+        job = parser.jobs[jobname]
+        # dry runs are not measured
+        with exporting({} if dry_run else parser.conf, parser.jobs):
+            job.run()
+        if cleanup:
+            planner = parser.cleanup_planner()
+            planner.add(job)
+            error = cleanup_error(planner.run())
+            if error:
+                raise click.ClickException(error)
 
 
 @cli.command()
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="How many jobs could be executed concurrently",
+)
 @click.option("--cleanup", is_flag=True, help="Perform a cleanup after a backup")
+@click.option("--force", is_flag=True, help="Backup even if nothing changed")
+@click.option("--profile", type=click.Path(), help="Save a trace of the run (JSON)")
+@click.option(
+    "--warm-up/--no-warm-up",
+    default=None,
+    help="Fill restic caches before the jobs (default: 'warm-up' of 'cache')",
+)
 @pass_parser
-def all(parser, cleanup):
+def all(parser, workers, cleanup, force, profile, warm_up):
     """Execute all jobs"""
-    for job in parser.jobs.values():
-        logging.info("Executing job %s", job)
-        job.run()
-    if cleanup:
-        parser.cleanup_all()
+    from .changes import detector
+    from .metrics import exporting
+    from .scheduler import Scheduler
+
+    detector.force = force
+    errors = []
+    caches = parser.cache_manager()
+    with profiling(profile):
+        workers = workers or parser.conf.get("workers", 1)
+        scheduler = Scheduler(parser.jobs, workers=workers)
+        if caches and (caches.warm if warm_up is None else warm_up):
+            # a failed warm-up only makes the jobs slower
+            repos = {x.name: x for job in parser.jobs.values() for x in job.repos}
+            parser.warm_up(repos.values())
+        with exporting(parser.conf, parser.jobs):
+            results = scheduler.run()
+        failed = [name for name, result in results.items() if not result.ok]
+        if failed:
+            errors.append(f"Failed or cancelled jobs: {', '.join(failed)}")
+        if cleanup:
+            # repositories are cleaned for jobs that succeeded
+            planner = parser.cleanup_planner()
+            for name, result in results.items():
+                if result.ok:
+                    planner.add(parser.jobs[name])
+            error = cleanup_error(planner.run())
+            if error:
+                errors.append(error)
+        if caches:
+            caches.evict()
+    if errors:
+        raise click.ClickException("; ".join(errors))
+
+
+@cli.group(invoke_without_command=True)
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="How many jobs could be executed concurrently",
+)
+@click.option("--socket", "control_socket", help="Path of the control socket")
+@click.pass_context
+def daemon(ctx, workers, control_socket):
+    """Run jobs on their schedules, reloading configuration when it changes"""
+    ctx.meta["control_socket"] = control_socket
+    if ctx.invoked_subcommand is not None:
+        return
+    import signal
+
+    from .daemon import Daemon
+
+    parser = ctx.obj
+    if ctx.find_root().params["no_cache"]:
+        from functools import partial
+
+        from .parser import Parser
+
+        load = partial(Parser, parser.path)
+    else:
+        from .compiled import ConfigCache
+
+        load = ConfigCache(parser.path).get
+    server = Daemon(parser.path, load, workers=workers, control_socket=control_socket)
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    try:
+        server.serve()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+def daemon_request(ctx, command, **params) -> dict:
+    """Sends a request to the daemon, returns its response."""
+    from .daemon import request, socket_path
+
+    path = ctx.meta["control_socket"] or socket_path(ctx.obj.path)
+    try:
+        response = request(path, command, **params)
+    except OSError as e:
+        raise click.ClickException(f"Daemon is not running ({path}): {e}")
+    if not response["ok"]:
+        raise click.ClickException(response["error"])
+    return response
+
+
+@daemon.command("run")
+@click.argument("jobname")
+@click.pass_context
+def daemon_run(ctx, jobname):
+    """Start a job in the running daemon"""
+    if daemon_request(ctx, "run", job=jobname)["started"]:
+        click.echo(f"Job {jobname} started")
+    else:
+        click.echo(f"Job {jobname} is already running")
+
+
+@daemon.command("status")
+@click.argument("jobname", required=False)
+@click.pass_context
+def daemon_status(ctx, jobname):
+    """Show jobs of the running daemon"""
+    import time
+
+    line = "{:<20} {:<8} {:<18} {:<17} {:<9} {:>9}"
+    click.echo(line.format("JOB", "STATUS", "SCHEDULE", "NEXT RUN", "LAST", ""))
+    for x in daemon_request(ctx, "status", job=jobname)["jobs"]:
+        last = x["last"] or {}
+        click.echo(
+            line.format(
+                x["job"],
+                x["status"],
+                x["schedule"] or "-",
+                x["next_run"][:16].replace("T", " ") if x["next_run"] else "-",
+                last.get("status", "-"),
+                f"{last['duration']:.1f}s" if last else "",
+            ).rstrip()
+        )
+        if last.get("error"):
+            finished = time.strftime("%Y-%m-%d %H:%M", time.localtime(last["finished"]))
+            click.echo(f"  {finished}: {last['error']}")
+
+
+@daemon.command("reload")
+@click.pass_context
+def daemon_reload(ctx):
+    """Reload configuration of the running daemon"""
+    changed = daemon_request(ctx, "reload")["changed"]
+    click.echo(f"Reloaded jobs: {', '.join(changed)}" if changed else "No changes")
+
+
+def cleanup_error(errors: dict):
+    """Returns message about repositories which cleanup failed."""
+    return f"Cleanup failed for: {', '.join(errors)}" if errors else None
+
+
+@cli.group(name="cache")
+def cache_group():
+    """Manage restic caches"""
+
+
+def cache_manager(parser):
+    manager = parser.cache_manager()
+    if manager is None:
+        raise click.ClickException("Restic caches are not managed, set 'cache'")
+    return manager
+
+
+@cache_group.command(name="warm-up")
+@click.option(
+    "-n", "--dry-run", is_flag=True, help="Prints commands instead of executing"
+)
+@click.argument("repos", nargs=-1)
+@pass_parser
+def cache_warm_up(parser, repos, dry_run):
+    """Fill restic caches of repositories (default: all)"""
+    from .executor import executor
+
+    executor.dry_run = dry_run
+    cache_manager(parser)
+    unknown = set(repos) - set(parser.repos)
+    if unknown:
+        raise click.ClickException(f"Unknown repositories: {', '.join(unknown)}")
+    errors = parser.warm_up(parser.repos[x] for x in repos or parser.repos)
+    if errors:
+        raise click.ClickException(f"Warm-up failed for: {', '.join(errors)}")
+
+
+@cache_group.command()
+@click.option(
+    "-n", "--dry-run", is_flag=True, help="Prints commands instead of executing"
+)
+@pass_parser
+def evict(parser, dry_run):
+    """Remove unused restic caches and the ones above 'max-size'"""
+    from .executor import executor
+    from .pump import humanize
+
+    executor.dry_run = dry_run
+    for entry in cache_manager(parser).evict():
+        click.echo(f"{entry.path.name}: {humanize(entry.size)}")
+
+
+@cli.command()
+@click.argument("jobname", required=False)
+@click.option("--days", type=float, help="Use only backups of last N days")
+@click.option(
+    "--factor",
+    default=2.0,
+    show_default=True,
+    help="How much slower a backup should be to be reported as a regression",
+)
+def stats(jobname, days, factor):
+    """Show statistics of previous backups"""
+    import time
+
+    from .history import History
+    from .pump import humanize
+
+    history = History()
+    rows = sorted(history.stats(jobname, days), key=lambda x: -x.median_duration)
+    if not rows:
+        click.echo("No backups recorded yet.")
+        return
+    line = "{:<20} {:>5} {:>6} {:>17} {:>9} {:>9} {:>6} {:>10}"
+    header = ("JOB", "RUNS", "FAILED", "LAST RUN", "LAST", "MEDIAN", "TREND", "ADDED")
+    click.echo(line.format(*header))
+    for x in rows:
+        click.echo(
+            line.format(
+                x.job,
+                x.runs,
+                x.failures,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(x.last_started)),
+                f"{x.last_duration:.1f}s",
+                f"{x.median_duration:.1f}s",
+                f"x{x.slowdown:.2f}",
+                humanize(x.median_added),
+            )
+        )
+    for x, median in history.regressions(factor=factor, days=days):
+        if jobname in (None, x.job):
+            click.echo(
+                f"Regression: {x.job} took {x.last_duration:.1f}s, "
+                f"usually {median:.1f}s"
+            )
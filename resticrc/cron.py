@@ -0,0 +1,132 @@
+"""
+Cron-style schedules of jobs: 'minute hour day month weekday',
+e.g. '30 2 * * *' or '*/15 8-18 * * mon-fri', and aliases like '@daily'.
+"""
+import datetime
+import typing as ty
+
+from attr import attrs, attrib
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTHS = "jan feb mar apr may jun jul aug sep oct nov dec".split()
+WEEKDAYS = "sun mon tue wed thu fri sat".split()
+# (name, first, last, names of values starting from the first)
+FIELDS = [
+    ("minute", 0, 59, []),
+    ("hour", 0, 23, []),
+    ("day", 1, 31, []),
+    ("month", 1, 12, MONTHS),
+    ("weekday", 0, 7, WEEKDAYS),
+]
+# days of months in a leap year
+MONTH_DAYS = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+# a matching date is found within a few years (February 29 in a leap one)
+MAX_DAYS = 5 * 366
+
+
+def parse_field(value: str, first: int, last: int, names: ty.List[str]) -> frozenset:
+    """ Returns values of a field: lists of '*', 'a', 'a-b' with optional '/step'. """
+
+    def number(x: str) -> int:
+        if x.lower() in names:
+            return names.index(x.lower()) + first
+        if not x.isdigit() or not first <= int(x) <= last:
+            raise ValueError(f"{x!r} is out of range {first}-{last}")
+        return int(x)
+
+    out: ty.Set[int] = set()
+    for part in value.split(","):
+        rng, _, step = part.partition("/")
+        if rng == "*":
+            start, end = first, last
+        elif "-" in rng:
+            a, b = rng.split("-", 1)
+            start, end = number(a), number(b)
+        else:
+            start = end = number(rng)
+            if step:
+                end = last
+        if not step:
+            interval = 1
+        elif step.isdigit() and int(step) > 0:
+            interval = int(step)
+        else:
+            raise ValueError(f"Invalid step {step!r}")
+        if start > end:
+            raise ValueError(f"Invalid range {rng!r}")
+        out.update(range(start, end + 1, interval))
+    return frozenset(out)
+
+
+@attrs(frozen=True)
+class Cron:
+    """ Parsed schedule, saved in the compiled config. """
+
+    expression: str = attrib()
+    minute: frozenset = attrib(eq=False)
+    hour: frozenset = attrib(eq=False)
+    day: frozenset = attrib(eq=False)
+    month: frozenset = attrib(eq=False)
+    weekday: frozenset = attrib(eq=False)
+    # cron matches either the day or the weekday if both are restricted
+    any_day: bool = attrib(default=False, eq=False)
+
+    @classmethod
+    def parse(cls, expression: str) -> "Cron":
+        expression = " ".join(str(expression).split())
+        fields = ALIASES.get(expression.lower(), expression).split()
+        if len(fields) != len(FIELDS):
+            raise ValueError(
+                f"Invalid schedule {expression!r}, expected e.g. '30 2 * * *'."
+            )
+        try:
+            values = [
+                parse_field(value, *spec[1:]) for value, spec in zip(fields, FIELDS)
+            ]
+        except ValueError as e:
+            raise ValueError(f"Invalid schedule {expression!r}: {e}") from None
+        minute, hour, day, month, weekday = values
+        # both 0 and 7 are Sunday
+        weekday = frozenset(x % 7 for x in weekday)
+        any_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+        if not any_day and not any(x <= MONTH_DAYS[m - 1] for x in day for m in month):
+            # e.g. '0 0 31 2 *', it would never run
+            raise ValueError(f"Invalid schedule {expression!r}: no such day.")
+        return cls(expression, minute, hour, day, month, weekday, any_day=any_day)
+
+    def __str__(self):
+        return self.expression
+
+    def matches_day(self, date: datetime.date) -> bool:
+        if date.month not in self.month:
+            return False
+        # isoweekday() is 1 for Monday and 7 for Sunday
+        in_day = date.day in self.day
+        in_weekday = date.isoweekday() % 7 in self.weekday
+        if self.any_day:
+            return in_day or in_weekday
+        return in_day and in_weekday
+
+    def next(self, after: datetime.datetime) -> datetime.datetime:
+        """ Returns the first matching minute later than after. """
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        date = start.date()
+        for _ in range(MAX_DAYS):
+            if self.matches_day(date):
+                for hour in sorted(self.hour):
+                    for minute in sorted(self.minute):
+                        moment = datetime.datetime.combine(
+                            date, datetime.time(hour, minute), tzinfo=after.tzinfo
+                        )
+                        if moment >= start:
+                            return moment
+            date += datetime.timedelta(days=1)
+        raise ValueError(f"Schedule {self.expression!r} never matches")
@@ -0,0 +1,468 @@
+"""
+Long-running scheduler ('resticrc daemon').
+
+Parsed jobs are kept in memory and started on their 'schedule'. The config
+is checked for changes every few seconds; only jobs whose settings changed
+are parsed again, the others keep their processed exclusions.
+Jobs writing to the same repository wait for each other (up to its
+'concurrency'), a job is never started twice at once. A job with 'after'
+waits for its queued or running dependencies and is cancelled unless
+their last runs succeeded.
+
+A unix socket in the runtime directory accepts one JSON request per
+connection, e.g. {"command": "run", "job": "etc"}, and answers with one
+JSON line, see Daemon.handle().
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import typing as ty
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from attr import attrs, attrib
+
+from . import metrics
+from .executor import executor
+from .remote import connections
+from .scheduler import CANCELLED, JobResult, run_job
+from .state import DurationStore, runtime_dir
+
+if ty.TYPE_CHECKING:
+    from .models import Job, Repository
+    from .parser import Parser
+
+log = logging.getLogger(__name__)
+
+# seconds between checks of the config file
+RELOAD_INTERVAL = 5.0
+WORKERS = 4
+
+IDLE = "idle"
+QUEUED = "queued"
+RUNNING = "running"
+# for dependencies to finish
+WAITING = "waiting"
+
+
+def socket_path(config) -> Path:
+    """ Returns control socket of the daemon serving the config. """
+    name = hashlib.sha1(str(Path(config).absolute()).encode()).hexdigest()[:16]
+    return runtime_dir() / f"daemon-{name}.sock"
+
+
+def raw_jobs(parser: "Parser") -> dict:
+    return parser.conf.get("jobs") or {}
+
+
+def unchanged(old: "Parser", new: "Parser", name: str, job: "Job") -> bool:
+    """ Returns True if the job parsed from the new config would be the same. """
+    return (
+        raw_jobs(old).get(name) == raw_jobs(new).get(name)
+        and old.conf.get("global") == new.conf.get("global")
+        and all((new.repos or {}).get(x.name) == x for x in job.repos)
+    )
+
+
+@attrs
+class JobState:
+    """ Job of the daemon with its schedule and the last result. """
+
+    name: str = attrib()
+    job: "Job" = attrib()
+    next_run: ty.Optional[datetime.datetime] = attrib(default=None)
+    status: str = attrib(default=IDLE)
+    started: ty.Optional[float] = attrib(default=None)
+    last: ty.Optional[JobResult] = attrib(default=None)
+    finished: ty.Optional[float] = attrib(default=None)
+
+    def reschedule(self, now: datetime.datetime):
+        schedule = self.job.schedule
+        self.next_run = schedule.next(now) if schedule else None
+
+    def as_dict(self) -> dict:
+        out = {
+            "job": self.name,
+            "status": self.status,
+            "schedule": str(self.job.schedule) if self.job.schedule else None,
+            "next_run": self.next_run.isoformat() if self.next_run else None,
+            "started": self.started,
+            "last": None,
+        }
+        if self.last is not None:
+            out["last"] = {
+                "status": self.last.status,
+                "duration": self.last.duration,
+                "finished": self.finished,
+                "error": str(self.last.error) if self.last.error else None,
+            }
+        return out
+
+
+class Daemon:
+    """ Runs jobs of the config on their schedules until stopped. """
+
+    def __init__(
+        self,
+        path,
+        load: ty.Callable[[], "Parser"],
+        workers: ty.Optional[int] = None,
+        control_socket=None,
+        reload_interval: float = RELOAD_INTERVAL,
+        durations: ty.Optional[DurationStore] = None,
+    ):
+        self.path = Path(path)
+        self.load = load
+        self.workers = workers
+        self.socket = Path(control_socket) if control_socket else socket_path(self.path)
+        self.reload_interval = reload_interval
+        self.durations = durations or DurationStore()
+        self.parser: ty.Optional["Parser"] = None
+        self.jobs: ty.Dict[str, JobState] = {}
+        # queued jobs in the order they were started
+        self.queue: ty.List[str] = []
+        # running jobs with names of the repositories they write to
+        self.running: ty.Dict[str, ty.List[str]] = {}
+        self.pool: ty.Optional[ThreadPoolExecutor] = None
+        # 'metrics' settings, read once at start
+        self.metrics: ty.Optional[dict] = None
+        # (mtime, size) of the loaded config
+        self.signature: ty.Optional[ty.Tuple[int, int]] = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def now() -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def reload(self, force=False) -> ty.List[str]:
+        """ Loads the config if the file changed, returns names of rebuilt jobs. """
+        try:
+            stat = self.path.stat()
+        except OSError as e:
+            log.warning("Failed to check config %s: %s", self.path, e)
+            return []
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature and not force:
+            return []
+        # a broken config is not retried until it is changed again
+        self.signature = signature
+        try:
+            parser = self.load()
+        except Exception as e:  # pylint: disable=broad-except
+            log.error("Failed to load config %s: %s", self.path, e)
+            return []
+        with self._lock:
+            changed = self.update(parser)
+        if changed:
+            log.info("Jobs loaded: %s", ", ".join(changed))
+        self._wakeup.set()
+        return changed
+
+    def update(self, parser: "Parser") -> ty.List[str]:
+        """ Takes jobs from the new parser, parsing only changed ones. """
+        old = self.parser
+        now = self.now()
+        changed = []
+        for name in list(self.jobs):
+            if name not in parser.jobs:
+                log.info("Job %s was removed", name)
+                del self.jobs[name]
+        for name in parser.jobs:
+            state = self.jobs.get(name)
+            if state and old and unchanged(old, parser, name, state.job):
+                continue
+            try:
+                job = parser.jobs[name]
+                # processed before the first run, so errors are reported now
+                job.exclude  # pylint: disable=pointless-statement
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("Failed to load job %s: %s", name, e)
+                continue
+            changed.append(name)
+            if state is None:
+                state = self.jobs[name] = JobState(name, job)
+                state.reschedule(now)
+                continue
+            # a running job finishes with its old settings
+            rescheduled = state.job.schedule != job.schedule
+            state.job = job
+            if rescheduled:
+                state.reschedule(now)
+        self.parser = parser
+        return changed
+
+    def waits_for(self, name: str, dep: str) -> bool:
+        """
+        Returns True if the job should wait for the dependency: it is queued,
+        running or waiting itself, but not for the job (a cycle).
+        """
+        seen = set()
+        todo = [dep]
+        while todo:
+            current = todo.pop()
+            if current == name:
+                return False
+            if current in seen or current not in self.jobs:
+                continue
+            seen.add(current)
+            if self.jobs[current].status == WAITING:
+                todo.extend(self.jobs[current].job.after)
+        return dep in self.jobs and self.jobs[dep].status != IDLE
+
+    def start(self, name: str) -> bool:
+        """
+        Queues the job, returns False if it is already queued or running,
+        or it is cancelled because its dependencies did not succeed.
+        """
+        with self._lock:
+            state = self.jobs[name]
+            if state.status != IDLE:
+                log.warning("Job %s is still %s, not started again", name, state.status)
+                return False
+            after = state.job.after
+            busy = [x for x in after if self.waits_for(name, x)]
+            failed = [
+                x
+                for x in after
+                if x not in self.jobs
+                or not (self.jobs[x].last and self.jobs[x].last.ok)
+            ]
+            if busy:
+                # started when they finish, see resume()
+                log.info("Job %s waits for %s", name, ", ".join(busy))
+                state.status = WAITING
+                return True
+            if failed:
+                error = RuntimeError(
+                    f"Dependencies did not succeed: {', '.join(failed)}"
+                )
+                log.warning("Job %s cancelled: %s", name, error)
+                state.last = JobResult(name, CANCELLED, error=error)
+                state.finished = time.time()
+            else:
+                state.status = QUEUED
+                self.queue.append(name)
+        if failed:
+            self.resume(name)
+            return False
+        self.dispatch()
+        return True
+
+    @property
+    def worker_count(self) -> int:
+        conf = self.parser.conf if self.parser else {}
+        return self.workers or conf.get("workers", WORKERS)
+
+    def concurrency(self, repo: "Repository") -> int:
+        """ Concurrency of the repository in the current config. """
+        current = (self.parser.repos or {}).get(repo.name) if self.parser else None
+        return (current or repo).concurrency
+
+    def dispatch(self):
+        """
+        Submits queued jobs while there are free workers and their repositories
+        have free slots, like Scheduler.ready(), so a worker never waits.
+        """
+        started = []
+        with self._lock:
+            usage = Counter(x for repos in self.running.values() for x in repos)
+            slots = self.worker_count - len(self.running)
+            for name in list(self.queue):
+                if slots <= 0:
+                    break
+                state = self.jobs.get(name)
+                if state is None or state.status != QUEUED:
+                    self.queue.remove(name)
+                    continue
+                repos = {x.name: x for x in state.job.repos}
+                if name in self.running or any(
+                    usage[x] >= self.concurrency(repo) for x, repo in repos.items()
+                ):
+                    continue
+                usage.update(list(repos))
+                slots -= 1
+                self.queue.remove(name)
+                self.running[name] = list(repos)
+                state.status = RUNNING
+                state.started = time.time()
+                started.append(state)
+        if started:
+            assert self.pool is not None
+        for state in started:
+            self.pool.submit(self.run_job, state)
+
+    def resume(self, name: str):
+        """ Starts jobs waiting for the finished one. """
+        with self._lock:
+            waiting = [
+                x
+                for x in self.jobs.values()
+                if x.status == WAITING and name in x.job.after
+            ]
+            for state in waiting:
+                state.status = IDLE
+        for state in waiting:
+            self.start(state.name)
+
+    def run_job(self, state: JobState):
+        result = run_job(state.name, state.job)
+        with self._lock:
+            state.status = IDLE
+            state.last = result
+            state.finished = time.time()
+            del self.running[state.name]
+        if result.ok:
+            self.durations.record(state.name, result.duration)
+            try:
+                self.durations.save()
+            except OSError as e:
+                log.warning("Failed to save job durations: %s", e)
+        if self.metrics is not None:
+            metrics.export(self.metrics, self.jobs)
+        self.dispatch()
+        self.resume(state.name)
+
+    def tick(self, now=None) -> ty.Optional[datetime.datetime]:
+        """ Starts jobs that are due, returns when the next one is. """
+        now = now or self.now()
+        with self._lock:
+            due = [x for x in self.jobs.values() if x.next_run and x.next_run <= now]
+            for state in due:
+                state.reschedule(now)
+        for state in due:
+            self.start(state.name)
+        with self._lock:
+            upcoming = [x.next_run for x in self.jobs.values() if x.next_run]
+        return min(upcoming, default=None)
+
+    def status(self, name=None) -> ty.List[dict]:
+        with self._lock:
+            if name is not None:
+                return [self.jobs[name].as_dict()]
+            return [x.as_dict() for x in self.jobs.values()]
+
+    def handle(self, request: dict) -> dict:
+        """
+        Executes a control request:
+        'status' (optionally of 'job'), 'run' of 'job' and 'reload'.
+        A job run with 'after' waits for its dependencies like a scheduled one.
+        """
+        command = request.get("command")
+        name = request.get("job")
+        if name is not None and name not in self.jobs:
+            return {"ok": False, "error": f"Unknown job {name!r}"}
+        if command == "status":
+            return {"ok": True, "jobs": self.status(name)}
+        if command == "run":
+            if name is None:
+                return {"ok": False, "error": "Job is required"}
+            return {"ok": True, "started": self.start(name)}
+        if command == "reload":
+            return {"ok": True, "changed": self.reload(force=True)}
+        return {"ok": False, "error": f"Unknown command {command!r}"}
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def serve(self):
+        """ Runs until stop() is called, waits for running jobs then. """
+        self.reload(force=True)
+        if self.parser is None:
+            raise ValueError(f"Failed to load config {self.path}")
+        # the pool is not resized by reloads
+        self.workers = self.worker_count
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="job")
+        self.metrics = metrics.settings(self.parser.conf)
+        http = None
+        if self.metrics is not None:
+            metrics.registry.enabled = True
+            metrics.export(self.metrics, self.jobs)
+            if self.metrics.get("listen"):
+                http = metrics.serve(str(self.metrics["listen"]))
+        server = ControlServer(self.socket, self)
+        thread = threading.Thread(
+            target=server.serve_forever, name="control", daemon=True
+        )
+        thread.start()
+        log.info("Daemon started, control socket %s", self.socket)
+        try:
+            while not self._stopped.is_set():
+                self.reload()
+                upcoming = self.tick()
+                timeout = self.reload_interval
+                if upcoming is not None:
+                    left = (upcoming - self.now()).total_seconds()
+                    timeout = max(0.0, min(timeout, left))
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+        except KeyboardInterrupt:
+            executor.shutdown()
+            raise
+        finally:
+            server.shutdown()
+            server.server_close()
+            if http is not None:
+                http.shutdown()
+                http.server_close()
+            log.info("Waiting for running jobs")
+            self.pool.shutdown(wait=True)
+            connections.close()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.daemon.handle(request)  # type: ignore
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("Failed to handle control request: %s", e)
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: Path, daemon: Daemon):
+        self.daemon = daemon
+        path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+        if path.exists():
+            try:
+                request(path, "status")
+            except OSError:
+                # left by a daemon that was killed
+                path.unlink()
+            else:
+                raise ValueError(f"Daemon is already running, socket {path}")
+        super().__init__(str(path), ControlHandler)
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def request(path, command: str, timeout: float = 30.0, **params) -> dict:
+    """ Sends a request to the daemon, raises OSError if it is not running. """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(json.dumps(dict(params, command=command)).encode() + b"\n")
+        with sock.makefile("rb") as fd:
+            line = fd.readline()
+    if not line:
+        raise ConnectionError(f"No response from {path}")
+    return json.loads(line)
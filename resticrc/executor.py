@@ -1,19 +1,294 @@
-from subprocess import check_call
+import contextlib
+import contextvars
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import typing as ty
+from collections import deque
+from subprocess import CalledProcessError
 
 from attr import attrib, attrs
 
+from .pump import PumpStats
+
+if ty.TYPE_CHECKING:
+    from .resources import Resources
+
+log = logging.getLogger(__name__)
+
+Command = ty.Sequence[str]
+# longest line that is read from a command output at once
+LINE_LIMIT = 1 << 20
+
+
+@attrs
+class OutputBuffer:
+    """ Last lines of output of the job commands, limited by size. """
+
+    name: str = attrib(default="")
+    limit: int = attrib(default=1 << 20)
+    echo: bool = attrib(default=True)
+
+    def __attrs_post_init__(self):
+        self.lines: ty.Deque[ty.Tuple[str, bytes]] = deque()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def append(self, stream: str, line: bytes):
+        with self._lock:
+            self.lines.append((stream, line))
+            self.size += len(line)
+            while self.size > self.limit and len(self.lines) > 1:
+                self.size -= len(self.lines.popleft()[1])
+        if self.echo:
+            out = sys.stdout if stream == "stdout" else sys.stderr
+            prefix = f"[{self.name}] " if self.name else ""
+            out.write(prefix + line.decode(errors="replace"))
+            out.flush()
+
+    def text(self, stream: ty.Optional[str] = None) -> str:
+        with self._lock:
+            lines = [x for name, x in self.lines if stream in (None, name)]
+        return b"".join(lines).decode(errors="replace")
+
+
+# output of the job currently executed in this thread or task
+job_output: "contextvars.ContextVar[ty.Optional[OutputBuffer]]" = (
+    contextvars.ContextVar("job_output", default=None)
+)
+
+# resources limits and name of the job currently executed in this thread or task
+job_resources: "contextvars.ContextVar[ty.Optional[ty.Tuple[Resources, str]]]" = (
+    contextvars.ContextVar("job_resources", default=None)
+)
+
+
+@attrs
+class Result:
+    """ Result of a command or pipeline. """
+
+    returncodes: ty.List[int] = attrib(factory=list)
+    # statistics of pumps between pipeline stages
+    stats: ty.List[PumpStats] = attrib(factory=list)
+    # how many chunks were sent to the standard input
+    fed: int = attrib(default=0)
+    commands: ty.List[ty.List[str]] = attrib(factory=list)
+    # seconds from start to exit of each command
+    durations: ty.List[float] = attrib(factory=list)
+
+    def check(self, stderr: ty.Optional[str] = None):
+        """ Raises error of the failed command, ignoring ones killed by SIGPIPE. """
+        failed = [
+            (command, code)
+            for command, code in zip(self.commands, self.returncodes)
+            if code
+        ]
+        if not failed:
+            return
+        real = [x for x in failed if x[1] != -signal.SIGPIPE]
+        command, code = (real or failed)[0]
+        raise CalledProcessError(code, command, stderr=stderr)
+
 
 @attrs
 class ConsoleExecutor:
     """ Command executor with debugging support. """
 
     dry_run: bool = attrib(default=False)
+    # how long to wait for processes after SIGTERM before killing them
+    grace_period: float = attrib(default=5.0)
+
+    def __attrs_post_init__(self):
+        self._pids: ty.Set[int] = set()
+        self._lock = threading.Lock()
+        self.stopping = False
 
-    def run(self, command, cwd=None):
+    def run(self, command: Command, cwd=None, **kwargs) -> Result:
+        """ Executes command, raises CalledProcessError if it fails. """
         if self.dry_run:
-            print("Executing:", command)
-        else:
-            check_call(command, cwd=cwd)
+            return self._show([command])
+        return self._sync(self.arun(command, cwd=cwd, **kwargs))
+
+    def pipeline(self, commands: ty.Sequence[Command], **kwargs) -> Result:
+        """ Executes commands with output of each sent to input of the next one. """
+        if self.dry_run:
+            return self._show(commands)
+        return self._sync(self.apipeline(commands, **kwargs))
+
+    def fanout(
+        self, producer: ty.Optional[Command], commands: ty.Sequence[Command], **kwargs
+    ) -> Result:
+        """ Executes commands concurrently, each one gets a copy of producer output. """
+        if self.dry_run:
+            return self._show(([producer] if producer else []) + list(commands))
+        return self._sync(self.afanout(producer, commands, **kwargs))
+
+    @contextlib.contextmanager
+    def capture(self, output: OutputBuffer):
+        """ Saves output of commands executed within the block into buffer. """
+        token = job_output.set(output)
+        try:
+            yield output
+        finally:
+            job_output.reset(token)
+
+    @contextlib.contextmanager
+    def limit(self, resources: ty.Optional["Resources"], name: str = ""):
+        """ Applies resources limits to commands executed within the block. """
+        token = job_resources.set((resources, name) if resources else None)
+        try:
+            yield
+        finally:
+            job_resources.reset(token)
+
+    def shutdown(self):
+        """
+        Terminates all running commands.
+        Could be called from any thread, e.g. on KeyboardInterrupt.
+        """
+        self.stopping = True
+        with self._lock:
+            pids = list(self._pids)
+        log.warning("Terminating %s running processes", len(pids))
+        self._signal(pids, signal.SIGTERM)
+        deadline = time.monotonic() + self.grace_period
+        while self._pids and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._lock:
+            self._signal(list(self._pids), signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _sync(self, coro):
+        # called from worker threads too: Python 3.8+ reaps children with
+        # ThreadedChildWatcher, 3.7 watchers only work in the main thread
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        return asyncio.run(self._guard(coro))
+
+    async def _guard(self, coro):
+        """ Converts SIGINT to cancellation, so children are terminated properly. """
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        main = threading.current_thread() is threading.main_thread()
+        if not main:
+            return await coro
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        interrupted = []
+
+        def on_interrupt():
+            interrupted.append(True)
+            task.cancel()
+
+        loop.add_signal_handler(signal.SIGINT, on_interrupt)
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            if interrupted:
+                raise KeyboardInterrupt from None
+            raise
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+
+    async def arun(self, command: Command, **kwargs) -> Result:
+        return await self.apipeline([command], **kwargs)
+
+    async def apipeline(
+        self,
+        commands: ty.Sequence[Command],
+        cwd=None,
+        timeout: ty.Optional[float] = None,
+        stdin: ty.Optional[ty.Iterable[bytes]] = None,
+        stdout=None,
+        pump: ty.Optional[dict] = None,
+        on_output: ty.Optional[ty.Callable[[bytes], None]] = None,
+        check=True,
+    ) -> Result:
+        """
+        Executes pipeline of commands.
+        :argument stdin: chunks of data for the first command.
+        :argument stdout: where to send output of the last command.
+        :argument pump: settings of pump between commands, see resticrc.pump.
+        :argument on_output: callback for each line of the last command output.
+        :argument check: raise CalledProcessError if any command failed.
+        """
+        commands = self._wrap(commands)
+        if self._skip(commands):
+            return Result()
+        from .pipeline import Pipeline  # pylint: disable=import-outside-toplevel
+
+        pipeline = Pipeline(self, commands, cwd, stdin, stdout, pump, on_output)
+        return await pipeline.run(timeout, check)
+
+    async def afanout(
+        self,
+        producer: ty.Optional[Command],
+        commands: ty.Sequence[Command],
+        cwd=None,
+        timeout: ty.Optional[float] = None,
+        stdin: ty.Optional[ty.Iterable[bytes]] = None,
+        pump: ty.Optional[dict] = None,
+        on_output: ty.Sequence[ty.Optional[ty.Callable[[bytes], None]]] = (),
+        check=True,
+    ) -> Result:
+        """
+        Executes commands concurrently, copying output of the producer command
+        (or stdin chunks, if there is no producer) to input of each of them.
+        Return codes are in order of producer and commands.
+        :argument pump: settings of the copy, keys are 'buffer' and 'queue'.
+        :argument on_output: callbacks for lines of output of each command.
+        """
+        producer = self._wrap([producer])[0] if producer else None
+        commands = self._wrap(commands)
+        stages = ([producer] if producer else []) + list(commands)
+        if self._skip(stages):
+            return Result()
+        from .pipeline import FanOut  # pylint: disable=import-outside-toplevel
+
+        fanout = FanOut(self, producer, commands, cwd, stdin, pump, list(on_output))
+        return await fanout.run(timeout, check)
+
+    def _wrap(self, commands: ty.Sequence[Command]) -> ty.List[Command]:
+        """ Applies resources limits of the current job to commands. """
+        limits = job_resources.get()
+        if limits is None:
+            return list(commands)
+        resources, name = limits
+        # dry runs show the limits, but do not create cgroups
+        return [resources.wrap(x, name, setup=not self.dry_run) for x in commands]
+
+    def _show(self, commands: ty.Sequence[Command]) -> Result:
+        """ Prints commands of a dry run, without starting an event loop. """
+        self._skip(self._wrap(commands))
+        return Result()
+
+    def _skip(self, commands) -> bool:
+        """ Returns True if commands should not be executed. """
+        if self.dry_run:
+            for command in commands:
+                print("Executing:", command)
+            return True
+        if self.stopping:
+            raise RuntimeError("Executor is shutting down.")
+        return False
+
+    def register(self, pid):
+        with self._lock:
+            self._pids.add(pid)
+
+    def unregister(self, pid):
+        with self._lock:
+            self._pids.discard(pid)
 
 
 executor = ConsoleExecutor()
@@ -1,2 +1,12 @@
-from .api import hookimpl, manager, process_filters
-from . import plugins
+import importlib
+
+# pluggy and plugins are imported on first access, not on every start
+_LAZY = ("hookimpl", "manager", "process_filters")
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    api = importlib.import_module(".api", __name__)
+    importlib.import_module(".plugins", __name__)
+    return getattr(api, name)
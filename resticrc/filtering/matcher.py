@@ -0,0 +1,237 @@
+"""
+Compiled matcher for restic exclusion patterns.
+
+Rules are the same as in restic:
+* pattern is matched against path components, '*' and '?' never match '/';
+* '**' matches any number of components;
+* pattern starting with '/' is matched from the root of the path,
+  others could match at any depth;
+* if pattern matches a directory, then everything inside it is matched too;
+* patterns starting with '!' re-include paths matched by other patterns,
+  the last matching pattern decides;
+* exclude and iexclude patterns are separate lists, a path matched
+  by either one is excluded;
+* environment variables in patterns are expanded.
+"""
+import os
+import posixpath
+import re
+import typing as ty
+
+GLOB_CHARS = re.compile(r"[*?\[\\]")
+
+# marker of a pattern end in a trie node
+_END = ""
+
+
+def split_pattern(pattern: str) -> ty.Tuple[bool, ty.List[str]]:
+    """ Returns whether pattern is anchored to the root and its components. """
+    pattern = os.path.expandvars(pattern)
+    anchored = pattern.startswith("/")
+    parts = [x for x in pattern.split("/") if x and x != "."]
+    # trailing '**' matches the directory itself as well as its contents,
+    # leading one is what unanchored patterns do anyway.
+    while parts and parts[-1] == "**":
+        parts.pop()
+    if not anchored:
+        while parts and parts[0] == "**":
+            parts.pop(0)
+    return anchored, parts
+
+
+def translate_part(part: str) -> str:
+    """ Translates one component of a pattern to regex, like Go's filepath.Match. """
+    out = []
+    i, n = 0, len(part)
+    while i < n:
+        char = part[i]
+        i += 1
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "\\" and i < n:
+            out.append(re.escape(part[i]))
+            i += 1
+        elif char == "[":
+            end = part.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(char))
+                continue
+            body = part[i:end]
+            i = end + 1
+            negate = body.startswith("^")
+            if negate:
+                body = body[1:]
+            out.append(f"[{'^/' if negate else ''}{body}]")
+        else:
+            out.append(re.escape(char))
+    return "".join(out)
+
+
+def translate_body(parts: ty.List[str]) -> str:
+    body = ""
+    for i, part in enumerate(parts):
+        if part == "**":
+            body += "(?:[^/]*/)*"
+            continue
+        body += translate_part(part)
+        if i < len(parts) - 1:
+            body += "/"
+    return body
+
+
+def compile_any(regexes: ty.List[str]) -> ty.Optional[ty.Pattern]:
+    if not regexes:
+        return None
+    return re.compile("|".join(f"(?:{x})" for x in regexes))
+
+
+class PatternSet:
+    """
+    Set of patterns compiled for matching with as few regex calls as possible:
+    * literal patterns go to a prefix trie of path components;
+    * one-component globs (like '*.log') are merged into a regex
+      that is matched against each component;
+    * globs starting with a literal component (like '.config/*/Cache')
+      are tried only at components equal to that literal;
+    * the rest is merged into a single regex matched against the whole path.
+    """
+
+    def __init__(self, patterns: ty.Iterable[str], fold=False):
+        self.fold = fold
+        self.anchored: ty.Dict[str, ty.Any] = {}
+        self.floating: ty.Dict[str, ty.Any] = {}
+        single = []
+        prefixed: ty.Dict[str, ty.List[str]] = {}
+        anchored_globs = []
+        floating_globs = []
+        for pattern in patterns:
+            anchored, parts = split_pattern(pattern)
+            if not parts:
+                continue
+            if fold:
+                parts = [x.casefold() for x in parts]
+            if not any(GLOB_CHARS.search(x) for x in parts):
+                node = self.anchored if anchored else self.floating
+                for part in parts:
+                    node = node.setdefault(part, {})
+                node[_END] = True
+            elif anchored:
+                anchored_globs.append("/" + translate_body(parts) + "(?:/|$)")
+            elif len(parts) == 1:
+                single.append(translate_part(parts[0]))
+            elif not GLOB_CHARS.search(parts[0]):
+                rest = translate_body(parts[1:]) + "(?:/|$)"
+                prefixed.setdefault(parts[0], []).append(rest)
+            else:
+                floating_globs.append("(?:^|/)" + translate_body(parts) + "(?:/|$)")
+        self.single = compile_any(single)
+        self.prefixed = {k: compile_any(v) for k, v in prefixed.items()}
+        self.anchored_regex = compile_any(anchored_globs)
+        self.regex = compile_any(floating_globs)
+
+    def __bool__(self):
+        return any(
+            (
+                self.anchored,
+                self.floating,
+                self.single,
+                self.prefixed,
+                self.anchored_regex,
+                self.regex,
+            )
+        )
+
+    @staticmethod
+    def _walk(trie, parts, start) -> bool:
+        node = trie
+        for part in parts[start:]:
+            node = node.get(part)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
+
+    def match(self, path: str, parts: ty.List[str]) -> bool:
+        """ Checks normalized path and its components against all patterns. """
+        if path.startswith("/"):
+            if self.anchored and self._walk(self.anchored, parts, 0):
+                return True
+            if self.anchored_regex and self.anchored_regex.match(path):
+                return True
+        floating, single, prefixed = self.floating, self.single, self.prefixed
+        if floating or single or prefixed:
+            for i, part in enumerate(parts):
+                if part in floating and self._walk(floating, parts, i):
+                    return True
+                if single and single.fullmatch(part):
+                    return True
+                if part in prefixed:
+                    rest = "/".join(parts[i + 1 :])
+                    if prefixed[part].match(rest):
+                        return True
+        return bool(self.regex and self.regex.search(path))
+
+
+def ordered(
+    patterns: ty.Iterable[str], fold=False
+) -> ty.List[ty.Tuple[bool, PatternSet]]:
+    """
+    Compiles patterns as runs of excluding and re-including ('!') ones,
+    in their order: the last matching pattern decides, like in restic.
+    """
+    runs: ty.List[ty.Tuple[bool, ty.List[str]]] = []
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        if not runs or runs[-1][0] != negated:
+            runs.append((negated, []))
+        runs[-1][1].append(pattern)
+    return [(negated, PatternSet(x, fold=fold)) for negated, x in runs]
+
+
+def decide(runs: ty.List[ty.Tuple[bool, PatternSet]], path: str, parts) -> bool:
+    """ Returns True if the last matching run is an excluding one. """
+    for negated, patterns in reversed(runs):
+        if patterns.match(path, parts):
+            return not negated
+    return False
+
+
+class ExclusionMatcher:
+    """ Matches paths against exclude and iexclude patterns of a job. """
+
+    def __init__(self, exclude: ty.Iterable[str] = (), iexclude: ty.Iterable[str] = ()):
+        self.exclude = ordered(exclude)
+        self.iexclude = ordered(iexclude, fold=True)
+
+    def __bool__(self):
+        # re-including patterns alone never exclude anything
+        return any(not negated and x for negated, x in self.exclude + self.iexclude)
+
+    def match(self, path: str) -> bool:
+        """ Returns True if path should be excluded. """
+        path = posixpath.normpath(path)
+        parts = [x for x in path.split("/") if x]
+        if self.exclude and decide(self.exclude, path, parts):
+            return True
+        if self.iexclude:
+            path = path.casefold()
+            parts = [x.casefold() for x in parts]
+            return decide(self.iexclude, path, parts)
+        return False
+
+    def excluded(self, paths: ty.Iterable[str]) -> ty.List[str]:
+        """ Returns paths that should be excluded. """
+        if not self:
+            return []
+        return [x for x in paths if self.match(x)]
+
+    def filter(self, paths: ty.Iterable[str]) -> ty.List[str]:
+        """ Returns paths that should be kept. """
+        if not self:
+            return list(paths)
+        return [x for x in paths if not self.match(x)]
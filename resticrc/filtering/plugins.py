@@ -1,3 +1,4 @@
+from ..sizefilter import parse_size
 from .api import hookimpl, manager
 
 
@@ -73,3 +74,22 @@ class Telegram:
 
 
 manager.register(Telegram())
+
+
+class Larger:
+    @hookimpl
+    def exclude_hook(self, config):
+        # 'larger: 500M' skips files bigger than that,
+        # 'larger: {size: 500M, report: true}' logs them for restic jobs too
+        value = config.get("larger")
+        if isinstance(value, dict):
+            unknown = set(value) - {"size", "report"}
+            if unknown:
+                raise ValueError(f"Unknown 'larger' settings: {', '.join(unknown)}")
+            config.larger_report = bool(value.get("report", False))
+            value = value.get("size")
+        if value:
+            config.larger = parse_size(value)
+
+
+manager.register(Larger())
@@ -0,0 +1,145 @@
+import typing as ty
+from pathlib import Path
+
+from .matcher import ExclusionMatcher
+
+if ty.TYPE_CHECKING:
+    from ..argfiles import ArgFiles
+
+
+def _parse_path(path: str):
+    if not isinstance(path, str):
+        return path
+    if path.startswith("~/"):
+        path = str(Path.home().joinpath(path[2:]).absolute())
+    return path
+
+
+class ExclusionSettings(dict):
+    def __init__(self, items):
+        super().__init__(items)
+        self.pluginmap: ty.Dict[str, ty.Union[ty.Tuple[str], Holder]] = {}
+        # in order: restic applies the last matching pattern ('!' re-includes)
+        self.exclude: ty.List[str] = []
+        self.iexclude: ty.List[str] = []
+        # files larger than this (in bytes) are skipped
+        self.larger: ty.Optional[int] = None
+        # restic skips them by itself, listing them takes another walk
+        self.larger_report = False
+        self._matcher: ty.Optional[ExclusionMatcher] = None
+
+    def map(self, name, *paths):
+        val = self.get(name)
+        if val is None:
+            return
+        # if user send True, then add paths as is
+        # to filtering them in the future
+        # if False, then mark paths as explicit include
+        self.pluginmap[name] = paths if val else Keep(paths)
+
+    def mapdefault(self, k, *defaults):
+        return self.pluginmap.setdefault(k, Default(defaults))
+
+    def add_results(self):
+        exclude, iexclude = list(self.exclude), list(self.iexclude)
+        for item in self.get_result():
+            if isinstance(item, IgnoreCase):
+                iexclude.append(item.value)
+            else:
+                exclude.append(item)
+        # duplicates are dropped, the first one keeps its place
+        self.exclude = list(dict.fromkeys(exclude))
+        self.iexclude = list(dict.fromkeys(iexclude))
+        self._matcher = None
+
+    @property
+    def matcher(self) -> ExclusionMatcher:
+        """ Exclusion patterns, compiled once for all paths of a job. """
+        if self._matcher is None:
+            self._matcher = ExclusionMatcher(self.exclude, self.iexclude)
+        return self._matcher
+
+    def get_result(self) -> ty.Iterator[ty.Union[str, "IgnoreCase"]]:
+        result: ty.List = []
+        keep: ty.List = []
+        # 1. populate paths
+        for key, item in self.pluginmap.items():
+            if isinstance(item, Holder):
+                item.action(key, self, keep, result)
+                continue
+            result.extend(item)
+        val = self.get("paths")
+        if isinstance(val, str):
+            raise ValueError("'paths' is a string instead of list")
+        result.extend(val or [])
+        # 2. filtering what should be kept
+        for item in keep:
+            # we can't do partial exclude right now, only full match
+            if item in result:
+                result.remove(item)
+        return map(_parse_path, result)
+
+    def as_args(self, files: ty.Optional["ArgFiles"] = None):
+        """ Restic arguments, long lists are written into files if given. """
+        if files is not None:
+            exclude = files.patterns("--exclude", "--exclude-file", self.exclude)
+            iexclude = files.patterns(
+                "--iexclude", "--iexclude-file", self.iexclude, name="iexclude"
+            )
+            return exclude + iexclude + self.size_args()
+        out = []
+        for item in self.exclude:
+            out.extend(["--exclude", item])
+        for item in self.iexclude:
+            out.extend(["--iexclude", item])
+        return out + self.size_args()
+
+    def size_args(self) -> ty.List[str]:
+        if self.larger is None:
+            return []
+        return ["--exclude-larger-than", str(self.larger)]
+
+    def render(self):
+        return "\n".join(self.get_result())
+
+    def __str__(self):
+        return self.render()
+
+
+# I decided not to use nested dicts like {"python": {"paths": ..., "type": "keep"}},
+# but to have class-holders, so checks could be made via isinstance(val, Keep) etc
+class Holder:
+    def __init__(self, value):
+        self.value = value
+
+    def action(self, name, config, keep, result):
+        raise NotImplementedError
+
+
+class Keep(Holder):
+    """ Holder that indicates that paths should be kept (excluded from exclusion) """
+
+    def action(self, name, config, keep, result):
+        keep.extend(self.value)
+
+
+class Default(Holder):
+    """
+    Holder for default values. Useful, when your plugin defines multiple ignores
+    and user may want to filtering some of them.
+    """
+
+    def action(self, name, config, keep, result):
+        # set value if item specified in config
+        val = config.get(name)
+        if val in (True, None):
+            result.extend(self.value)
+        else:
+            keep.extend(self.value)
+
+
+class IgnoreCase(Holder):
+    """ Holder that indicates that value should be excluded with --iexclude arg. """
+
+    def action(self, name, config, keep, result):
+        result.append(self)
@@ -0,0 +1,267 @@
+"""
+Expansion of glob patterns in job paths.
+
+Every directory is listed once with os.scandir(), listings are shared by all
+patterns of an expansion (the paths of one job). Patterns are expanded
+in the calling thread and matches are streamed as they are found; only wide
+wildcard levels, with many directories to descend into, are split between
+threads, so small trees do not pay for the thread handoffs.
+Semantics follow glob.glob(recursive=True): '*' and '?' do not match names
+starting with a dot, '**' matches zero or more directories,
+symlinks to directories are not followed by '**', a trailing '/'
+matches only directories (and is kept in the matched paths).
+"""
+import fnmatch
+import functools
+import logging
+import os
+import re
+import stat
+import threading
+import typing as ty
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+MAGIC = re.compile(r"[*?[]")
+MISSING = "missing path"
+DENIED = "permission denied"
+NOTHING = "no matches"
+# directories to descend into at one level before they are split between threads
+WIDE = 64
+
+# entries cache their type, only the checks a pattern needs are made
+Entry = os.DirEntry
+# pattern, directory and index of the pattern part to match in it
+Target = ty.Tuple[int, str, int]
+
+
+def has_magic(part: str) -> bool:
+    return MAGIC.search(part) is not None
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(part: str) -> ty.Pattern:
+    return re.compile(fnmatch.translate(part))
+
+
+def _is_dir(entry: Entry) -> bool:
+    """ Follows symlinks, an entry which cannot be checked is not a directory. """
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def reason(error: OSError) -> str:
+    if isinstance(error, PermissionError):
+        return f"{DENIED}: {error.filename}"
+    return f"{MISSING}: {error.filename}"
+
+
+class Expansion:
+    """
+    Paths matched by the patterns, yielded as they are found (each one once).
+    After the iteration 'unmatched' maps patterns which matched nothing
+    to the reason.
+    """
+
+    def __init__(self, globber: "Globber", patterns: ty.Sequence[str], cwd=None):
+        self.globber = globber
+        # listings live as long as the expansion, so they are never stale
+        self.listings: ty.Dict[str, ty.Union[ty.List[Entry], OSError]] = {}
+        self.patterns = list(patterns)
+        self.parts = [self.split(x) for x in self.patterns]
+        self.dironly = [x.endswith("/") for x in self.patterns]
+        self.cwd = cwd
+        self.matched = [False] * len(self.patterns)
+        self.reasons: ty.Dict[int, str] = {}
+        self.unmatched: ty.Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._pool: ty.Optional[ThreadPoolExecutor] = None
+        self._stopped = False
+
+    @staticmethod
+    def split(pattern: str) -> ty.Tuple[str, ty.List[str]]:
+        root = "/" if pattern.startswith("/") else ""
+        return root, [x for x in pattern.split("/") if x]
+
+    def fullpath(self, path: str) -> str:
+        return os.path.join(self.cwd, path) if self.cwd else path or "."
+
+    def __iter__(self) -> ty.Iterator[str]:
+        seen: ty.Set[str] = set()
+        stack: ty.List[ty.Any] = [
+            (i, root, 0) for i, (root, parts) in enumerate(self.parts) if parts or root
+        ]
+        stack.reverse()
+        try:
+            for found in self._walk(stack, parallel=True):
+                for path in found:
+                    if path not in seen:
+                        seen.add(path)
+                        yield path
+        finally:
+            # nothing new is started if the consumer stopped early
+            self._stopped = True
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        for i, pattern in enumerate(self.patterns):
+            if not self.matched[i]:
+                self.unmatched[pattern] = self.reasons.get(i, NOTHING)
+
+    def _walk(
+        self, stack: ty.List[ty.Any], parallel: bool
+    ) -> ty.Iterator[ty.List[str]]:
+        """
+        Expands targets on the stack depth first, yields paths found in each directory.
+        Wide levels are pushed as futures of chunks expanded by other threads.
+        """
+        threads = self.globber.threads
+        while stack and not self._stopped:
+            item = stack.pop()
+            if isinstance(item, Future):
+                yield item.result()
+                continue
+            found, targets = self._step(*item)
+            if found:
+                yield found
+            if parallel and threads > 1 and len(targets) >= WIDE:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(threads, thread_name_prefix="glob")
+                # contiguous chunks keep the order of a serial expansion
+                size = -(-len(targets) // threads)
+                chunks = [targets[i : i + size] for i in range(0, len(targets), size)]
+                stack.extend(
+                    self._pool.submit(self._chunk, x) for x in reversed(chunks)
+                )
+            else:
+                stack.extend(reversed(targets))
+
+    def _chunk(self, targets: ty.List[Target]) -> ty.List[str]:
+        found: ty.List[str] = []
+        for paths in self._walk(targets[::-1], parallel=False):
+            found.extend(paths)
+        return found
+
+    def _fail(self, pattern: int, error: OSError):
+        # permission denied is more useful than a missing branch of a wildcard
+        with self._lock:
+            current = self.reasons.get(pattern)
+            if current is None or not current.startswith(DENIED):
+                self.reasons[pattern] = reason(error)
+
+    def _step(
+        self, pattern: int, base: str, index: int
+    ) -> ty.Tuple[ty.List[str], ty.List[Target]]:
+        """
+        Matches a part of the pattern in base, returns found paths
+        and directories where the rest of the pattern is matched.
+        """
+        parts = self.parts[pattern][1]
+        dironly = self.dironly[pattern]
+        found: ty.List[str] = []
+        targets: ty.List[Target] = []
+        # literal parts are joined without listing
+        while index < len(parts) and not has_magic(parts[index]):
+            base = os.path.join(base, parts[index])
+            index += 1
+        if index == len(parts):
+            path = self.fullpath(base)
+            try:
+                # a trailing '/' follows symlinks, like the shell does
+                mode = (os.stat(path) if dironly else os.lstat(path)).st_mode
+            except OSError as e:
+                self._fail(pattern, e)
+                return found, targets
+            if not dironly or stat.S_ISDIR(mode):
+                found.append(base)
+            return self._found(pattern, found), targets
+        try:
+            entries = self.globber.listdir(self.fullpath(base), self.listings)
+        except OSError as e:
+            self._fail(pattern, e)
+            return found, targets
+        part = parts[index]
+        last = index == len(parts) - 1
+        # os.path.join() is too slow for every entry
+        prefix = base if not base or base.endswith("/") else base + "/"
+        if part == "**":
+            if last:
+                if base:
+                    found.append(base)
+            else:
+                targets.append((pattern, base, index + 1))
+            for entry in entries:
+                name = entry.name
+                if name.startswith("."):
+                    continue
+                is_dir = _is_dir(entry)
+                if is_dir and not entry.is_symlink():
+                    targets.append((pattern, prefix + name, index))
+                elif last and (is_dir or not dironly):
+                    found.append(prefix + name)
+        else:
+            regex = _compile(part)
+            hidden = part.startswith(".")
+            for entry in entries:
+                name = entry.name
+                if name.startswith(".") and not hidden:
+                    continue
+                if not regex.match(name):
+                    continue
+                if last:
+                    if not dironly or _is_dir(entry):
+                        found.append(prefix + name)
+                elif _is_dir(entry):
+                    targets.append((pattern, prefix + name, index + 1))
+        return self._found(pattern, found), targets
+
+    def _found(self, pattern: int, paths: ty.List[str]) -> ty.List[str]:
+        if not paths:
+            return paths
+        self.matched[pattern] = True
+        if self.dironly[pattern]:
+            return [x if x.endswith("/") else x + "/" for x in paths]
+        return paths
+
+
+class Globber:
+    """ Expands patterns, see the module docstring. """
+
+    def __init__(self, threads: int = 8):
+        self.threads = threads
+        # number of os.scandir() calls, for tests and debugging
+        self.listed = 0
+        self._lock = threading.Lock()
+
+    def expand(self, patterns: ty.Iterable[str], cwd=None) -> Expansion:
+        return Expansion(self, list(patterns), cwd=cwd)
+
+    def listdir(
+        self,
+        directory: str,
+        listings: ty.Dict[str, ty.Union[ty.List[Entry], OSError]],
+    ) -> ty.List[Entry]:
+        """ Lists directory once, a failed listing is raised again. """
+        listing = listings.get(directory)
+        if listing is None:
+            with self._lock:
+                self.listed += 1
+            try:
+                listing = self._scandir(directory)
+            except OSError as e:
+                listing = e
+            listings[directory] = listing
+        if isinstance(listing, OSError):
+            raise listing
+        return listing
+
+    @staticmethod
+    def _scandir(directory: str) -> ty.List[Entry]:
+        with os.scandir(directory) as it:
+            return list(it)
+
+
+globber = Globber()
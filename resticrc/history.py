@@ -0,0 +1,190 @@
+import logging
+import sqlite3
+import statistics
+import time
+import typing as ty
+from pathlib import Path
+
+from attr import attrs, attrib
+
+from .state import state_dir
+
+log = logging.getLogger(__name__)
+
+# fields of the 'summary' message of 'restic backup --json'
+SUMMARY_FIELDS = (
+    "files_new",
+    "files_changed",
+    "files_unmodified",
+    "dirs_new",
+    "dirs_changed",
+    "dirs_unmodified",
+    "data_added",
+    "total_files_processed",
+    "total_bytes_processed",
+    "total_duration",
+)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    snapshot_id TEXT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    status INTEGER NOT NULL,
+    {", ".join(f"{x} NUMERIC" for x in SUMMARY_FIELDS)}
+);
+CREATE INDEX IF NOT EXISTS runs_job ON runs (job, started);
+CREATE UNIQUE INDEX IF NOT EXISTS runs_snapshot ON runs (job, repo, snapshot_id);
+CREATE TABLE IF NOT EXISTS prunes (
+    id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    status INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prunes_repo ON prunes (repo, started);
+"""
+
+
+@attrs
+class JobStats:
+    """ Aggregated statistics of the job runs. """
+
+    job: str = attrib()
+    runs: int = attrib()
+    failures: int = attrib()
+    last_started: float = attrib()
+    last_duration: float = attrib()
+    median_duration: float = attrib()
+    median_added: float = attrib()
+
+    @property
+    def slowdown(self) -> float:
+        """ How much slower the last run was, compared to the usual one. """
+        if not self.median_duration:
+            return 1.0
+        return self.last_duration / self.median_duration
+
+
+class History:
+    """ Local history of backups, stored in SQLite database. """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else state_dir() / "history.sqlite"
+
+    def connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(SCHEMA)
+        return conn
+
+    def record(
+        self,
+        job: str,
+        repo: str,
+        started: float,
+        duration: float,
+        status: int = 0,
+        summary: ty.Optional[dict] = None,
+    ):
+        summary = summary or {}
+        values = dict(
+            job=job,
+            repo=repo,
+            snapshot_id=summary.get("snapshot_id"),
+            started=started,
+            duration=duration,
+            status=status,
+            **{x: summary.get(x) for x in SUMMARY_FIELDS},
+        )
+        keys = ", ".join(values)
+        placeholders = ", ".join(f":{x}" for x in values)
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO runs ({keys}) VALUES ({placeholders})",
+                    values,
+                )
+        finally:
+            conn.close()
+
+    def record_prune(self, repo: str, started: float, duration: float, status=0):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO prunes (repo, started, duration, status) "
+                    "VALUES (?, ?, ?, ?)",
+                    (repo, started, duration, status),
+                )
+        finally:
+            conn.close()
+
+    def last_prune(self, repo: str) -> ty.Optional[float]:
+        """ Returns start time of the last successful prune of the repository. """
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT max(started) FROM prunes WHERE repo = ? AND status = 0", (repo,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return row[0]
+
+    def runs(self, job=None, since: ty.Optional[float] = None) -> ty.List[sqlite3.Row]:
+        """ Returns runs ordered by start time. """
+        query = "SELECT * FROM runs WHERE started >= ?"
+        params: ty.List[ty.Any] = [since or 0]
+        if job:
+            query += " AND job = ?"
+            params.append(job)
+        conn = self.connect()
+        try:
+            return conn.execute(query + " ORDER BY started", params).fetchall()
+        finally:
+            conn.close()
+
+    def stats(self, job=None, days: ty.Optional[float] = None) -> ty.List[JobStats]:
+        since = time.time() - days * 86400 if days else None
+        by_job: ty.Dict[str, ty.List[sqlite3.Row]] = {}
+        for row in self.runs(job, since):
+            by_job.setdefault(row["job"], []).append(row)
+        out = []
+        for name, rows in by_job.items():
+            ok = [x for x in rows if not x["status"]] or rows
+            out.append(
+                JobStats(
+                    job=name,
+                    runs=len(rows),
+                    failures=len(rows) - len([x for x in rows if not x["status"]]),
+                    last_started=rows[-1]["started"],
+                    last_duration=ok[-1]["duration"],
+                    median_duration=statistics.median(x["duration"] for x in ok),
+                    median_added=statistics.median(x["data_added"] or 0 for x in ok),
+                )
+            )
+        return out
+
+    def regressions(
+        self, factor: float = 2.0, min_runs: int = 3, days=None
+    ) -> ty.List[ty.Tuple[JobStats, float]]:
+        """
+        Returns jobs which last successful run took 'factor' times longer
+        than the median of the previous runs, with that median.
+        """
+        since = time.time() - days * 86400 if days else None
+        out = []
+        for stats in self.stats(days=days):
+            ok = [x for x in self.runs(stats.job, since) if not x["status"]]
+            previous = [x["duration"] for x in ok[:-1]]
+            if len(previous) < min_runs:
+                continue
+            median = statistics.median(previous)
+            if median and ok[-1]["duration"] >= median * factor:
+                out.append((stats, median))
+        return out
@@ -0,0 +1,362 @@
+"""
+Metrics of job runs in OpenMetrics text format.
+
+Code running a job adds what it measured (phases, restic summaries) to the
+run of the current context, see measure(). Finished runs are merged into
+a state shared by all resticrc processes (histograms keep counting between
+cron runs), and the state is written as a textfile for node_exporter,
+atomically, so a partial file is never scraped. The daemon serves
+the same text over HTTP too.
+
+Nothing is collected unless metrics are enabled by the 'metrics' setting.
+"""
+import contextlib
+import contextvars
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+import typing as ty
+from pathlib import Path
+
+from attr import attrs, attrib
+
+from .state import state_dir
+from .tracing import span
+
+log = logging.getLogger(__name__)
+
+# parts of the job run, in order
+PHASES = ("list", "snapshot", "producer", "restic", "cleanup")
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 21600, math.inf)
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+@attrs
+class Run:
+    """ Measurements of one job run. """
+
+    job: str = attrib()
+    started: float = attrib(factory=time.time)
+    duration: float = attrib(default=0.0)
+    # 0 for success, exit code of the failed command or 1 for other errors
+    status: int = attrib(default=0)
+    phases: ty.Dict[str, float] = attrib(factory=dict)
+    # summaries of restic backups by (part of the job, repository)
+    summaries: ty.Dict[ty.Tuple[str, str], dict] = attrib(factory=dict)
+
+    def __attrs_post_init__(self):
+        # parts of the job, e.g. datasets, are measured concurrently
+        self._lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_summary(self, part: str, repo: str, summary: dict):
+        with self._lock:
+            self.summaries[(part, repo)] = summary
+
+    def totals(self) -> ty.Dict[str, int]:
+        """
+        Returns bytes and files of the run: the source of every part is read
+        once for all repositories, while data is added to each one of them.
+        """
+        read: ty.Dict[str, ty.Tuple[int, int]] = {}
+        added = 0
+        for (part, _), summary in self.summaries.items():
+            processed = int(summary.get("total_bytes_processed") or 0)
+            files = int(summary.get("total_files_processed") or 0)
+            read[part] = max(read.get(part, (0, 0)), (processed, files))
+            added += int(summary.get("data_added") or 0)
+        return {
+            "processed_bytes": sum(x for x, _ in read.values()),
+            "added_bytes": added,
+            "scanned_files": sum(x for _, x in read.values()),
+        }
+
+
+# run of the job currently executed in this thread or task
+current_run: "contextvars.ContextVar[ty.Optional[Run]]" = contextvars.ContextVar(
+    "current_run", default=None
+)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """
+    Adds time spent within the block to the phase of the current run,
+    the phase is a span of the trace too.
+    """
+    run = current_run.get()
+    with span(name):
+        if run is None:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            run.add_phase(name, time.monotonic() - start)
+
+
+def add_phase(name: str, seconds: float):
+    run = current_run.get()
+    if run is not None:
+        run.add_phase(name, seconds)
+
+
+def add_summary(part: str, repo: str, summary: ty.Optional[dict]):
+    run = current_run.get()
+    if run is not None and summary:
+        run.add_summary(part, repo, summary)
+
+
+class Histogram:
+    """ Cumulative histogram saved as a dict: counts of buckets, sum and count. """
+
+    @staticmethod
+    def new() -> dict:
+        return {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+
+    @staticmethod
+    def observe(data: dict, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                data["buckets"][i] += 1
+        data["sum"] += value
+        data["count"] += 1
+
+
+class Registry:
+    """
+    Runs of this process and the state of all jobs, saved between runs.
+    The state file is locked while it is updated, jobs could be run
+    by several processes at once.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else state_dir() / "metrics.json"
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.pending: ty.List[Run] = []
+        self.state: ty.Dict[str, dict] = {}
+
+    @contextlib.contextmanager
+    def measure(self, job: str):
+        """ Measures the job run within the block, if metrics are enabled. """
+        if not self.enabled:
+            yield None
+            return
+        run = Run(job)
+        token = current_run.set(run)
+        start = time.monotonic()
+        try:
+            yield run
+        except BaseException as e:
+            run.status = getattr(e, "returncode", None) or 1
+            raise
+        finally:
+            current_run.reset(token)
+            run.duration = time.monotonic() - start
+            with self._lock:
+                self.pending.append(run)
+
+    def merge(self, state: ty.Dict[str, dict], run: Run):
+        job = state.setdefault(run.job, {"histograms": {}})
+        job.update(run.totals())
+        job["exit_status"] = run.status
+        job["last_run_timestamp_seconds"] = run.started
+        if not run.status:
+            job["last_success_timestamp_seconds"] = run.started
+        histograms = job["histograms"]
+        Histogram.observe(histograms.setdefault("", Histogram.new()), run.duration)
+        for name, seconds in run.phases.items():
+            Histogram.observe(histograms.setdefault(name, Histogram.new()), seconds)
+
+    def flush(self, textfile=None, jobs: ty.Optional[ty.Container[str]] = None):
+        """
+        Saves pending runs into the state, writes the textfile if it is set.
+        Jobs missing in 'jobs' (removed from the config) are forgotten.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, []
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load()
+            size = len(state)
+            if jobs is not None:
+                state = {k: v for k, v in state.items() if k in jobs}
+            for run in pending:
+                self.merge(state, run)
+            if pending or len(state) != size:
+                atomic_write(self.path, json.dumps(state))
+            self.state = state
+            # under the lock, so an older state never replaces a newer one
+            if textfile:
+                atomic_write(Path(textfile), render(state))
+
+    def load(self) -> ty.Dict[str, dict]:
+        try:
+            with open(self.path) as fd:
+                return json.load(fd)
+        except (OSError, ValueError) as e:
+            log.debug("Failed to read metrics from %s: %s", self.path, e)
+            return {}
+
+    def render(self) -> str:
+        return render(self.state)
+
+
+def atomic_write(path: Path, text: str):
+    """ Writes a temporary file next to the path and renames it. """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # node_exporter reads only *.prom files
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "w") as out:
+            out.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**values: str) -> str:
+    return ",".join(f'{k}="{escape(str(v))}"' for k, v in values.items())
+
+
+def number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# gauges of the last run: key of the job state (name without 'resticrc_job_')
+GAUGES = {
+    "processed_bytes": "Bytes read by the last run",
+    "added_bytes": "Bytes added to repositories by the last run",
+    "scanned_files": "Files read by the last run",
+    "exit_status": "Exit code of the last run, 0 for success",
+    "last_run_timestamp_seconds": "Start of the last run",
+    "last_success_timestamp_seconds": "Start of the last successful run",
+}
+UNITS = ("bytes", "seconds")
+
+
+def render(state: ty.Dict[str, dict]) -> str:
+    """ Returns metrics of the jobs in OpenMetrics text format. """
+    lines: ty.List[str] = []
+
+    def family(name, kind, description):
+        lines.append(f"# TYPE {name} {kind}")
+        unit = name.rsplit("_", 1)[-1]
+        if unit in UNITS:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {description}.")
+
+    def histogram(name, data, **values):
+        for bound, count in zip(BUCKETS, data["buckets"]):
+            lines.append(
+                f"{name}_bucket{{{labels(**values, le=number(float(bound)))}}} {count}"
+            )
+        lines.append(f"{name}_count{{{labels(**values)}}} {data['count']}")
+        lines.append(f"{name}_sum{{{labels(**values)}}} {number(data['sum'])}")
+
+    jobs = sorted(state.items())
+    for key, description in GAUGES.items():
+        name = f"resticrc_job_{key}"
+        family(name, "gauge", description)
+        for job, values in jobs:
+            if values.get(key) is not None:
+                lines.append(f"{name}{{{labels(job=job)}}} {number(values[key])}")
+
+    name = "resticrc_job_duration_seconds"
+    family(name, "histogram", "Duration of job runs")
+    for job, values in jobs:
+        if "" in values["histograms"]:
+            histogram(name, values["histograms"][""], job=job)
+
+    name = "resticrc_job_phase_duration_seconds"
+    family(name, "histogram", "Duration of parts of job runs")
+    for job, values in jobs:
+        for phase_name in PHASES:
+            if phase_name in values["histograms"]:
+                histogram(
+                    name, values["histograms"][phase_name], job=job, phase=phase_name
+                )
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def settings(conf: dict) -> ty.Optional[dict]:
+    """ Returns 'metrics' settings: 'textfile' and 'listen' (daemon only). """
+    value = conf.get("metrics")
+    if not value:
+        return None
+    if isinstance(value, str):
+        return {"textfile": value}
+    return dict(value)
+
+
+@contextlib.contextmanager
+def exporting(conf: dict, jobs: ty.Optional[ty.Container[str]] = None):
+    """ Collects metrics of runs within the block if they are enabled, saves them. """
+    options = settings(conf)
+    if options is None:
+        yield
+        return
+    registry.enabled = True
+    try:
+        yield
+    finally:
+        export(options, jobs)
+
+
+def export(options: dict, jobs: ty.Optional[ty.Container[str]] = None):
+    try:
+        registry.flush(options.get("textfile"), jobs)
+    except OSError as e:
+        log.warning("Failed to save metrics: %s", e)
+
+
+def serve(address: str):
+    """ Serves metrics of the registry over HTTP at 'host:port' in a thread. """
+    # pylint: disable=import-outside-toplevel
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            log.debug("Metrics request: " + format, *args)
+
+    host, _, port = address.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    log.info("Serving metrics at http://%s:%s/metrics", *server.server_address[:2])
+    return server
@@ -1,11 +1,18 @@
 import logging
-from typing import List, Optional
+from typing import Iterable, List, Optional, TYPE_CHECKING
 
 from attr import attrs, attrib
 
-from .filtering.api import process_filters, ExclusionSettings
+from .cron import Cron
+from .metrics import registry
+from .resources import Resources
 from .runner import Runner
 from .executor import executor
+from .tracing import span
+
+if TYPE_CHECKING:
+    from .filtering.settings import ExclusionSettings
+    from .remote import Remote
 
 log = logging.getLogger(__name__)
 
@@ -15,19 +22,39 @@ class Repository:
     name: str = attrib()
     path: str = attrib()
     password_file: str = attrib(default=None)
+    # how many jobs may write to this repository at the same time
+    concurrency: int = attrib(default=1)
+    # cleanup policy, overrides global 'keep-daily' and 'prune-after'
+    keep_daily: Optional[int] = attrib(default=None)
+    prune_after: Optional[str] = attrib(default=None)
+    # restic cache of this repository, see resticrc.cache
+    cache_dir: Optional[str] = attrib(default=None)
 
-    def get_args(self):
+    def get_args(self, cache=True):
+        """ Returns arguments of the repository, without the cache for remote restic. """
         args = ["--repo", self.path]
         if self.password_file:
             args.extend(["--password-file", self.password_file])
+        if cache and self.cache_dir:
+            args.extend(["--cache-dir", self.cache_dir])
         return args
 
     def cleanup(self, keep_daily=None, prune=None):
-        args = ["restic"] + self.get_args()
         if keep_daily:
-            executor.run(args + ["forget", "--group-by", "host,tags", "--keep-daily", str(keep_daily)])
+            executor.run(self.forget_args(keep_daily))
         if prune:
-            executor.run(args + ["prune"])
+            executor.run(self.prune_args())
+
+    def forget_args(self, keep_daily, tags: Iterable[str] = ()) -> List[str]:
+        """ Arguments of forget for snapshots with any of the tags (or all). """
+        args = ["restic"] + self.get_args()
+        args += ["forget", "--group-by", "host,tags", "--keep-daily", str(keep_daily)]
+        for tag in tags:
+            args.extend(["--tag", tag])
+        return args
+
+    def prune_args(self) -> List[str]:
+        return ["restic"] + self.get_args() + ["prune"]
 
 
 @attrs
@@ -37,19 +64,49 @@ class Job:
     runner: Runner = attrib()
     _exclude: dict = attrib(factory=dict)
     conf: dict = attrib(factory=dict)
+    # names of jobs that should be finished before this one
+    after: List[str] = attrib(factory=list)
+    name: Optional[str] = attrib(default=None, eq=False)
+    # all repositories the job writes to, the first one is 'repo'
+    repos: List[Repository] = attrib(factory=list)
+    resources: Optional[Resources] = attrib(default=None)
+    # host the job source is read on
+    remote: Optional["Remote"] = attrib(default=None)
+    # when the daemon runs the job
+    schedule: Optional[Cron] = attrib(default=None)
 
     def __attrs_post_init__(self):
         self._exclude_processed = None
+        if self.name is None and self.tags:
+            self.name = self.tags[0]
+        if not self.repos:
+            self.repos = [self.repo]
 
     @property
-    def exclude(self) -> ExclusionSettings:
+    def exclude(self) -> "ExclusionSettings":
         if self._exclude_processed:
             return self._exclude_processed
+        # pluggy and plugins are needed only for jobs missing in compiled config
+        from .filtering.api import process_filters
+
         log.debug("Exclude before processing filters: %s", self._exclude)
-        val = process_filters(self._exclude)
+        with span("process_filters", job=self.name):
+            val = process_filters(self._exclude)
         log.debug("Exclude after processing filters: %s", val)
         self._exclude_processed = val
         return val
 
+    def command(self, command: List[str], cwd=None) -> List[str]:
+        """ Returns command which executes on the job host. """
+        if self.remote is None:
+            return command
+        return self.remote.connect().wrap(command, cwd)
+
     def run(self):
-        self.runner(self)
+        with span(f"job {self.name}"), registry.measure(self.name):
+            with executor.limit(self.resources, self.name):
+                shell = self.conf.get("shell")
+                if shell:
+                    # prepares the source, e.g. dumps the list of packages
+                    executor.run(self.command(["sh", "-c", shell]))
+                self.runner(self)
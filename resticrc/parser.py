@@ -1,27 +1,30 @@
+import copy
+import os
 import logging
 import typing as ty
 from pathlib import Path
 
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-import yaml
-
+from .cron import Cron
 from .models import Repository, Job
+from .resources import Resources
 from .runner import Runner
+from .tracing import span
 
 log = logging.getLogger(__name__)
 
+# 'skip' and 'ignore' are aliases of 'exclude'
+EXCLUDE_KEYS = ("exclude", "skip", "ignore")
+
 
 class Parser:
     """ Configuration parser. """
 
     def __init__(self, conf, read=True):
+        self.path: ty.Optional[Path] = None
         self.conf = self.try_load(conf)
         self.global_settings: ty.Dict[str, ty.Any] = {}
         self.repos: ty.Optional[ty.Dict[str, Repository]] = None
-        self.jobs: ty.Optional[ty.Dict[str, Job]] = None
+        self.jobs: ty.Optional[ty.Mapping[str, Job]] = None
         if read:
             self.read()
 
@@ -32,15 +35,21 @@ class Parser:
         pth = Path(conf)
         if not pth.exists():
             raise ValueError(f"Path {pth} does not exist.")
+        self.path = pth
         with open(pth) as fd:
-            return yaml.load(fd, Loader=Loader)
+            return load_yaml(fd)
 
     def read(self):
         """ Reads configuration settings (global, repos, etc). """
-        self.global_settings = self.conf.get("global", {})
+        self.global_settings = dict(self.conf.get("global", {}))
+        if int(self.conf.get("workers", 1)) < 1:
+            raise ValueError("'workers' should be at least 1.")
+        exclude = pop_exclude(self.global_settings)
+        if exclude:
+            self.global_settings["exclude"] = exclude
         # dictionary for access to repos from parse_jobs()
         self.repos = self.parse_repos()
-        self.jobs = self.parse_jobs()
+        self.jobs = JobMap(self)
 
     def parse_repos(self):
         value = self.conf.get("repos")
@@ -48,12 +57,27 @@ class Parser:
             raise ValueError(
                 "Please define at lease one repository in mapping 'repos'."
             )
+        caches = self.cache_manager()
         out = {}
         for name, repo in value.items():
             if isinstance(repo, str):
                 repo = {"path": repo}
             passwd = repo.get("password-file")
-            out[name] = Repository(name=name, path=repo["path"], password_file=passwd)
+            cache = repo.get("cache-dir")
+            if cache is None and caches is not None:
+                cache = caches.repo_dir(name, repo["path"])
+            concurrency = int(repo.get("concurrency", 1))
+            if concurrency < 1:
+                raise ValueError(f"[repo {name!r}] 'concurrency' should be at least 1.")
+            out[name] = Repository(
+                name=name,
+                path=repo["path"],
+                password_file=passwd,
+                concurrency=concurrency,
+                keep_daily=repo.get("keep-daily"),
+                prune_after=repo.get("prune-after"),
+                cache_dir=os.path.expanduser(cache) if cache else None,
+            )
         return out
 
     def parse_jobs(self) -> dict:
@@ -63,26 +87,46 @@ class Parser:
         }
 
     def parse_job(self, name, conf):
+        from . import remote  # pylint: disable=import-outside-toplevel
+
         log.debug("Processing job %s", name)
         conf = self.parse_paths(conf)
+        exclude = pop_exclude(conf)
+        log.debug("Raw exclude: %s", exclude)
+        conf["exclude"] = self.parse_exclude(exclude)
         for k, v in self.global_settings.items():
             if k == "exclude":
-                log.debug("Raw exclude: %s", v)
-                conf[k] = self.parse_exclude(conf.get("exclude", {}))
+                continue
+            if k == "resources":
+                # job settings override only the keys they have
+                conf[k] = {**v, **conf.get(k, {})}
             else:
                 conf.setdefault(k, v)
-        repo_name = conf["repo"]
-        repo = self.repos[repo_name]
+        # the source is read once for all repositories
+        repos = [self.repos[x] for x in getlist(conf["repo"])]
+        if not repos:
+            raise ValueError(f"[job {name!r}] No repositories provided.")
         try:
             runner = Runner.from_dict(conf)
+            resources = Resources.from_dict(conf.pop("resources", None))
+            job_remote = remote.from_dict(conf)
+            schedule = conf.pop("schedule", None)
+            if schedule is not None:
+                schedule = Cron.parse(schedule)
         except Exception as e:
             raise ValueError(f"[job {name!r}] {e}")
         return Job(
-            repo=repo,
+            name=name,
+            repo=repos[0],
+            repos=repos,
+            resources=resources,
+            remote=job_remote,
+            schedule=schedule,
             tags=[conf.get("tag", name)],
             runner=runner,
+            after=getlist(conf.pop("after", [])),
             conf=conf,
-            exclude=conf.pop("exclude", None),
+            exclude=conf.pop("exclude", None) or {},
         )
 
     def parse_paths(self, conf) -> dict:
@@ -98,10 +142,7 @@ class Parser:
         return conf
 
     def parse_exclude(self, exclude):
-        if isinstance(exclude, str):
-            exclude = {"paths": [exclude]}
-        elif isinstance(exclude, list):
-            exclude = {"paths": exclude}
+        exclude = normalize_exclude(exclude)
         self.merge_exclusions(exclude)
         log.debug("Exclude after merge: %s", exclude)
         return exclude
@@ -113,13 +154,125 @@ class Parser:
                 val = jobexclude.get(key, []) + val
             jobexclude.setdefault(key, val)
 
-    def cleanup_all(self):
-        """ Performs cleanup for all repositories """
-        for repo in self.repos.values():
-            repo.cleanup(
-                keep_daily=self.conf.get("keep-daily"),
-                prune=self.conf.get("prune-after"),
-            )
+    def cleanup_planner(self):
+        from .cleanup import CleanupPlanner  # pylint: disable=import-outside-toplevel
+
+        return CleanupPlanner(
+            keep_daily=self.conf.get("keep-daily"),
+            prune_after=self.conf.get("prune-after"),
+            resources=Resources.from_dict(self.global_settings.get("resources")),
+        )
+
+    def cache_manager(self):
+        """ Returns manager of restic caches if the 'cache' setting is set. """
+        if not self.conf.get("cache"):
+            return None
+        from .cache import CacheManager  # pylint: disable=import-outside-toplevel
+
+        return CacheManager.from_conf(self.conf)
+
+    def warm_up(self, repos: ty.Iterable[Repository]) -> ty.Dict[str, Exception]:
+        """ Fills restic caches of the repositories, returns errors of failed ones. """
+        manager = self.cache_manager()
+        if manager is None:
+            return {}
+        resources = Resources.from_dict(self.global_settings.get("resources"))
+        return manager.warm_up(repos, resources)
+
+    def cleanup_all(self) -> ty.Dict[str, Exception]:
+        """ Performs cleanup for all jobs, returns errors of failed repositories. """
+        planner = self.cleanup_planner()
+        for job in self.jobs.values():
+            planner.add(job)
+        return planner.run()
+
+
+def normalize_exclude(exclude) -> dict:
+    """
+    Converts exclusions to a dictionary: a string is a path, a list could mix
+    paths and dictionaries of settings, e.g. [{larger: 500M, caches: yes}, Media].
+    """
+    if isinstance(exclude, str):
+        return {"paths": [exclude]}
+    if isinstance(exclude, list):
+        out: ty.Dict[str, ty.Any] = {}
+        paths = []
+        for item in exclude:
+            if isinstance(item, dict):
+                out.update(normalize_exclude(item))
+            else:
+                paths.append(item)
+        if paths:
+            out["paths"] = out.get("paths", []) + paths
+        return out
+    return dict(exclude or {})
+
+
+def pop_exclude(conf: dict) -> dict:
+    """ Pops exclusions of a job or global settings, merging all aliases. """
+    out: ty.Dict[str, ty.Any] = {}
+    for key in EXCLUDE_KEYS:
+        if key not in conf:
+            continue
+        for name, value in normalize_exclude(conf.pop(key)).items():
+            if isinstance(value, list):
+                out[name] = out.get(name, []) + value
+            else:
+                out.setdefault(name, value)
+    return out
+
+
+class JobMap(ty.Mapping[str, Job]):
+    """
+    Jobs of the configuration, each one is parsed on first access,
+    so running a single job does not pay for the others.
+    """
+
+    def __init__(self, parser: Parser, jobs: ty.Optional[ty.Dict[str, Job]] = None):
+        self.parser = parser
+        self.jobs: ty.Dict[str, Job] = dict(jobs or {})
+        # whether jobs were parsed since creation, i.e. compiled config is stale
+        self.dirty = False
+
+    @property
+    def raw(self) -> dict:
+        return self.parser.conf.get("jobs") or {}
+
+    def __getitem__(self, name: str) -> Job:
+        job = self.jobs.get(name)
+        if job is None:
+            if name not in self.raw:
+                raise KeyError(name)
+            # parsing mutates job settings, raw config is kept intact
+            with span("parse job", job=name):
+                conf = copy.deepcopy(self.raw[name])
+                job = self.jobs[name] = self.parser.parse_job(name, conf)
+            self.dirty = True
+        return job
+
+    def __iter__(self) -> ty.Iterator[str]:
+        return iter(self.raw)
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def __contains__(self, name) -> bool:
+        return name in self.raw
+
+    def parsed(self) -> ty.Dict[str, Job]:
+        """ Returns jobs parsed so far. """
+        return dict(self.jobs)
+
+
+def load_yaml(stream) -> dict:
+    # pylint: disable=import-outside-toplevel
+    import yaml
+
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader  # type: ignore
+    return yaml.load(stream, Loader=Loader)
 
 
 def getlist(value) -> list:
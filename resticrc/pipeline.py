@@ -0,0 +1,260 @@
+"""
+Pipelines of commands running under asyncio, see ConsoleExecutor.
+
+Imported at the first executed command: asyncio and its subprocess support
+are not needed by dry runs and commands that only read the config.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import typing as ty
+from subprocess import TimeoutExpired
+
+from . import tracing
+from .executor import LINE_LIMIT, Result, job_output
+from .pump import Tee, coalesce, pump, read_chunks
+
+if ty.TYPE_CHECKING:
+    from .executor import ConsoleExecutor
+
+log = logging.getLogger(__name__)
+
+
+class Pipeline:
+    def __init__(
+        self, executor, commands, cwd, stdin, stdout, pump_settings, on_output
+    ):
+        self.executor: "ConsoleExecutor" = executor
+        self.commands = [list(x) for x in commands]
+        self.cwd = cwd
+        self.stdin = stdin
+        self.stdout = stdout
+        self.pump_settings = pump_settings
+        self.on_output = on_output
+        self.output = job_output.get()
+        self.procs: ty.List[asyncio.subprocess.Process] = []
+        self.started: ty.List[float] = []
+        self.tasks: ty.List[asyncio.Future] = []
+        self.result = Result(commands=self.commands)
+
+    async def run(self, timeout, check=True) -> Result:
+        try:
+            await self.start()
+            await asyncio.wait_for(self.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.terminate()
+            raise TimeoutExpired(self.commands[-1], timeout) from None
+        except BaseException:
+            await self.terminate()
+            raise
+        if check:
+            self.check()
+        return self.result
+
+    async def spawn(self, command, stdin, stdout, on_output=None):
+        """ Starts command, reading its output if it is captured. """
+        log.debug("Starting %s", command)
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=asyncio.subprocess.PIPE if self.output else None,
+            cwd=self.cwd,
+            limit=LINE_LIMIT,
+        )
+        self.executor.register(proc.pid)
+        self.procs.append(proc)
+        self.started.append(time.monotonic())
+        if self.output:
+            self.tasks.append(self.read(proc.stderr, "stderr"))
+        if proc.stdout is not None:
+            self.tasks.append(self.read(proc.stdout, "stdout", on_output))
+        return proc
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        capture = asyncio.subprocess.PIPE if self.output else None
+        to_close: ty.List[int] = []
+        try:
+            stdin: ty.Optional[int] = None
+            if self.stdin is not None:
+                stdin, writer = os.pipe()
+                to_close.append(stdin)
+                self.tasks.append(loop.run_in_executor(None, self.feed, writer))
+            last = len(self.commands) - 1
+            for i, command in enumerate(self.commands):
+                if i < last:
+                    reader, stdout = os.pipe()
+                    to_close.append(stdout)
+                elif self.on_output:
+                    stdout = asyncio.subprocess.PIPE
+                else:
+                    stdout = self.stdout if self.stdout is not None else capture
+                await self.spawn(command, stdin, stdout, self.on_output)
+                if i < last:
+                    stdin = self.link(reader)
+                    to_close.append(stdin)
+        finally:
+            for fd in to_close:
+                os.close(fd)
+
+    def link(self, reader: int) -> int:
+        """ Returns input for the next command, connected to reader. """
+        if self.pump_settings is None:
+            return reader
+        src = reader
+        stdin, dst = os.pipe()
+        loop = asyncio.get_running_loop()
+        self.tasks.append(loop.run_in_executor(None, self.pump, src, dst))
+        return stdin
+
+    def pump(self, src: int, dst: int):
+        try:
+            stats = pump(src, dst, self.pump_settings)
+            self.result.stats.append(stats)
+            log.info("Stream: %s", stats)
+        except BrokenPipeError:
+            log.warning("Consumer closed its input before the end of stream")
+        finally:
+            os.close(src)
+            os.close(dst)
+
+    def feed(self, fd: int):
+        try:
+            with open(fd, "wb", closefd=True) as out:
+                for chunk in self.stdin:
+                    out.write(chunk)
+                    self.result.fed += 1
+        except BrokenPipeError:
+            log.warning("Command closed its input after %s chunks", self.result.fed)
+
+    def read(self, stream: asyncio.StreamReader, name: str, on_output=None):
+        return asyncio.ensure_future(self._read(stream, name, on_output))
+
+    async def _read(self, stream: asyncio.StreamReader, name: str, on_output):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                line = await stream.read(LINE_LIMIT)
+            if not line:
+                return
+            if name == "stdout" and on_output:
+                on_output(line)
+            else:
+                self.output.append(name, line)
+
+    async def wait(self):
+        self.result.durations = [0.0] * len(self.procs)
+        try:
+            await asyncio.gather(
+                *self.tasks, *(self._wait(i) for i in range(len(self.procs)))
+            )
+        finally:
+            for proc in self.procs:
+                if proc.returncode is not None:
+                    self.executor.unregister(proc.pid)
+        self.result.returncodes = [x.returncode for x in self.procs]
+
+    async def _wait(self, index: int):
+        proc = self.procs[index]
+        await proc.wait()
+        duration = self.result.durations[index] = time.monotonic() - self.started[index]
+        tracer = tracing.tracer
+        if tracer is not None:
+            end = time.perf_counter_ns()
+            command = self.commands[index]
+            tracer.add_async(
+                os.path.basename(command[0]),
+                end - int(duration * 1e9),
+                end,
+                {"command": command, "returncode": proc.returncode},
+            )
+
+    async def terminate(self):
+        alive = [x for x in self.procs if x.returncode is None]
+        for proc in alive:
+            with contextlib.suppress(ProcessLookupError):
+                proc.terminate()
+        if alive:
+            waiting = asyncio.gather(*(x.wait() for x in alive))
+            try:
+                await asyncio.wait_for(waiting, self.executor.grace_period)
+            except asyncio.TimeoutError:
+                for proc in alive:
+                    with contextlib.suppress(ProcessLookupError):
+                        proc.kill()
+                await asyncio.gather(*(x.wait() for x in alive))
+        for proc in self.procs:
+            self.executor.unregister(proc.pid)
+        # let readers and pumps see the end of their streams
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def check(self):
+        self.result.check(self.output.text("stderr") if self.output else None)
+
+
+class FanOut(Pipeline):
+    """ Producer (or stdin chunks) copied to several commands running at once. """
+
+    def __init__(self, executor, producer, commands, cwd, stdin, settings, on_output):
+        stages = ([producer] if producer else []) + list(commands)
+        super().__init__(executor, stages, cwd, stdin, None, settings, None)
+        self.producer = producer
+        self.consumers = self.commands[1:] if producer else self.commands
+        self.callbacks = on_output + [None] * (len(self.consumers) - len(on_output))
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        capture = asyncio.subprocess.PIPE if self.output else None
+        settings = self.pump_settings or {}
+        chunk_size = int(settings.get("buffer", 1 << 20))
+        source: ty.Optional[ty.Iterable[bytes]] = None
+        # descriptors owned by the copying thread once it is started
+        reader: ty.Optional[int] = None
+        sinks: ty.List[int] = []
+        to_close: ty.List[int] = []
+        try:
+            if self.producer:
+                reader, writer = os.pipe()
+                to_close.append(writer)
+                await self.spawn(self.producer, None, writer)
+                source = read_chunks(reader, chunk_size)
+            elif self.stdin is not None:
+                source = coalesce(self.count(self.stdin), min(chunk_size, 1 << 16))
+            for command, on_output in zip(self.consumers, self.callbacks):
+                stdin = None
+                if source is not None:
+                    stdin, sink = os.pipe()
+                    to_close.append(stdin)
+                    sinks.append(sink)
+                stdout = asyncio.subprocess.PIPE if on_output else capture
+                await self.spawn(command, stdin, stdout, on_output)
+        except BaseException:
+            for fd in sinks + ([reader] if reader is not None else []):
+                os.close(fd)
+            raise
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        if source is not None:
+            queue_size = int(settings.get("queue", 8))
+            self.tasks.append(
+                loop.run_in_executor(None, self.tee, source, sinks, queue_size, reader)
+            )
+
+    def count(self, chunks: ty.Iterable[bytes]) -> ty.Iterator[bytes]:
+        for chunk in chunks:
+            self.result.fed += 1
+            yield chunk
+
+    def tee(self, source, sinks, queue_size, reader):
+        try:
+            stats = Tee(source, sinks, queue_size).run()
+            self.result.stats.append(stats)
+            log.info("Stream: %s", stats)
+        finally:
+            if reader is not None:
+                os.close(reader)
@@ -0,0 +1,273 @@
+import errno
+import fcntl
+import logging
+import os
+import queue
+import select
+import threading
+import time
+import typing as ty
+
+from attr import attrs, attrib
+
+log = logging.getLogger(__name__)
+
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+
+def humanize(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(size) < 1024 or unit == "TiB":
+            break
+        size /= 1024
+    return f"{size:.1f}{unit}"
+
+
+@attrs
+class PumpStats:
+    """ Statistics of a stream between producer and consumer. """
+
+    method: str = attrib(default="splice")
+    bytes: int = attrib(default=0)
+    duration: float = attrib(default=0.0)
+    # time spent waiting for the producer output, i.e. producer is the bottleneck
+    read_wait: float = attrib(default=0.0)
+    # time spent waiting for the consumer to accept data
+    write_wait: float = attrib(default=0.0)
+
+    @property
+    def rate(self) -> float:
+        return self.bytes / self.duration if self.duration else 0.0
+
+    @property
+    def bottleneck(self) -> str:
+        return "producer" if self.read_wait >= self.write_wait else "consumer"
+
+    def __str__(self):
+        return (
+            f"{humanize(self.bytes)} in {self.duration:.1f}s "
+            f"({humanize(self.rate)}/s, {self.method}); "
+            f"waited for producer {self.read_wait:.1f}s, "
+            f"for consumer {self.write_wait:.1f}s"
+        )
+
+
+@attrs
+class TeeStats(PumpStats):
+    """ Statistics of a stream copied to several consumers. """
+
+    method: str = attrib(default="tee")
+    # time each consumer spent writing, the largest one slowed down the rest
+    writes: ty.List[float] = attrib(factory=list)
+    # consumers that closed their input before the end of stream
+    dropped: ty.List[int] = attrib(factory=list)
+
+    @property
+    def slowest(self) -> int:
+        return max(range(len(self.writes)), key=self.writes.__getitem__, default=0)
+
+    def __str__(self):
+        out = super().__str__() + f"; slowest consumer #{self.slowest}"
+        if self.dropped:
+            out += f", dropped {self.dropped}"
+        return out
+
+
+class Pump:
+    """
+    Moves data from one file descriptor to another,
+    measuring how long each side kept the other waiting.
+
+    Uses os.splice() between pipes, so data never leaves the kernel,
+    or a reusable buffer when splice is not available.
+    """
+
+    def __init__(self, src: int, dst: int, chunk_size: int = 1 << 20, splice=True):
+        self.src = src
+        self.dst = dst
+        self.chunk_size = chunk_size
+        self.splice = splice and hasattr(os, "splice")
+        self.stats = PumpStats(method="splice" if self.splice else "buffer")
+
+    def run(self) -> PumpStats:
+        start = time.monotonic()
+        try:
+            if self.splice:
+                try:
+                    self._splice()
+                except OSError as e:
+                    # splice() needs a pipe on at least one side
+                    unsupported = e.errno in (errno.EINVAL, errno.ENOSYS)
+                    if not unsupported or self.stats.bytes:
+                        raise
+                    log.debug("splice() is not supported, falling back to buffer")
+                    self.stats.method = "buffer"
+                    self._copy()
+            else:
+                self._copy()
+        finally:
+            self.stats.duration = time.monotonic() - start
+        return self.stats
+
+    @staticmethod
+    def _wait(poller) -> float:
+        start = time.monotonic()
+        poller.poll()
+        return time.monotonic() - start
+
+    def _splice(self):
+        stats = self.stats
+        readable, writable = select.poll(), select.poll()
+        readable.register(self.src, select.POLLIN)
+        writable.register(self.dst, select.POLLOUT)
+        while True:
+            stats.read_wait += self._wait(readable)
+            stats.write_wait += self._wait(writable)
+            try:
+                size = os.splice(
+                    self.src, self.dst, self.chunk_size, flags=SPLICE_FLAGS
+                )
+            except BlockingIOError:
+                continue
+            if not size:
+                return
+            stats.bytes += size
+
+    def _copy(self):
+        stats = self.stats
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        while True:
+            start = time.monotonic()
+            size = os.readv(self.src, [buffer])
+            stats.read_wait += time.monotonic() - start
+            if not size:
+                return
+            written = 0
+            start = time.monotonic()
+            while written < size:
+                written += os.write(self.dst, view[written:size])
+            stats.write_wait += time.monotonic() - start
+            stats.bytes += size
+
+
+class Tee:
+    """
+    Copies a stream to several file descriptors.
+
+    Each consumer is written by its own thread from a bounded queue, so the
+    producer is held back only by the slowest consumer and only when it falls
+    'queue_size' chunks behind. Chunks are shared between consumers, not copied.
+    A consumer that closed its input is dropped, the rest get the whole stream.
+    A consumer that failed otherwise is dropped too, run() raises its error.
+    """
+
+    def __init__(
+        self, chunks: ty.Iterable[bytes], dsts: ty.Sequence[int], queue_size: int = 8
+    ):
+        self.chunks = chunks
+        self.dsts = list(dsts)
+        self.queues: ty.List["queue.Queue[ty.Optional[bytes]]"] = [
+            queue.Queue(queue_size) for _ in self.dsts
+        ]
+        self.stats = TeeStats(writes=[0.0] * len(self.dsts))
+        # write errors other than a closed input
+        self.errors: ty.List[OSError] = []
+
+    def run(self) -> TeeStats:
+        """ Copies the stream, closes all destinations. """
+        stats = self.stats
+        start = time.monotonic()
+        writers = [
+            threading.Thread(target=self._write, args=(i,), name=f"tee-{i}")
+            for i in range(len(self.dsts))
+        ]
+        for thread in writers:
+            thread.start()
+        try:
+            chunks = iter(self.chunks)
+            while len(stats.dropped) < len(self.dsts):
+                wait = time.monotonic()
+                chunk = next(chunks, None)
+                stats.read_wait += time.monotonic() - wait
+                if chunk is None:
+                    break
+                wait = time.monotonic()
+                for i, output in enumerate(self.queues):
+                    if i not in stats.dropped:
+                        output.put(chunk)
+                stats.write_wait += time.monotonic() - wait
+                stats.bytes += len(chunk)
+        finally:
+            for output in self.queues:
+                output.put(None)
+            for thread in writers:
+                thread.join()
+            stats.duration = time.monotonic() - start
+        if self.errors:
+            raise self.errors[0]
+        return stats
+
+    def _write(self, i: int):
+        fd = self.dsts[i]
+        try:
+            while True:
+                chunk = self.queues[i].get()
+                if chunk is None:
+                    return
+                if i in self.stats.dropped:
+                    continue
+                start = time.monotonic()
+                try:
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(fd, view) :]
+                except BrokenPipeError:
+                    log.warning("Consumer #%s closed its input", i)
+                    self.stats.dropped.append(i)
+                except OSError as e:
+                    # the queue is still drained, so the producer is not blocked
+                    log.error("Failed to write to consumer #%s: %s", i, e)
+                    self.errors.append(e)
+                    self.stats.dropped.append(i)
+                self.stats.writes[i] += time.monotonic() - start
+        finally:
+            os.close(fd)
+
+
+def read_chunks(fd: int, size: int = 1 << 20) -> ty.Iterator[bytes]:
+    while True:
+        chunk = os.read(fd, size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def coalesce(items: ty.Iterable[bytes], size: int = 1 << 16) -> ty.Iterator[bytes]:
+    """ Joins small items into chunks of at least 'size' bytes. """
+    batch: ty.List[bytes] = []
+    total = 0
+    for item in items:
+        batch.append(item)
+        total += len(item)
+        if total >= size:
+            yield b"".join(batch)
+            batch, total = [], 0
+    if batch:
+        yield b"".join(batch)
+
+
+def set_pipe_size(fd: int, size: int):
+    """ Tries to increase capacity of a pipe, to make fewer context switches. """
+    try:
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), size)
+    except OSError as e:
+        log.debug("Failed to set pipe size: %s", e)
+
+
+def pump(src: int, dst: int, settings: ty.Optional[dict] = None) -> PumpStats:
+    settings = settings or {}
+    chunk_size = int(settings.get("buffer", 1 << 20))
+    for fd in (src, dst):
+        set_pipe_size(fd, chunk_size)
+    return Pump(src, dst, chunk_size, splice=settings.get("splice", True)).run()
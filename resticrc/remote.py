@@ -0,0 +1,185 @@
+"""
+Remote jobs.
+
+The command reading the source runs on the remote host: restic for file jobs,
+the producer for 'cmd' and 'zstd' jobs (its output is streamed back to restic).
+Commands are sent through a transport; the SSH one keeps a single
+multiplexed master connection per host, shared by all jobs of the host,
+so no command pays for a new SSH handshake.
+Other transports are added with register(), e.g. the local one for tests.
+"""
+import atexit
+import logging
+import shlex
+import threading
+import typing as ty
+from abc import ABC, abstractmethod
+
+from attr import attrs, attrib
+
+from .executor import executor
+from .state import runtime_dir
+
+log = logging.getLogger(__name__)
+
+# how long an idle master connection is kept if resticrc did not close it
+CONTROL_PERSIST = 600
+
+
+def remote_command(command: ty.Sequence[str], cwd=None) -> str:
+    """ Returns shell command line executing the command in cwd. """
+    line = " ".join(shlex.quote(x) for x in command)
+    if cwd:
+        return f"cd {shlex.quote(str(cwd))} && exec {line}"
+    return line
+
+
+@attrs(frozen=True)
+class Remote:
+    """ Where a job runs, saved in the compiled config. """
+
+    host: str = attrib()
+    transport: str = attrib(default="ssh")
+    # extra ssh options, e.g. ('-p', '2222')
+    options: ty.Tuple[str, ...] = attrib(default=(), converter=tuple)
+
+    def connect(self) -> "Transport":
+        """ Returns transport of the host, shared by all jobs. """
+        return connections.get(self)
+
+
+class Transport(ABC):
+    def __init__(self, remote: Remote):
+        self.remote = remote
+        self._lock = threading.Lock()
+        self.opened = False
+
+    def open(self):
+        """ Prepares the connection once, before the first command. """
+        with self._lock:
+            if not self.opened:
+                self.connect()
+                self.opened = True
+
+    def connect(self):
+        pass
+
+    def close(self):
+        self.opened = False
+
+    @abstractmethod
+    def wrap(self, command: ty.Sequence[str], cwd=None) -> ty.List[str]:
+        """ Returns local command which executes the command on the host in cwd. """
+
+
+class LocalTransport(Transport):
+    """ Runs commands on this host through the shell, like ssh does. """
+
+    def wrap(self, command: ty.Sequence[str], cwd=None) -> ty.List[str]:
+        self.open()
+        return ["sh", "-c", remote_command(command, cwd)]
+
+
+class SSHTransport(Transport):
+    """ OpenSSH client with a master connection (ControlMaster). """
+
+    def base(self) -> ty.List[str]:
+        directory = runtime_dir() / "ssh"
+        directory.mkdir(exist_ok=True, mode=0o700)
+        # %C is a hash of the connection, short enough for a socket path
+        return [
+            "ssh",
+            "-o",
+            f"ControlPath={directory}/%C",
+            "-o",
+            "BatchMode=yes",
+            *self.remote.options,
+        ]
+
+    def connect(self):
+        # backgrounds after authentication, its stdio is redirected to /dev/null;
+        # the master outlives the job which opened it and serves the other jobs,
+        # so it does not get nice, cgroup etc of that job
+        with executor.limit(None):
+            executor.run(
+                self.base()
+                + ["-o", "ControlMaster=yes", "-o", f"ControlPersist={CONTROL_PERSIST}"]
+                + ["-f", "-N", self.remote.host]
+            )
+
+    def close(self):
+        if not self.opened:
+            return
+        try:
+            executor.run(self.base() + ["-O", "exit", self.remote.host])
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug("Failed to close connection to %s: %s", self.remote.host, e)
+        super().close()
+
+    def wrap(self, command: ty.Sequence[str], cwd=None) -> ty.List[str]:
+        self.open()
+        # 'auto' connects directly if the master has gone
+        return self.base() + [
+            "-o",
+            "ControlMaster=auto",
+            self.remote.host,
+            "--",
+            remote_command(command, cwd),
+        ]
+
+
+TRANSPORTS: ty.Dict[str, ty.Type[Transport]] = {
+    "ssh": SSHTransport,
+    "local": LocalTransport,
+}
+
+
+def register(name: str, transport: ty.Type[Transport]):
+    TRANSPORTS[name] = transport
+
+
+class Connections:
+    """ Transports of all hosts used in this process. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transports: ty.Dict[Remote, Transport] = {}
+
+    def get(self, remote: Remote) -> Transport:
+        with self._lock:
+            transport = self._transports.get(remote)
+            if transport is None:
+                if not self._transports:
+                    atexit.register(self.close)
+                try:
+                    cls = TRANSPORTS[remote.transport]
+                except KeyError:
+                    raise ValueError(
+                        f"Unknown transport {remote.transport!r}"
+                    ) from None
+                transport = self._transports[remote] = cls(remote)
+            return transport
+
+    def close(self):
+        with self._lock:
+            transports = list(self._transports.values())
+            self._transports.clear()
+        for transport in transports:
+            transport.close()
+
+
+connections = Connections()
+
+
+def from_dict(conf: dict) -> ty.Optional[Remote]:
+    """ Pops remote settings of a job: 'ssh', 'ssh-options' and 'transport'. """
+    host = conf.pop("ssh", None)
+    options = conf.pop("ssh-options", ())
+    transport = conf.pop("transport", "ssh")
+    if host is None:
+        return None
+    if isinstance(options, str):
+        options = shlex.split(options)
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {transport!r}")
+    return Remote(host=str(host), transport=transport, options=options)
@@ -0,0 +1,165 @@
+"""
+Limits of resources used by backup processes.
+
+Settings are applied by prefixing commands with standard tools
+(nice, ionice, taskset), so they are inherited by children of the commands,
+e.g. zstd started by tar, and are visible in dry runs.
+Processes are moved to a cgroup v2 by a tiny shell wrapper before exec.
+"""
+import logging
+import os
+import threading
+import typing as ty
+from pathlib import Path
+
+from attr import attrs, attrib
+
+from .sizefilter import parse_size
+
+log = logging.getLogger(__name__)
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+CGROUP_ROOT = "/sys/fs/cgroup/resticrc"
+# moves the shell to the cgroup given as the first argument, then executes the rest
+CGROUP_WRAPPER = 'echo $$ > "$1/cgroup.procs" && shift && exec "$@"'
+
+_cgroup_lock = threading.Lock()
+
+
+def parse_cpus(value) -> ty.List[int]:
+    """
+    Parses CPU list like '0-3,6' or [0, 1]. A number means that many CPUs
+    from the end of the allowed ones, production usually sticks to the first.
+    """
+    if isinstance(value, int):
+        allowed = sorted(os.sched_getaffinity(0))
+        if not 0 < value <= len(allowed):
+            raise ValueError(f"Only {len(allowed)} CPUs are available, not {value}")
+        return allowed[-value:]
+    if isinstance(value, str):
+        value = value.split(",")
+    out: ty.Set[int] = set()
+    for item in value:
+        first, _, last = str(item).strip().partition("-")
+        out.update(range(int(first), int(last or first) + 1))
+    return sorted(out)
+
+
+def format_cpus(cpus: ty.Iterable[int]) -> str:
+    return ",".join(str(x) for x in cpus)
+
+
+@attrs
+class Resources:
+    """ Resources settings of a job, see readme for keys of 'resources'. """
+
+    nice: ty.Optional[int] = attrib(default=None)
+    # 'idle', 'best-effort[:level]' or 'realtime[:level]'
+    ionice: ty.Optional[str] = attrib(default=None)
+    cpus: ty.Optional[ty.List[int]] = attrib(default=None)
+    # restic limits, KiB/s
+    limit_upload: ty.Optional[int] = attrib(default=None)
+    limit_download: ty.Optional[int] = attrib(default=None)
+    # cgroup v2 settings, the group is created in 'cgroup' directory
+    memory_max: ty.Optional[int] = attrib(default=None)
+    io_weight: ty.Optional[int] = attrib(default=None)
+    cgroup: str = attrib(default=CGROUP_ROOT)
+
+    @classmethod
+    def from_dict(cls, conf: ty.Optional[dict]) -> ty.Optional["Resources"]:
+        if not conf:
+            return None
+        conf = dict(conf)
+        cpus = conf.pop("cpus", None)
+        ionice = conf.pop("ionice", None)
+        if ionice is not None and str(ionice).partition(":")[0] not in IONICE_CLASSES:
+            raise ValueError(f"Unknown ionice class {ionice!r}")
+        memory_max = conf.pop("memory-max", None)
+        limits = {}
+        for key in ("limit-upload", "limit-download"):
+            value = conf.pop(key, None)
+            if value is not None:
+                # restic wants KiB/s
+                limits[key.replace("-", "_")] = max(1, parse_size(value) // 1024)
+        resources = cls(
+            nice=conf.pop("nice", None),
+            ionice=ionice,
+            cpus=parse_cpus(cpus) if cpus is not None else None,
+            memory_max=parse_size(memory_max) if memory_max is not None else None,
+            io_weight=conf.pop("io-weight", None),
+            cgroup=conf.pop("cgroup", CGROUP_ROOT),
+            **limits,
+        )
+        if conf:
+            raise ValueError(f"Unknown resources settings: {', '.join(conf)}")
+        return resources
+
+    def restic_args(self) -> ty.List[str]:
+        args = []
+        if self.limit_upload:
+            args.extend(["--limit-upload", str(self.limit_upload)])
+        if self.limit_download:
+            args.extend(["--limit-download", str(self.limit_download)])
+        return args
+
+    def threads(self, default: int) -> int:
+        """ Number of threads for a CPU-bound command, e.g. zstd. """
+        if not self.cpus:
+            return default
+        return len(self.cpus)
+
+    def prefix(self, name: str, setup=True) -> ty.List[str]:
+        """
+        Returns command prefix which applies the settings.
+        The cgroup is not created without 'setup', e.g. for dry runs.
+        """
+        out = []
+        cgroup = self.cgroup_path(name, setup)
+        if cgroup:
+            out.extend(["sh", "-c", CGROUP_WRAPPER, "sh", str(cgroup)])
+        if self.nice is not None:
+            out.extend(["nice", "-n", str(self.nice)])
+        if self.ionice is not None:
+            cls, _, level = str(self.ionice).partition(":")
+            out.extend(["ionice", "-c", IONICE_CLASSES[cls]])
+            if level:
+                out.extend(["-n", level])
+        if self.cpus:
+            out.extend(["taskset", "-c", format_cpus(self.cpus)])
+        return out
+
+    def wrap(
+        self, command: ty.Sequence[str], name: str = "", setup=True
+    ) -> ty.List[str]:
+        return self.prefix(name, setup) + list(command)
+
+    def cgroup_path(self, name: str, setup=True) -> ty.Optional[Path]:
+        """ Creates cgroup for the job if needed, returns None if it is not used. """
+        if self.memory_max is None and self.io_weight is None:
+            return None
+        path = Path(self.cgroup) / (name or "default")
+        if not setup:
+            return path
+        with _cgroup_lock:
+            try:
+                self._setup_cgroup(path)
+            except OSError as e:
+                log.warning("Failed to set up cgroup %s, ignoring it: %s", path, e)
+                return None
+        return path
+
+    def _setup_cgroup(self, path: Path):
+        parent = path.parent
+        if not parent.exists():
+            parent.mkdir(parents=True)
+        controllers = []
+        if self.memory_max is not None:
+            controllers.append("+memory")
+        if self.io_weight is not None:
+            controllers.append("+io")
+        (parent / "cgroup.subtree_control").write_text(" ".join(controllers))
+        path.mkdir(exist_ok=True)
+        if self.memory_max is not None:
+            (path / "memory.max").write_text(str(self.memory_max))
+        if self.io_weight is not None:
+            (path / "io.weight").write_text(f"default {self.io_weight}")
@@ -1,19 +1,30 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
 import glob
+import itertools
 import logging
-import subprocess
-from typing import List, TYPE_CHECKING
+import os
+import shlex
+import time
+from typing import Callable, Dict, List, Optional, TYPE_CHECKING, Union
 
 from attr import attrs, attrib
+from attr.converters import optional
 
 from .executor import executor
 from .commands import Restic
+from .metrics import phase
 
 if TYPE_CHECKING:
     from .models import Job
 
 log = logging.getLogger(__name__)
 
+# snapshots of one process
+_snapshots = itertools.count()
+
 
 class Runner(ABC):
     @staticmethod
@@ -23,15 +34,32 @@ class Runner(ABC):
             paths = [paths]
         log.debug("Paths: %s", paths)
         run_cmd = conf.pop("cmd", None)
+        items = conf.pop("items", None)
+        items_cmd = conf.pop("items-cmd", None)
         runner = None
-        if run_cmd:
+        if (items is not None or items_cmd) and not run_cmd:
+            raise ValueError("items need a cmd to back up every item.")
+        if items is not None or items_cmd:
+            runner = ItemsRunner(
+                target=run_cmd,
+                items=items or [],
+                discover=items_cmd,
+                filename=conf.pop("save-as", ITEM),
+                workers=conf.pop("parallel", 4),
+            )
+        elif run_cmd:
             runner = PipedRunner(target=run_cmd, filename=conf.pop("save-as", None))
         zfs_dataset = conf.pop("zfs-dataset", None)
         if zfs_dataset:
-            mountpoint = conf.pop("zfs-mountpoint", None)
-            if mountpoint is None:
-                raise ValueError("No snapshot mountpoint provided.")
-            runner = ZFSSnapshotRunner(dataset=zfs_dataset, paths=paths or ["."])
+            if conf.pop("zfs-mountpoint", None) is not None:
+                log.warning("zfs-mountpoint is ignored: snapshots are not mounted")
+            runner = ZFSSnapshotRunner(
+                datasets=zfs_dataset,
+                recursive=conf.pop("zfs-recursive", False),
+                workers=conf.pop("zfs-workers", 4),
+                skip_unmounted=conf.pop("zfs-skip-unmounted", False),
+                paths=paths or ["."],
+            )
         if runner is None:
             if not paths:
                 raise ValueError("No paths provided.")
@@ -52,34 +80,228 @@ class FileRunner(Runner):
         restic.backup_files(self.paths)
 
 
+def _as_list(value: Union[str, List[str]]) -> List[str]:
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _as_argv(value: Union[str, List[str]]) -> List[str]:
+    """ Command is a list of arguments or a string split like a shell does it. """
+    if isinstance(value, str):
+        return shlex.split(value)
+    return [str(x) for x in value]
+
+
+def run_parts(job: "Job", parts: Dict[str, Callable[[], None]], workers: int, kind):
+    """ Runs parts of the job concurrently, raises the first error after all end. """
+    errors: List[Exception] = []
+    with ThreadPoolExecutor(
+        max(1, min(workers, len(parts))), thread_name_prefix=kind
+    ) as pool:
+        futures = {
+            # threads do not inherit job context (output buffer, resources)
+            name: pool.submit(contextvars.copy_context().run, part)
+            for name, part in parts.items()
+        }
+        for name, future in futures.items():
+            error = future.exception()
+            if error is not None:
+                log.error("[%s] Backup of %s failed: %s", job.name, name, error)
+                errors.append(error)
+    if errors:
+        raise errors[0]
+
+
 @attrs
 class ZFSSnapshotRunner(Runner):
-    dataset: str = attrib()
-    mountpoint: str = attrib(default="/mnt")
+    """
+    Backups snapshots of datasets, read from '<mountpoint>/.zfs/snapshot/<name>',
+    so nothing is mounted. All snapshots are created by one 'zfs snapshot'
+    call, which is atomic, and datasets are backed up concurrently,
+    each one with 'zfs:<dataset>' tag. A dataset that is not mounted
+    fails the job, unless it is allowed to be skipped.
+    """
+
+    datasets: List[str] = attrib(converter=_as_list)
+    # snapshot children of the datasets too
+    recursive: bool = attrib(default=False)
+    # datasets backed up at the same time
+    workers: int = attrib(default=4)
     paths: List[str] = attrib(default=["."])
+    # datasets that are not mounted are skipped instead of failing the job
+    skip_unmounted: bool = attrib(default=False)
+
+    @staticmethod
+    def snapshot_name() -> str:
+        """ Unique name, so overlapping runs do not destroy snapshots of each other. """
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        return f"resticrc-{stamp}-{os.getpid()}-{next(_snapshots)}"
+
+    def mountpoints(self) -> Dict[str, Optional[str]]:
+        """
+        Returns mountpoints of the datasets (and their children if recursive),
+        None for datasets that are not mounted.
+        """
+        command = [
+            "zfs",
+            "list",
+            "-H",
+            "-o",
+            "name,mountpoint,mounted",
+            "-t",
+            "filesystem",
+        ]
+        if self.recursive:
+            command.append("-r")
+        lines: List[bytes] = []
+        executor.run(command + self.datasets, on_output=lines.append)
+        if not lines and executor.dry_run:
+            # default mountpoints, just to show commands
+            return {x: f"/{x}" for x in self.datasets}
+        out = {}
+        for line in lines:
+            name, mountpoint, mounted = line.decode().rstrip("\n").split("\t")
+            # no .zfs directory to read from otherwise
+            usable = mounted == "yes" and mountpoint.startswith("/")
+            out[name] = mountpoint if usable else None
+        return out
+
+    def snapshot(self, name: str) -> List[str]:
+        """ Snapshots all datasets at once, returns snapshots to destroy. """
+        snapshots = [f"{x}@{name}" for x in self.datasets]
+        command = ["zfs", "snapshot"]
+        if self.recursive:
+            command.append("-r")
+        executor.run(command + snapshots)
+        return snapshots
+
+    def destroy(self, snapshots: List[str]):
+        failed = None
+        for snapshot in snapshots:
+            command = ["zfs", "destroy"]
+            if self.recursive:
+                command.append("-r")
+            try:
+                executor.run(command + [snapshot])
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("Failed to destroy snapshot %s: %s", snapshot, e)
+                failed = failed or e
+        if failed:
+            raise failed
+
+    def backup(self, job: "Job", dataset: str, path: str):
+        name = job.name if len(self.datasets) == 1 and not self.recursive else None
+        restic = Restic(
+            job,
+            self,
+            name=name or f"{job.name}:{dataset}",
+            # paths differ in every run, parent snapshot is found by tags
+            args=["--tag", f"zfs:{dataset}", "--group-by", "host,tags"],
+        )
+        # the snapshot directory is new every run, its files are not
+        restic.backup_files(paths=self.paths, cwd=path, root=f"zfs:{dataset}")
+
+    @staticmethod
+    def unmounted(dataset: str):
+        raise ValueError(
+            f"Dataset {dataset} is not mounted, "
+            "set zfs-skip-unmounted to back up the others only."
+        )
 
     def __call__(self, job: "Job"):
-        snapshot_name = f"{self.dataset}@restic"
-        executor.run(["zfs", "snapshot", snapshot_name])
-        executor.run(["mount", "-t", "zfs", snapshot_name, self.mountpoint])
+        # snapshots are mounted by zfs when they are read, it needs mountpoints
+        with phase("list"):
+            mountpoints = self.mountpoints()
+        if not any(mountpoints.values()):
+            raise ValueError(f"No mounted datasets in {', '.join(self.datasets)}.")
+        name = self.snapshot_name()
+        with phase("snapshot"):
+            snapshots = self.snapshot(name)
+        parts = {
+            dataset: functools.partial(
+                self.backup,
+                job,
+                dataset,
+                os.path.join(mountpoint, ".zfs", "snapshot", name),
+            )
+            for dataset, mountpoint in mountpoints.items()
+            if mountpoint is not None
+        }
+        for dataset, mountpoint in mountpoints.items():
+            if mountpoint is None and self.skip_unmounted:
+                log.warning(
+                    "[%s] Dataset %s is not mounted, skipped", job.name, dataset
+                )
+            elif mountpoint is None:
+                # the others are backed up, the job fails after them
+                parts[dataset] = functools.partial(self.unmounted, dataset)
         try:
-            restic = Restic(job, self)
-            restic.backup_files(paths=self.paths, cwd=self.mountpoint)
+            run_parts(job, parts, self.workers, "zfs")
         finally:
-            executor.run(["umount", self.mountpoint])
-            executor.run(["zfs", "destroy", snapshot_name])
+            with phase("cleanup"):
+                self.destroy(snapshots)
 
 
 @attrs
 class PipedRunner(Runner):
-    target = attrib()
+    target: List[str] = attrib(converter=_as_argv)
     filename = attrib(default=None)
 
     def __call__(self, job: "Job"):
         restic = Restic(job, self)
-        restic_proc = restic.backup_stdin(filename=self.filename)
-        if executor.dry_run:
+        restic.backup_stdin(self.target, filename=self.filename)
+
+
+# replaced by the item in arguments of the command and in the file name
+ITEM = "{item}"
+
+
+@attrs
+class ItemsRunner(Runner):
+    """
+    Backups output of the command for every item, e.g. a dump of every database,
+    several at once. Each item is a separate stdin backup with 'item:<item>' tag.
+    Items are listed in the config and/or printed by the discovery command,
+    one per line.
+    """
+
+    target: List[str] = attrib(converter=_as_argv)
+    items: List[str] = attrib(factory=list, converter=_as_list)
+    discover: Optional[List[str]] = attrib(default=None, converter=optional(_as_argv))
+    filename: str = attrib(default=ITEM)
+    # producers running at the same time
+    workers: int = attrib(default=4)
+
+    def __attrs_post_init__(self):
+        if not any(ITEM in x for x in self.target):
+            raise ValueError(f"cmd should contain {ITEM} for every item.")
+
+    def find_items(self, job: "Job") -> List[str]:
+        items = [str(x) for x in self.items]
+        if self.discover:
+            lines: List[bytes] = []
+            executor.run(job.command(self.discover), on_output=lines.append)
+            found = (x.decode().strip() for x in lines)
+            items.extend(x for x in found if x and x not in items)
+        if not items and executor.dry_run:
+            # discovery is not executed, just to show commands
+            return [ITEM]
+        return items
+
+    def backup(self, job: "Job", item: str):
+        restic = Restic(
+            job,
+            self,
+            name=f"{job.name}:{item}",
+            # the parent snapshot of the item is found by its tag
+            args=["--tag", f"item:{item}", "--group-by", "host,tags"],
+        )
+        producer = [x.replace(ITEM, item) for x in self.target]
+        restic.backup_stdin(producer, filename=self.filename.replace(ITEM, item))
+
+    def __call__(self, job: "Job"):
+        items = self.find_items(job)
+        if not items:
+            log.warning("[%s] No items to back up", job.name)
             return
-        subprocess.check_call(self.target.split(), stdout=restic_proc.stdin)
-        restic_proc.stdin.close()
-        restic_proc.wait()
+        parts = {x: functools.partial(self.backup, job, x) for x in items}
+        run_parts(job, parts, self.workers, "item")
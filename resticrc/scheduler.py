@@ -0,0 +1,195 @@
+import logging
+import time
+import typing as ty
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from attr import attrs, attrib
+
+from .executor import OutputBuffer, executor
+from .state import DurationStore
+
+if ty.TYPE_CHECKING:
+    from .models import Job
+
+log = logging.getLogger(__name__)
+
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+@attrs
+class JobResult:
+    name: str = attrib()
+    status: str = attrib()
+    duration: float = attrib(default=0.0)
+    error: ty.Optional[BaseException] = attrib(default=None)
+
+    @property
+    def ok(self):
+        return self.status == DONE
+
+
+def run_job(name: str, job: "Job") -> JobResult:
+    """ Runs the job, capturing its output; errors are returned, not raised. """
+    log.info("Executing job %s", name)
+    start = time.monotonic()
+    try:
+        with executor.capture(OutputBuffer(name)):
+            job.run()
+    except Exception as e:  # pylint: disable=broad-except
+        log.error("Job %s failed: %s", name, e)
+        return JobResult(name, FAILED, time.monotonic() - start, error=e)
+    duration = time.monotonic() - start
+    log.info("Job %s finished in %.1fs", name, duration)
+    return JobResult(name, DONE, duration)
+
+
+@attrs
+class Scheduler:
+    """
+    Runs jobs concurrently, respecting 'after' dependencies
+    and concurrency limits of repositories.
+    Jobs on the critical path (by durations of previous runs) are started first.
+    """
+
+    jobs: ty.Dict[str, "Job"] = attrib()
+    workers: int = attrib(default=1)
+    durations: DurationStore = attrib(factory=DurationStore)
+
+    def __attrs_post_init__(self):
+        self.results: ty.Dict[str, JobResult] = {}
+        self.check()
+        self.priority = self.critical_paths()
+
+    def check(self):
+        """
+        Checks that all dependencies exist, there are no cycles
+        and every job could be started.
+        """
+        if self.workers < 1:
+            raise ValueError("'workers' should be at least 1.")
+        for name, job in self.jobs.items():
+            for dep in job.after:
+                if dep not in self.jobs:
+                    raise ValueError(f"[job {name!r}] Unknown dependency {dep!r}.")
+            for repo in job.repos:
+                if repo.concurrency < 1:
+                    raise ValueError(
+                        f"[repo {repo.name!r}] 'concurrency' should be at least 1."
+                    )
+        visited: ty.Dict[str, bool] = {}
+
+        def visit(name, path):
+            if visited.get(name):
+                return
+            if name in path:
+                cycle = " -> ".join(path[path.index(name) :] + [name])
+                raise ValueError(f"Dependency cycle: {cycle}")
+            for dep in self.jobs[name].after:
+                visit(dep, path + [name])
+            visited[name] = True
+
+        for name in self.jobs:
+            visit(name, [])
+
+    def dependents(self, name) -> ty.List[str]:
+        return [x for x, job in self.jobs.items() if name in job.after]
+
+    def critical_paths(self) -> ty.Dict[str, float]:
+        """
+        Returns expected time from start of each job to the end of the run,
+        i.e. its own duration plus the longest chain of its dependents.
+        """
+        known = [self.durations.get(x) for x in self.jobs]
+        known = [x for x in known if x is not None]
+        fallback = sum(known) / len(known) if known else 0.0
+        out: ty.Dict[str, float] = {}
+
+        def length(name):
+            if name not in out:
+                own = self.durations.get(name, fallback)
+                out[name] = own + max(
+                    (length(x) for x in self.dependents(name)), default=0.0
+                )
+            return out[name]
+
+        for name in self.jobs:
+            length(name)
+        return out
+
+    def ready(self, pending: ty.Set[str], running: ty.Iterable[str]) -> ty.List[str]:
+        """ Returns jobs that can be started right now, most important first. """
+        running = list(running)
+        slots = self.workers - len(running)
+        repo_usage: ty.Dict[str, int] = {}
+        for name in running:
+            for repo in self.jobs[name].repos:
+                repo_usage[repo.name] = repo_usage.get(repo.name, 0) + 1
+        out = []
+        candidates = sorted(pending, key=lambda x: (-self.priority[x], x))
+        for name in candidates:
+            if slots <= 0:
+                break
+            job = self.jobs[name]
+            if not all(
+                dep in self.results and self.results[dep].ok for dep in job.after
+            ):
+                continue
+            if any(repo_usage.get(x.name, 0) >= x.concurrency for x in job.repos):
+                continue
+            for repo in job.repos:
+                repo_usage[repo.name] = repo_usage.get(repo.name, 0) + 1
+            slots -= 1
+            out.append(name)
+        return out
+
+    def cancel_dependents(self, name, pending: ty.Set[str]):
+        for dep in self.dependents(name):
+            if dep in pending:
+                log.warning("Cancelling job %s: dependency %s failed", dep, name)
+                pending.remove(dep)
+                self.results[dep] = JobResult(dep, CANCELLED)
+                self.cancel_dependents(dep, pending)
+
+    def fail_pending(self, pending: ty.Set[str]):
+        for name in sorted(pending):
+            error = RuntimeError("Job could not be started")
+            log.error("Job %s failed: %s", name, error)
+            self.results[name] = JobResult(name, FAILED, error=error)
+        pending.clear()
+
+    def run_job(self, name) -> JobResult:
+        return run_job(name, self.jobs[name])
+
+    def run(self) -> ty.Dict[str, JobResult]:
+        pending = set(self.jobs)
+        running: ty.Dict[ty.Any, str] = {}
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="job") as pool:
+            while pending or running:
+                for name in self.ready(pending, running.values()):
+                    pending.remove(name)
+                    running[pool.submit(self.run_job, name)] = name
+                if not running:
+                    # nothing could ever start them, check() should prevent it
+                    self.fail_pending(pending)
+                    break
+                try:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                except KeyboardInterrupt:
+                    pending.clear()
+                    executor.shutdown()
+                    raise
+                for future in done:
+                    name = running.pop(future)
+                    result = future.result()
+                    self.results[name] = result
+                    if result.ok:
+                        self.durations.record(name, result.duration)
+                    else:
+                        self.cancel_dependents(name, pending)
+        try:
+            self.durations.save()
+        except OSError as e:
+            log.warning("Failed to save job durations: %s", e)
+        return self.results
@@ -0,0 +1,106 @@
+"""
+Files skipped by the size limit ('larger: 500M' exclusion).
+
+restic skips them by itself (--exclude-larger-than), but it never sees files
+packed by tar, so for zstd jobs the tree is scanned in several threads
+and big files are excluded by name. Skipped files are reported by walks
+resticrc does anyway (pre-walk, zstd, prefetch), plain restic jobs scan
+the tree again only with 'report: true'.
+"""
+
+import logging
+import stat
+import typing as ty
+
+from attr import attrs, attrib
+
+from .pump import humanize
+from .walker import Walker
+
+if ty.TYPE_CHECKING:
+    from .filtering.matcher import ExclusionMatcher
+
+log = logging.getLogger(__name__)
+
+# biggest skipped files logged one by one
+REPORTED = 20
+
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(value) -> int:
+    """ Parses size like 512, '500M' or '1.5GiB' to bytes. """
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper()
+    for suffix in ("IB", "B"):
+        if text.endswith(suffix):
+            text = text[: -len(suffix)]
+            break
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    number = text[: len(text) - len(unit)].strip()
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size {value!r}, expected e.g. 500M") from None
+
+
+@attrs
+class SizeReport:
+    """ Files larger than the limit, with their sizes. """
+
+    limit: int = attrib()
+    files: ty.List[ty.Tuple[str, int]] = attrib(factory=list)
+
+    @property
+    def saved(self) -> int:
+        return sum(size for _, size in self.files)
+
+    @property
+    def paths(self) -> ty.List[str]:
+        return [path for path, _ in self.files]
+
+    def filter(self, entries: ty.Iterable[ty.Tuple[str, ty.Any]]) -> ty.Iterator[str]:
+        """ Yields paths of (path, lstat) entries within the limit, saves the rest. """
+        return (path for path, _ in self.within(entries))
+
+    def within(
+        self, entries: ty.Iterable[ty.Tuple[str, ty.Any]]
+    ) -> ty.Iterator[ty.Tuple[str, ty.Any]]:
+        """ Yields (path, lstat) entries within the limit, saves the rest. """
+        for path, st in entries:
+            if stat.S_ISREG(st.st_mode) and st.st_size > self.limit:
+                self.files.append((path, st.st_size))
+                continue
+            yield path, st
+
+    def log(self, name: str):
+        if not self.files:
+            return
+        log.info(
+            "[%s] %s files larger than %s skipped, %s saved",
+            name,
+            len(self.files),
+            humanize(self.limit),
+            humanize(self.saved),
+        )
+        biggest = sorted(self.files, key=lambda x: x[1], reverse=True)
+        for path, size in biggest[:REPORTED]:
+            log.info("[%s] Skipped %s (%s)", name, path, humanize(size))
+        if len(biggest) > REPORTED:
+            log.info("[%s] ... and %s more", name, len(biggest) - REPORTED)
+
+
+def scan_larger(
+    matcher: ty.Optional["ExclusionMatcher"],
+    paths: ty.Iterable[str],
+    limit: int,
+    cwd=None,
+    threads: int = 8,
+) -> SizeReport:
+    """ Finds files larger than the limit, skipping excluded ones. """
+    report = SizeReport(limit)
+    walker = Walker(matcher, threads=threads, cwd=cwd, stat=True)
+    for _ in report.filter(walker.walk(sorted(paths))):
+        pass
+    return report
@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import typing as ty
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+def state_dir() -> Path:
+    """ Returns directory for persistent resticrc state (history, indexes etc). """
+    base = os.environ.get("XDG_STATE_HOME")
+    path = Path(base) if base else Path.home().joinpath(".local", "state")
+    return path / "resticrc"
+
+
+def cache_dir() -> Path:
+    """ Returns directory for data that could be rebuilt (compiled config etc). """
+    base = os.environ.get("XDG_CACHE_HOME")
+    path = Path(base) if base else Path.home().joinpath(".cache")
+    return path / "resticrc"
+
+
+def runtime_dir() -> Path:
+    """ Returns private directory for sockets, removed on logout. """
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base:
+        return private_dir(Path(base) / "resticrc")
+    return private_dir(Path(tempfile.gettempdir()) / f"resticrc-{os.getuid()}")
+
+
+def private_dir(path: Path) -> Path:
+    """
+    Creates directory only this user could access. The temporary directory
+    is shared, so a directory somebody else made there in advance is refused.
+    """
+    path.mkdir(parents=True, exist_ok=True, mode=0o700)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a directory owned by this user")
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        # ours, e.g. created before with the default mode
+        os.chmod(path, 0o700)
+    return path
+
+
+class DurationStore:
+    """ Durations of previous job runs, used to plan the next ones. """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else state_dir() / "durations.json"
+        self._lock = threading.Lock()
+        self._data: ty.Optional[ty.Dict[str, float]] = None
+
+    @property
+    def data(self) -> ty.Dict[str, float]:
+        if self._data is None:
+            try:
+                with open(self.path) as fd:
+                    self._data = json.load(fd)
+            except (OSError, ValueError) as e:
+                log.debug("Failed to read durations from %s: %s", self.path, e)
+                self._data = {}
+        return self._data
+
+    def get(self, name, default=None) -> ty.Optional[float]:
+        return self.data.get(name, default)
+
+    def record(self, name, duration: float):
+        with self._lock:
+            self.data[name] = duration
+
+    def save(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w") as fd:
+                json.dump(self.data, fd)
+            os.replace(tmp, self.path)
@@ -0,0 +1,389 @@
+"""
+tar archive written by resticrc itself, for zstd jobs with 'prefetch'.
+
+GNU tar reads files one by one, so on network filesystems and disks it
+mostly waits for reads. Here chunks of files are read by a thread pool
+ahead of the writer, while members are written in a fixed order (sorted
+by path, like 'tar --sort=name'), so the archive stays the same when
+files do. The tree is walked in that order too, so the archive is written
+while it is walked. Read-ahead is limited by the buffer size, not by
+sizes of files.
+
+The archive is compressed in-process by the 'zstandard' package if it is
+installed, otherwise by a zstd process.
+"""
+import collections
+import grp
+import logging
+import os
+import pwd
+import stat
+import struct
+import tarfile
+import typing as ty
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# files are read by chunks of this size
+CHUNK = 1 << 20
+# bytes read ahead of the writer
+BUFFER = 64 << 20
+BLOCK = tarfile.BLOCKSIZE
+RECORD = tarfile.RECORDSIZE
+
+Entry = ty.Tuple[str, os.stat_result]
+
+
+# small files read by one task of the pool
+BATCH = 16
+
+Read = ty.Tuple[str, int, int]
+
+
+def _read(path: str, offset: int, length: int) -> bytes:
+    with open(path, "rb", buffering=0) as fd:
+        data = os.pread(fd.fileno(), length, offset)
+        while data and len(data) < length:
+            more = os.pread(fd.fileno(), length - len(data), offset + len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+
+def _read_batch(reads: ty.List[Read]) -> ty.List[ty.Union[bytes, OSError]]:
+    out: ty.List[ty.Union[bytes, OSError]] = []
+    for read in reads:
+        try:
+            out.append(_read(*read))
+        except OSError as e:
+            out.append(e)
+    return out
+
+
+def batches(reads: ty.Iterable[Read], size: int) -> ty.Iterator[ty.List[Read]]:
+    """ Groups reads up to 'size' bytes, so a task is not made for every small file. """
+    batch: ty.List[Read] = []
+    total = 0
+    for read in reads:
+        if batch and (total + read[2] > size or len(batch) >= BATCH):
+            yield batch
+            batch, total = [], 0
+        batch.append(read)
+        total += read[2]
+    if batch:
+        yield batch
+
+
+class ReadAhead:
+    """
+    Chunks of files read in a thread pool ahead of the consumer,
+    no more than 'limit' bytes (and one chunk) at once, taken in order.
+    """
+
+    def __init__(
+        self,
+        pool: ThreadPoolExecutor,
+        reads: ty.Iterable[Read],
+        limit: int,
+        chunk: int = CHUNK,
+    ):
+        self.pool = pool
+        self.batches = batches(reads, chunk)
+        self.limit = limit
+        self.pending: "collections.deque[ty.Tuple[int, Future]]" = collections.deque()
+        self.current: "collections.deque[ty.Union[bytes, OSError]]" = (
+            collections.deque()
+        )
+        self.in_flight = 0
+        # the most bytes read ahead, for tests and benchmarks
+        self.peak = 0
+
+    def fill(self):
+        while self.in_flight < self.limit:
+            batch = next(self.batches, None)
+            if batch is None:
+                return
+            length = sum(x[2] for x in batch)
+            self.pending.append((length, self.pool.submit(_read_batch, batch)))
+            self.in_flight += length
+            self.peak = max(self.peak, self.in_flight)
+
+    def take(self) -> bytes:
+        """ Returns the next chunk, raises OSError if it was not read. """
+        if not self.current:
+            self.fill()
+            length, future = self.pending.popleft()
+            self.current.extend(future.result())
+            self.in_flight -= length
+        data = self.current.popleft()
+        if isinstance(data, OSError):
+            raise data
+        return data
+
+
+# name, mode, uid, gid, size, mtime, checksum, type, linkname, magic,
+# uname, gname, devmajor, devminor, prefix
+HEADER = struct.Struct("100s8s8s8s12s12s8s1s100s8s32s32s8s8s155s12x")
+# checksum is counted with its field filled with spaces
+CHECKSUM = slice(148, 156)
+
+
+def header(info: tarfile.TarInfo) -> ty.Optional[bytes]:
+    """
+    Packs the header of a member like TarInfo.tobuf() does in GNU format,
+    several times faster. Returns None if the member needs GNU extensions
+    (long names, big numbers), tobuf() writes them.
+    """
+    name = info.name.encode(tarfile.ENCODING, "surrogateescape")
+    if info.isdir() and not name.endswith(b"/"):
+        name += b"/"
+    linkname = info.linkname.encode(tarfile.ENCODING, "surrogateescape")
+    numbers = (info.uid, info.gid, info.size, info.mtime)
+    limits = (8**7, 8**7, 8**11, 8**11)
+    if len(name) > 100 or len(linkname) > 100:
+        return None
+    if any(not 0 <= x < limit for x, limit in zip(numbers, limits)):
+        return None
+    device = info.ischr() or info.isblk()
+    buf = bytearray(
+        HEADER.pack(
+            name,
+            b"%07o\0" % (info.mode & 0o7777),
+            b"%07o\0" % info.uid,
+            b"%07o\0" % info.gid,
+            b"%011o\0" % info.size,
+            b"%011o\0" % info.mtime,
+            b" " * 8,
+            info.type,
+            linkname,
+            tarfile.GNU_MAGIC,
+            info.uname.encode(tarfile.ENCODING, "surrogateescape"),
+            info.gname.encode(tarfile.ENCODING, "surrogateescape"),
+            b"%07o\0" % info.devmajor if device else b"",
+            b"%07o\0" % info.devminor if device else b"",
+            b"",
+        )
+    )
+    buf[CHECKSUM] = b"%06o\0 " % sum(buf)
+    return bytes(buf)
+
+
+class TarStream:
+    """ Writes entries found by the walker as a tar archive (GNU format). """
+
+    def __init__(
+        self,
+        threads: int = 8,
+        buffer: int = BUFFER,
+        cwd: ty.Optional[str] = None,
+        chunk: int = CHUNK,
+    ):
+        self.threads = threads
+        self.buffer = buffer
+        self.cwd = cwd
+        self.chunk = chunk
+        self.read_ahead: ty.Optional[ReadAhead] = None
+        self._users: ty.Dict[int, str] = {}
+        self._groups: ty.Dict[int, str] = {}
+
+    def fullpath(self, path: str) -> str:
+        return os.path.join(self.cwd, path) if self.cwd else path
+
+    def user(self, uid: int) -> str:
+        if uid not in self._users:
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._users[uid] = ""
+        return self._users[uid]
+
+    def group(self, gid: int) -> str:
+        if gid not in self._groups:
+            try:
+                self._groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._groups[gid] = ""
+        return self._groups[gid]
+
+    def tarinfos(
+        self, members: ty.Iterable[Entry]
+    ) -> ty.Iterator[ty.Tuple[tarfile.TarInfo, str]]:
+        """ Yields headers with paths of members, hard links refer to the first name. """
+        links: ty.Dict[ty.Tuple[int, int], str] = {}
+        for path, st in members:
+            # like GNU tar does
+            name = path.lstrip("/")
+            if not name:
+                continue
+            info = tarfile.TarInfo(name)
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.uid, info.gid = st.st_uid, st.st_gid
+            info.uname, info.gname = self.user(st.st_uid), self.group(st.st_gid)
+            info.mtime = int(st.st_mtime)
+            mode = st.st_mode
+            if stat.S_ISREG(mode):
+                key = (st.st_dev, st.st_ino)
+                if st.st_nlink > 1 and key in links:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = links[key]
+                else:
+                    links.setdefault(key, name)
+                    info.size = st.st_size
+            elif stat.S_ISDIR(mode):
+                info.type = tarfile.DIRTYPE
+            elif stat.S_ISLNK(mode):
+                info.type = tarfile.SYMTYPE
+                try:
+                    info.linkname = os.readlink(self.fullpath(path))
+                except OSError as e:
+                    log.warning("Failed to read link %s: %s", path, e)
+                    continue
+            elif stat.S_ISFIFO(mode):
+                info.type = tarfile.FIFOTYPE
+            elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+                info.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+                info.devmajor = os.major(st.st_rdev)
+                info.devminor = os.minor(st.st_rdev)
+            else:
+                # sockets are skipped by tar too
+                continue
+            yield info, path
+
+    def stream(self, entries: ty.Iterable[Entry]) -> ty.Iterator[bytes]:
+        """
+        Yields the archive in chunks of about CHUNK bytes. Entries are
+        (path, lstat) of every member, directories included, in the order
+        they are written (Walker.walk_sorted() with 'dirs').
+        """
+        infos = self.tarinfos(entries)
+        # members taken from the walk by the read-ahead, not written yet
+        queued: "collections.deque[ty.Tuple[tarfile.TarInfo, str]]" = (
+            collections.deque()
+        )
+        reads: "collections.deque[Read]" = collections.deque()
+
+        def advance() -> bool:
+            member = next(infos, None)
+            if member is None:
+                return False
+            queued.append(member)
+            info, path = member
+            if info.isreg():
+                reads.extend(
+                    (self.fullpath(path), offset, min(self.chunk, info.size - offset))
+                    for offset in range(0, info.size, self.chunk)
+                )
+            return True
+
+        def pending() -> ty.Iterator[Read]:
+            while reads or advance():
+                if reads:
+                    yield reads.popleft()
+
+        with ThreadPoolExecutor(self.threads, thread_name_prefix="tar") as pool:
+            self.read_ahead = ReadAhead(pool, pending(), self.buffer, self.chunk)
+            out = Output(self.chunk)
+            while queued or advance():
+                if queued:
+                    yield from out.add(self.member(*queued.popleft()))
+            # end of archive: two zero blocks, padded to a record
+            blocks = bytes(2 * BLOCK)
+            size = out.size + len(blocks)
+            yield from out.add([blocks, bytes(-size % RECORD)])
+            yield from out.flush()
+
+    def member(self, info: tarfile.TarInfo, path: str) -> ty.Iterator[bytes]:
+        """ Yields the header and the content of the member. """
+        head = header(info) or info.tobuf(
+            tarfile.GNU_FORMAT, tarfile.ENCODING, "surrogateescape"
+        )
+        if not info.isreg() or not info.size:
+            yield head
+            return
+        read_ahead = self.read_ahead
+        assert read_ahead is not None
+        chunks = range(0, info.size, self.chunk)
+        try:
+            data = read_ahead.take()
+        except OSError as e:
+            log.warning("Failed to read %s, skipped: %s", path, e)
+            for _ in chunks[1:]:
+                try:
+                    read_ahead.take()
+                except OSError:
+                    pass
+            return
+        yield head
+        changed = False
+        for i, offset in enumerate(chunks):
+            if i:
+                try:
+                    data = read_ahead.take()
+                except OSError as e:
+                    log.warning("Failed to read %s: %s", path, e)
+                    data = b""
+            length = min(self.chunk, info.size - offset)
+            if len(data) != length:
+                changed = True
+                # the header is written already, the size is kept
+                data = data[:length] + bytes(length - len(data))
+            yield data
+        if changed:
+            log.warning("%s changed while it was read, padded with zeros", path)
+        yield bytes(-info.size % BLOCK)
+
+
+class Output:
+    """ Joins small pieces, so the pipe is written by big chunks. """
+
+    def __init__(self, size: int = CHUNK):
+        self.chunk = size
+        self.parts: ty.List[bytes] = []
+        self.buffered = 0
+        # bytes of the archive so far
+        self.size = 0
+
+    def add(self, parts: ty.Iterable[bytes]) -> ty.Iterator[bytes]:
+        for part in parts:
+            self.size += len(part)
+            if len(part) >= self.chunk:
+                # a chunk of a big file is not copied
+                yield from self.flush()
+                yield part
+                continue
+            self.parts.append(part)
+            self.buffered += len(part)
+            if self.buffered >= self.chunk:
+                yield from self.flush()
+
+    def flush(self) -> ty.Iterator[bytes]:
+        if self.parts:
+            data = b"".join(self.parts)
+            self.parts, self.buffered = [], 0
+            yield data
+
+
+def zstandard_available() -> bool:
+    try:
+        import zstandard  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        return False
+    return True
+
+
+def compress(
+    chunks: ty.Iterable[bytes], threads: int, level: int = 3
+) -> ty.Iterator[bytes]:
+    """ Compresses chunks with multi-threaded zstd of the 'zstandard' package. """
+    # pylint: disable=import-outside-toplevel
+    import zstandard
+
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+    stream = compressor.compressobj()
+    for chunk in chunks:
+        data = stream.compress(chunk)
+        if data:
+            yield data
+    yield stream.flush()
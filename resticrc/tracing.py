@@ -0,0 +1,146 @@
+"""
+Spans of run phases, saved as a Chrome trace ('--profile'), which is opened
+by ui.perfetto.dev or chrome://tracing.
+
+Spans are complete events on the track of their thread, so concurrent jobs
+are separate tracks; commands are async events, they overlap within a job.
+Nothing is recorded unless the tracer is started: span() then returns
+a shared no-op object.
+"""
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import typing as ty
+
+log = logging.getLogger(__name__)
+
+
+class Tracer:
+    """ Events of this process, times are from time.perf_counter_ns(). """
+
+    def __init__(self, origin: ty.Optional[int] = None):
+        self.origin = time.perf_counter_ns() if origin is None else origin
+        self.pid = os.getpid()
+        self.events: ty.List[dict] = []
+        self.threads: ty.Dict[int, str] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _us(self, ns: int) -> float:
+        return (ns - self.origin) / 1000
+
+    def _event(self, **event) -> dict:
+        thread = threading.current_thread()
+        tid = thread.ident or 0
+        event.update(pid=self.pid, tid=tid)
+        with self._lock:
+            self.threads.setdefault(tid, thread.name)
+            self.events.append(event)
+        return event
+
+    def add(self, name: str, start: int, end: int, args: ty.Optional[dict] = None):
+        """ Adds a span of the current thread. """
+        self._event(
+            name=name,
+            cat="span",
+            ph="X",
+            ts=self._us(start),
+            dur=(end - start) / 1000,
+            args=args or {},
+        )
+
+    def add_async(self, name: str, start: int, end: int, args=None):
+        """ Adds a span that could overlap others of the thread, e.g. a command. """
+        span_id = next(self._ids)
+        common = dict(name=name, cat="command", id=span_id)
+        self._event(ph="b", ts=self._us(start), args=args or {}, **common)
+        self._event(ph="e", ts=self._us(end), **common)
+
+    def trace(self) -> dict:
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        names = [
+            dict(name="thread_name", ph="M", pid=self.pid, tid=tid, args={"name": x})
+            for tid, x in threads.items()
+        ]
+        return {"traceEvents": names + events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w") as out:
+            json.dump(self.trace(), out)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer: Tracer, name: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args["error"] = repr(exc)
+        self.tracer.add(self.name, self.start, time.perf_counter_ns(), self.args)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+NO_SPAN = _NoSpan()
+# started by --profile
+tracer: ty.Optional[Tracer] = None
+
+
+def span(name: str, **args):
+    """ Returns context manager recording time of the block, if tracing is on. """
+    current = tracer
+    if current is None:
+        return NO_SPAN
+    return Span(current, name, args)
+
+
+@contextlib.contextmanager
+def profile(
+    path,
+    origin: ty.Optional[int] = None,
+    before: ty.Iterable[ty.Tuple[str, int, int]] = (),
+):
+    """
+    Traces the block if the path is set, saves the trace there.
+    Spans 'before' (name, start, end) happened before the block, e.g. startup.
+    """
+    global tracer  # pylint: disable=global-statement
+    if not path:
+        yield None
+        return
+    tracer = Tracer(origin)
+    for name, start, end in before:
+        tracer.add(name, start, end)
+    try:
+        yield tracer
+    finally:
+        current, tracer = tracer, None
+        try:
+            current.save(path)
+        except OSError as e:
+            log.warning("Failed to save trace to %s: %s", path, e)
+        else:
+            log.info("Trace saved to %s, open it in ui.perfetto.dev", path)
@@ -0,0 +1,288 @@
+import collections
+import logging
+import os
+import queue
+import threading
+import typing as ty
+from concurrent.futures import Future, ThreadPoolExecutor
+
+if ty.TYPE_CHECKING:
+    from .filtering.matcher import ExclusionMatcher
+
+log = logging.getLogger(__name__)
+
+# paths are sent to the consumer in batches to reduce locking overhead
+BATCH_SIZE = 512
+_DONE = None
+
+# (path, item) of a listed entry, item is None for directories to descend
+Listed = ty.Tuple[str, ty.Any]
+
+
+class Walker:
+    """
+    Walks directory trees with os.scandir() in several threads,
+    skipping excluded subtrees entirely.
+
+    Yields files, symlinks and directories with nothing left inside,
+    i.e. everything restic needs to rebuild the tree from --files-from.
+    Memory usage is bounded: paths are streamed through a bounded queue,
+    only directories waiting to be listed are kept.
+    With 'stat', yields (path, lstat result) pairs, stat() calls are made
+    by the walker threads too.
+    """
+
+    def __init__(
+        self,
+        matcher: ty.Optional["ExclusionMatcher"] = None,
+        threads: int = 8,
+        cwd: ty.Optional[str] = None,
+        max_batches: int = 64,
+        stat=False,
+    ):
+        self.matcher = matcher
+        self.threads = threads
+        self.cwd = cwd
+        self.max_batches = max_batches
+        self.stat = stat
+
+    def excluded(self, path: str) -> bool:
+        return bool(self.matcher) and self.matcher.match(path)
+
+    def fullpath(self, path: str) -> str:
+        return os.path.join(self.cwd, path) if self.cwd else path
+
+    def item(self, path: str, entry: ty.Optional[os.DirEntry] = None):
+        """ Returns what is yielded for the path, None if it disappeared. """
+        if not self.stat:
+            return path
+        try:
+            if entry is not None:
+                return path, entry.stat(follow_symlinks=False)
+            return path, os.lstat(self.fullpath(path))
+        except FileNotFoundError:
+            return None
+
+    def walk(self, roots: ty.Iterable[str]) -> ty.Iterator[ty.Any]:
+        output: "queue.Queue[ty.Optional[ty.List[ty.Any]]]" = queue.Queue(
+            self.max_batches
+        )
+        state = _WalkState()
+        batch: ty.List[ty.Any] = []
+        for root in roots:
+            if self.excluded(root):
+                continue
+            full = self.fullpath(root)
+            if os.path.isdir(full) and not os.path.islink(full):
+                state.push(root)
+            else:
+                item = self.item(root)
+                if item is not None:
+                    batch.append(item)
+        if batch:
+            yield from batch
+        if not state.dirs:
+            return
+        workers = [
+            threading.Thread(
+                target=self._worker, args=(state, output), name=f"walker-{i}"
+            )
+            for i in range(self.threads)
+        ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        try:
+            finished = 0
+            while finished < len(workers):
+                item = output.get()
+                if item is _DONE:
+                    finished += 1
+                    continue
+                yield from item
+        finally:
+            state.stop()
+            for thread in workers:
+                # unblock workers waiting on the full queue
+                while thread.is_alive():
+                    try:
+                        output.get_nowait()
+                    except queue.Empty:
+                        thread.join(0.01)
+
+    def _worker(self, state: "_WalkState", output: queue.Queue):
+        batch: ty.List[ty.Any] = []
+        try:
+            while True:
+                directory = state.pop()
+                if directory is None:
+                    break
+                try:
+                    batch = self._scan(directory, state, batch, output)
+                except OSError as e:
+                    log.warning("Failed to list %s: %s", directory, e)
+                finally:
+                    state.task_done()
+            if batch:
+                output.put(batch)
+        finally:
+            output.put(_DONE)
+
+    def _scan(self, directory, state, batch, output) -> ty.List[ty.Any]:
+        """ Lists directory, returns not yet sent batch of paths. """
+        empty = True
+        with os.scandir(self.fullpath(directory)) as entries:
+            for entry in entries:
+                path = os.path.join(directory, entry.name)
+                if self.excluded(path):
+                    continue
+                empty = False
+                if entry.is_dir(follow_symlinks=False):
+                    state.push(path)
+                    continue
+                item = self.item(path, entry)
+                if item is None:
+                    continue
+                batch.append(item)
+                if len(batch) >= BATCH_SIZE:
+                    output.put(batch)
+                    batch = []
+        if empty:
+            item = self.item(directory)
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def walk_sorted(self, roots: ty.Iterable[str], dirs=False) -> ty.Iterator[ty.Any]:
+        """
+        Yields what walk() does in the order of 'tar --sort=name': entries
+        of each directory sorted by name, subdirectories walked in place.
+        Directories are listed by the threads ahead of the consumer, only
+        listings of directories on the way and of those read ahead are kept.
+        With 'dirs', every directory is yielded before its contents.
+        """
+        walked: ty.List[str] = []
+        for root in sorted(set(roots), key=lambda x: x.split("/")):
+            # a root inside another one would be yielded twice
+            if any(root.startswith(x.rstrip("/") + "/") for x in walked):
+                continue
+            walked.append(root)
+            if self.excluded(root):
+                continue
+            full = self.fullpath(root)
+            if not os.path.isdir(full) or os.path.islink(full):
+                item = self.item(root)
+                if item is not None:
+                    yield item
+                continue
+            if dirs:
+                item = self.item(root)
+                if item is None:
+                    continue
+                yield item
+            with ThreadPoolExecutor(self.threads, thread_name_prefix="walker") as pool:
+                yield from self._walk_sorted(root, pool, dirs)
+
+    def _walk_sorted(
+        self, root: str, pool: ThreadPoolExecutor, dirs: bool
+    ) -> ty.Iterator[ty.Any]:
+        # each directory on the way has up to 'threads' subdirectories listed ahead
+        ahead: ty.Dict[str, Future] = {}
+
+        def read_ahead(todo: "collections.deque[str]"):
+            if todo:
+                path = todo.popleft()
+                ahead[path] = pool.submit(self._list, path, dirs)
+
+        def listing(directory: str):
+            future = ahead.pop(directory, None) or pool.submit(
+                self._list, directory, dirs
+            )
+            try:
+                entries = future.result()
+            except OSError as e:
+                log.warning("Failed to list %s: %s", directory, e)
+                entries = []
+            todo = collections.deque(path for path, item in entries if item is None)
+            for _ in range(self.threads):
+                read_ahead(todo)
+            return iter(entries), todo
+
+        stack = [listing(root)]
+        try:
+            while stack:
+                entries, todo = stack[-1]
+                entry = next(entries, None)
+                if entry is None:
+                    stack.pop()
+                    continue
+                path, item = entry
+                if item is None:
+                    read_ahead(todo)
+                    stack.append(listing(path))
+                else:
+                    yield item
+        finally:
+            for future in ahead.values():
+                future.cancel()
+
+    def _list(self, directory: str, dirs: bool) -> ty.List[Listed]:
+        """ Lists the directory sorted by name, like _scan() does. """
+        listed: ty.List[Listed] = []
+        empty = True
+        with os.scandir(self.fullpath(directory)) as entries:
+            for entry in sorted(entries, key=lambda x: x.name):
+                path = os.path.join(directory, entry.name)
+                if self.excluded(path):
+                    continue
+                empty = False
+                if entry.is_dir(follow_symlinks=False) and not dirs:
+                    listed.append((path, None))
+                    continue
+                item = self.item(path, entry)
+                if item is None:
+                    continue
+                listed.append((path, item))
+                if entry.is_dir(follow_symlinks=False):
+                    # yielded before it is descended
+                    listed.append((path, None))
+        if empty and not dirs:
+            item = self.item(directory)
+            if item is not None:
+                listed.append((directory, item))
+        return listed
+
+
+class _WalkState:
+    """ Stack of directories to list, shared by walker threads. """
+
+    def __init__(self):
+        self.dirs: ty.List[str] = []
+        self.pending = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def push(self, directory):
+        with self.cond:
+            self.dirs.append(directory)
+            self.pending += 1
+            self.cond.notify()
+
+    def pop(self) -> ty.Optional[str]:
+        with self.cond:
+            while not self.dirs and self.pending and not self.stopped:
+                self.cond.wait()
+            if self.stopped or not self.dirs:
+                return None
+            return self.dirs.pop()
+
+    def task_done(self):
+        with self.cond:
+            self.pending -= 1
+            if not self.pending:
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
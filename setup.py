@@ -5,7 +5,10 @@ setup(
     name="resticrc",
     version="0.1.0",
     packages=find_packages(),
+    python_requires=">=3.8",
     install_requires=["click>=7.0", "attrs>=19.1.0", "pluggy>=0.12.0", "pyyaml>=5.1.2"],
+    # multi-threaded zstd in-process for 'zstd: {prefetch: true}' jobs
+    extras_require={"zstd": ["zstandard>=0.18"]},
     tests_require=["pytest>=5.1.1", "pytest-mock>=1.10.4", "pytest-cov>=2.7.1"],
     entry_points="""
         [console_scripts]
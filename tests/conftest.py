@@ -1,5 +1,4 @@
 import logging
-import glob
 import subprocess
 
 import pytest
@@ -12,13 +11,21 @@ def logger():
     logging.getLogger("resticrc").setLevel(logging.DEBUG)
 
 
+@pytest.fixture(autouse=True)
+def state(tmp_path, monkeypatch):
+    path = tmp_path / "state"
+    monkeypatch.setenv("XDG_STATE_HOME", str(path))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return path / "resticrc"
+
+
 class Helpers:
     def __init__(self, mocker):
         self.mocker = mocker
         self.exec = mocker.patch.object(executor, "run")
+        self.pipeline = mocker.patch.object(executor, "pipeline")
         self.sp_call = mocker.patch.object(subprocess, "check_call")
         self.sp_popen = mocker.patch("subprocess.Popen")
-        self.glob = mocker.patch.object(glob, "glob")
 
 
 @pytest.fixture
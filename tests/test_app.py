@@ -1,4 +1,3 @@
-import glob
 import subprocess
 
 from resticrc.models import Job, Repository
@@ -7,7 +6,6 @@ from resticrc.executor import executor
 
 
 def test_simple_job(helpers):
-    helpers.glob.return_value = ["/home"]
     job = Job(
         repo=Repository("host", path="/backups/host"),
         tags=["home"],
@@ -18,7 +16,7 @@ def test_simple_job(helpers):
     assert helpers.exec.called
     cmd_args = helpers.exec.call_args[0][0]
     command = " ".join(cmd_args)
-    assert len(cmd_args) == 11
+    assert len(cmd_args) == 12
     assert command.startswith("restic")
     assert "--repo /backups/host" in command
     assert "--tag home" in command
@@ -28,7 +26,6 @@ def test_simple_job(helpers):
 
 
 def test_glob_empty(helpers):
-    helpers.glob.return_value = []
     job = Job(
         repo=Repository("test", "/backups/test"),
         tags=["test2"],
@@ -37,24 +34,26 @@ def test_glob_empty(helpers):
     job.run()
     assert helpers.exec.called
     args = helpers.exec.call_args[0][0]
-    assert len(args) == 7
+    assert len(args) == 8
 
 
-def test_runner_glob_exclude(helpers):
-    helpers.glob.return_value = ["/home/user1/.config", "/home/user2/.config"]
+def test_runner_glob_exclude(helpers, tmp_path):
+    for user in ("user1", "user2", "user3"):
+        (tmp_path / user).mkdir()
+    for user in ("user1", "user2"):
+        (tmp_path / user / ".config").mkdir()
     job = Job(
         repo=Repository("test", "/backups/test"),
         tags=["testtag"],
-        runner=FileRunner(paths=["/home/*/.config"]),
-        exclude={"paths": ["/home/user2/.config"]},
+        runner=FileRunner(paths=[f"{tmp_path}/*/.config"]),
+        exclude={"paths": [f"{tmp_path}/user2/.config"]},
     )
-    run = job.run()
-    glob.glob.assert_called_with("/home/*/.config")
+    job.run()
     args = helpers.exec.call_args[0][0]
-    assert len(args) == 9
+    assert len(args) == 10
     command = " ".join(args)
-    assert "--exclude /home/user2/.config" in command
-    assert command.endswith("/home/user1/.config")
+    assert f"--exclude {tmp_path}/user2/.config" in command
+    assert command.endswith(f"{tmp_path}/user1/.config")
 
 
 def test_job_cmd(helpers):
@@ -64,20 +63,20 @@ def test_job_cmd(helpers):
         runner=PipedRunner(target="pg_dumpall", filename="pgdump.bin"),
     )
     job.run()
-    helpers.sp_popen.assert_called_with(
-        [
-            "restic",
-            "--repo",
-            "/backups/host",
-            "backup",
-            "--tag",
-            "postgres",
-            "--stdin",
-            "--stdin-filename",
-            "pgdump.bin",
-        ],
-        stdin=subprocess.PIPE,
-    )
+    producer, restic = helpers.pipeline.call_args[0][0]
+    assert producer == ["pg_dumpall"]
+    assert restic == [
+        "restic",
+        "--repo",
+        "/backups/host",
+        "backup",
+        "--json",
+        "--tag",
+        "postgres",
+        "--stdin",
+        "--stdin-filename",
+        "pgdump.bin",
+    ]
 
 
 def test_dry_run(mocker, capsys):
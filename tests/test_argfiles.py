@@ -0,0 +1,164 @@
+import os
+
+import pytest
+
+from resticrc.argfiles import ArgFiles, restic_safe
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+
+
+def read(path, separator="\n"):
+    with open(path) as fd:
+        return fd.read().split(separator)[:-1]
+
+
+def test_short_lists_in_argv():
+    with ArgFiles(threshold=2) as files:
+        assert files.patterns("--exclude", "--exclude-file", {"b", "a"}) == [
+            "--exclude",
+            "a",
+            "--exclude",
+            "b",
+        ]
+        assert files.paths(["/b", "/a"], "--files-from-raw") == ["/a", "/b"]
+        assert files.directory is None
+
+
+def test_long_lists_in_files():
+    patterns = ["*.log", "# not a comment", "$HOME/.cache", " spaced", "/tmp"]
+    with ArgFiles(threshold=2) as files:
+        args = files.patterns("--exclude", "--exclude-file", patterns)
+        # restic would change these patterns, they stay in argv
+        assert args[2:] == [
+            "--exclude",
+            " spaced",
+            "--exclude",
+            "# not a comment",
+            "--exclude",
+            "$HOME/.cache",
+        ]
+        assert args[0] == "--exclude-file"
+        assert read(args[1]) == ["*.log", "/tmp"]
+        paths = files.paths(["/c", "/a\nb", "-b"], "-T")
+        assert paths[0] == "-T"
+        assert read(paths[1], "\0") == ["-b", "/a\nb", "/c"]
+        directory = files.directory
+        assert oct(os.stat(directory).st_mode & 0o777) == "0o700"
+    assert not os.path.exists(directory)
+
+
+def test_negated_patterns_keep_order():
+    patterns = ["/data", "!/data/keep", "/data/keep/tmp", "*.log"]
+    with ArgFiles(threshold=2) as files:
+        args = files.patterns("--exclude", "--exclude-file", patterns)
+        assert args[0] == "--exclude-file"
+        assert read(args[1]) == patterns
+        # with a pattern that stays in argv, none goes to the file
+        args = files.patterns("--exclude", "--exclude-file", patterns + [" spaced"])
+        assert args[1::2] == patterns + [" spaced"]
+
+
+def test_restic_safe():
+    assert restic_safe("/home/*/.cache")
+    assert not restic_safe("")
+    assert not restic_safe("trailing ")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for i in range(20):
+        (tmp_path / f"{i:02}.txt").write_text(str(i))
+    return tmp_path
+
+
+@pytest.fixture
+def restic(mocker, monkeypatch):
+    """ Saves arguments and content of files they refer to. """
+    monkeypatch.setattr(executor, "dry_run", False)
+    calls = []
+
+    def run(command, **kwargs):
+        contents = {
+            x: read(x, "\0" if x.endswith("paths") else "\n")
+            for x in command
+            if os.path.isfile(x) and "resticrc-" in x
+        }
+        calls.append((command, contents))
+
+    mocker.patch.object(executor, "run", side_effect=run)
+    mocker.patch.object(executor, "pipeline", side_effect=lambda x, **kw: run(x[0]))
+    return calls
+
+
+def test_job_paths_in_file(tree, restic):
+    exclude = [f"/srv/{i}" for i in range(20)]
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([f"{tree}/*.txt"]),
+        exclude={"paths": exclude},
+    )
+    job.run()
+    command, contents = restic[0]
+    exclude_file = command[command.index("--exclude-file") + 1]
+    assert contents[exclude_file] == sorted(exclude)
+    paths_file = command[command.index("--files-from-raw") + 1]
+    assert contents[paths_file] == [str(tree / f"{i:02}.txt") for i in range(20)]
+    assert "--exclude" not in command
+    # removed after the run
+    assert not os.path.exists(paths_file)
+
+
+def test_tar_paths_in_file(tree, restic):
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([f"{tree}/*.txt"]),
+        conf={"zstd": True},
+    )
+    job.run()
+    tar, contents = restic[0]
+    assert tar[:2] == ["tar", "-c"]
+    assert tar[-4:-1] == ["--null", "--verbatim-files-from", "-T"]
+    assert len(contents[tar[-1]]) == 20
+
+
+@pytest.mark.parametrize(
+    "settings, compression, filename",
+    [
+        ({"threads": 4}, ["-I", "zstd -T4"], "/archive.tar.zst"),
+        (
+            {"threads": 4, "rsyncable": True, "sort": True},
+            ["--sort=name", "-I", "zstd -T4 --rsyncable"],
+            "/archive.tar.zst",
+        ),
+        ({"compress": False, "sort": True}, ["--sort=name"], "/archive.tar"),
+    ],
+)
+def test_tar_modes(tree, capsys, monkeypatch, settings, compression, filename):
+    monkeypatch.setattr(executor, "dry_run", True)
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([str(tree)]),
+        conf={"zstd": settings},
+    )
+    job.run()
+    tar, restic = capsys.readouterr().out.splitlines()[-2:]
+    expected = ", ".join(repr(x) for x in ["tar", "-c", *compression, str(tree)])
+    assert f"[{expected}]" in tar
+    assert restic.endswith(f"'--stdin-filename', '{filename}']")
+
+
+def test_dry_run_shows_content(tree, capsys, mocker):
+    mocker.patch.object(executor, "dry_run", True)
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([f"{tree}/*.txt"]),
+    )
+    job.run()
+    out = capsys.readouterr().out
+    assert "Contents of " in out
+    assert f"\n{tree}/19.txt\n" in out
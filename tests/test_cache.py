@@ -0,0 +1,178 @@
+import os
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from resticrc import remote
+from resticrc.cache import LOCK, WARM_UP, CacheManager, locked, using
+from resticrc.console import cli
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.parser import Parser
+from resticrc.remote import LocalTransport, Remote, connections
+from resticrc.runner import FileRunner
+
+# logs arguments, fills the cache like restic does
+RESTIC = """#!/bin/sh
+echo "$*" >> "$RESTIC_LOG"
+while [ $# -gt 0 ]; do
+    [ "$1" = "--cache-dir" ] && echo index > "$2/index"
+    shift
+done
+"""
+
+
+@pytest.fixture
+def restic(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "restic").write_text(RESTIC)
+    (bindir / "restic").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("RESTIC_LOG", str(tmp_path / "restic.log"))
+    monkeypatch.setattr(executor, "dry_run", False)
+    return tmp_path / "restic.log"
+
+
+def make_cache(path, size, used):
+    path.mkdir(parents=True)
+    (path / "data").write_bytes(bytes(size))
+    (path / LOCK).touch()
+    os.utime(path / LOCK, (used, used))
+
+
+def test_from_conf(tmp_path):
+    assert CacheManager.from_conf({}) is None
+    manager = CacheManager.from_conf({"cache": str(tmp_path)})
+    assert manager.base == tmp_path
+    assert (manager.max_size, manager.max_age, manager.warm) == (None, None, False)
+    manager = CacheManager.from_conf(
+        {"cache": {"max-size": "1G", "max-age": "2w", "warm-up": "snapshots --json"}}
+    )
+    assert manager.base.name == "restic"
+    assert (manager.max_size, manager.max_age) == (1 << 30, 14 * 86400)
+    assert manager.warm and manager.warm_up_args == ["snapshots", "--json"]
+    assert CacheManager.from_conf({"cache": {"warm-up": True}}).warm_up_args == WARM_UP
+    with pytest.raises(ValueError, match="size"):
+        CacheManager.from_conf({"cache": {"size": "1G"}})
+
+
+def test_parse_repos(tmp_path):
+    conf = {
+        "repos": {
+            "host": "/backups/host",
+            "other host": "/backups/other",
+            "offsite": {"path": "sftp:backup:/host", "cache-dir": "/var/cache/off"},
+        }
+    }
+    assert Parser(conf).repos["host"].cache_dir is None
+    repos = Parser({**conf, "cache": str(tmp_path)}).repos
+    assert os.path.dirname(repos["host"].cache_dir) == str(tmp_path)
+    assert os.path.basename(repos["other host"].cache_dir).startswith("other_host-")
+    assert repos["offsite"].cache_dir == "/var/cache/off"
+    assert repos["host"].get_args()[-2:] == ["--cache-dir", repos["host"].cache_dir]
+    assert "--cache-dir" not in repos["host"].get_args(cache=False)
+    # a new repository at the same name gets a new cache
+    moved = Parser({"repos": {"host": "/mnt/host"}, "cache": str(tmp_path)})
+    assert moved.repos["host"].cache_dir != repos["host"].cache_dir
+
+
+def test_locks(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    with using([Repository("host", "/backups/host", cache_dir=str(tmp_path))]):
+        with locked(tmp_path) as shared:
+            assert shared
+        with locked(tmp_path, exclusive=True, blocking=False) as exclusive:
+            assert not exclusive
+    with locked(tmp_path, exclusive=True, blocking=False) as exclusive:
+        assert exclusive
+
+
+def test_evict(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    now = time.time()
+    make_cache(tmp_path / "old", 1000, now - 30 * 86400)
+    make_cache(tmp_path / "lru", 3000, now - 3600)
+    make_cache(tmp_path / "busy", 3000, now - 7200)
+    make_cache(tmp_path / "new", 3000, now)
+    manager = CacheManager(tmp_path, max_size=7000, max_age=7 * 86400)
+    with locked(tmp_path / "busy"):
+        removed = manager.evict(now)
+    # the busy cache is skipped, the next one is removed instead
+    assert [x.path.name for x in removed] == ["old", "lru"]
+    assert sorted(os.listdir(tmp_path)) == ["busy", "new"]
+    assert manager.evict(now) == []
+
+
+def test_evict_dry_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", True)
+    make_cache(tmp_path / "old", 1000, 0)
+    assert len(CacheManager(tmp_path, max_age=1).evict()) == 1
+    assert os.listdir(tmp_path) == ["old"]
+
+
+def test_commands(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", True)
+    remote.register("local", LocalTransport)
+    repo = Repository("host", "/backups/host", cache_dir=str(tmp_path))
+    try:
+        for host in (None, "juno"):
+            Job(
+                repo=repo,
+                tags=["etc"],
+                runner=FileRunner(["/etc"]),
+                remote=host and Remote(host, transport="local"),
+            ).run()
+    finally:
+        connections.close()
+        del remote.TRANSPORTS["local"]
+    local, remote_run = [
+        x for x in capsys.readouterr().out.splitlines() if "backup" in x
+    ]
+    assert f"'--cache-dir', '{tmp_path}'" in local
+    # restic of remote file jobs runs on the remote host
+    assert "--cache-dir" not in remote_run
+
+
+def config(tmp_path, cache):
+    path = tmp_path / "config.yml"
+    path.write_text(
+        f"repos:\n  host: /backups/host\n  db: /backups/db\n"
+        f"cache:\n  dir: {tmp_path}/restic\n  max-age: 7d\n{cache}"
+    )
+    return str(path)
+
+
+def test_warm_up(tmp_path, restic):
+    conf = config(tmp_path, "")
+    result = CliRunner().invoke(cli, ["-c", conf, "cache", "warm-up"])
+    assert result.exit_code == 0, result.output
+    calls = sorted(restic.read_text().splitlines())
+    assert [x.split()[1] for x in calls] == ["/backups/db", "/backups/host"]
+    assert all(x.endswith(" ".join(WARM_UP)) for x in calls)
+    caches = sorted(os.listdir(tmp_path / "restic"))
+    assert [x.partition("-")[0] for x in caches] == ["db", "host"]
+    for name in caches:
+        assert (tmp_path / "restic" / name / "index").exists()
+    result = CliRunner().invoke(cli, ["-c", conf, "cache", "warm-up", "nas"])
+    assert "Unknown repositories: nas" in result.output
+
+
+def test_all(tmp_path, restic):
+    (tmp_path / "etc").mkdir()
+    job = f"jobs:\n  etc:\n    repo: host\n    path: {tmp_path}/etc\n"
+    conf = config(tmp_path, "  warm-up: snapshots\n" + job)
+    stale = tmp_path / "restic" / "removed-0123abcd"
+    make_cache(stale, 100, 0)
+    result = CliRunner().invoke(cli, ["-c", conf, "all"])
+    assert result.exit_code == 0, result.output
+    warm_up, backup = restic.read_text().splitlines()
+    # only repositories of the jobs are warmed up
+    assert warm_up.startswith("--repo /backups/host") and warm_up.endswith("snapshots")
+    assert "--cache-dir" in backup and "backup" in backup
+    assert not stale.exists()
+    restic.unlink()
+    result = CliRunner().invoke(cli, ["-c", conf, "all", "--no-warm-up"])
+    assert result.exit_code == 0, result.output
+    assert "snapshots" not in restic.read_text()
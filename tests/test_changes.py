@@ -0,0 +1,126 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from resticrc.changes import RECORD, ChangeDetector, StatIndex, detector
+from resticrc.console import cli
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for i in range(50):
+        path = root / f"d{i % 5}" / f"{i}.txt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(str(i))
+    (root / "debug.log").write_text("log")
+    return root
+
+
+@pytest.fixture
+def restic(mocker, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    monkeypatch.setattr(detector, "force", False)
+    return mocker.patch.object(executor, "run")
+
+
+@pytest.fixture
+def job(tree):
+    return Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([str(tree)]),
+        exclude={"paths": ["*.log"]},
+        conf={"skip-unchanged": True},
+    )
+
+
+def test_skip_unchanged(job, tree, restic):
+    job.run()
+    assert restic.call_count == 1
+    assert len(StatIndex.load(ChangeDetector.index_path(job.name))) == 50
+    job.run()
+    assert restic.call_count == 1
+    # excluded files are not checked
+    (tree / "debug.log").write_text("more logs")
+    job.run()
+    assert restic.call_count == 1
+    os.utime(tree / "d1" / "1.txt", ns=(1, 1))
+    job.run()
+    assert restic.call_count == 2
+    (tree / "d1" / "new.txt").write_text("new")
+    job.run()
+    job.run()
+    assert restic.call_count == 3
+
+
+def test_paths_processed_once(tree, restic):
+    (tree / "x[1].txt").write_text("brackets")
+    (tree / "x1.txt").write_text("plain")
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([f"{tree}/x[[]*"]),
+        conf={"skip-unchanged": True},
+    )
+    job.run()
+    args = restic.call_args[0][0]
+    # the expanded name is not a pattern again
+    assert str(tree / "x[1].txt") in args
+    assert str(tree / "x1.txt") not in args
+
+
+def test_failed_backup_is_not_indexed(job, restic):
+    restic.side_effect = RuntimeError("restic failed")
+    with pytest.raises(RuntimeError):
+        job.run()
+    assert not ChangeDetector.index_path(job.name).exists()
+
+
+def test_settings_change(job, restic):
+    job.run()
+    job.conf["tag"] = "other"
+    job.run()
+    assert restic.call_count == 2
+
+
+def test_changes_count(job, tree):
+    first = detector.scan(job, [str(tree)])
+    first.commit()
+    (tree / "d0" / "0.txt").write_text("changed")
+    (tree / "d0" / "5.txt").unlink()
+    (tree / "d0" / "new.txt").write_text("new")
+    scan = detector.scan(job, [str(tree)])
+    assert not scan.unchanged
+    assert scan.changes == 3
+    assert len(scan.index.records) == 50 * RECORD.size
+
+
+def test_moving_root(job, tree, tmp_path):
+    # e.g. a new snapshot directory of a dataset every run
+    for i, name in enumerate(("snap1", "snap2")):
+        (tmp_path / name).symlink_to(tree)
+        scan = detector.scan(
+            job, ["."], cwd=str(tmp_path / name), name="tree:tank", root="zfs:tank"
+        )
+        assert scan.unchanged == bool(i)
+        scan.commit()
+    assert ChangeDetector.index_path("tree:tank").exists()
+    assert not ChangeDetector.index_path("tree").exists()
+
+
+def test_force(tree, tmp_path, restic):
+    config = tmp_path / "config.yml"
+    config.write_text(
+        f"repos:\n  host: /backups/host\n"
+        f"jobs:\n  tree:\n    repo: host\n    path: {tree}\n    skip-unchanged: true\n"
+    )
+    runner = CliRunner()
+    for args in ([], [], ["--force"]):
+        result = runner.invoke(cli, ["-c", str(config), "run", "tree", *args])
+        assert result.exit_code == 0, result.exc_info
+    assert restic.call_count == 2
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from resticrc.cleanup import CleanupPlanner, parse_interval
+from resticrc.executor import executor
+from resticrc.history import History
+from resticrc.models import Job, Repository
+from resticrc.parser import Parser
+from resticrc.runner import FileRunner
+
+HOST = Repository("host", "/backups/host")
+OFFSITE = Repository("offsite", "sftp:backup:/host")
+
+
+def make_job(name, *repos):
+    return Job(repo=repos[0], repos=list(repos), tags=[name], runner=FileRunner(["/"]))
+
+
+@pytest.fixture
+def restic(mocker, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    return mocker.patch.object(executor, "run")
+
+
+def test_parse_interval():
+    assert parse_interval(None) is None
+    assert parse_interval(False) is None
+    assert parse_interval(True) == 0
+    assert parse_interval(7) == 7 * 86400
+    assert parse_interval("12h") == 12 * 3600
+    assert parse_interval("2w") == 14 * 86400
+    with pytest.raises(ValueError):
+        parse_interval("soon")
+
+
+def test_one_forget_per_repo(restic):
+    planner = CleanupPlanner(keep_daily=7)
+    planner.add(make_job("etc", HOST, OFFSITE))
+    planner.add(make_job("home", HOST))
+    assert planner.run() == {}
+    commands = sorted(x.args[0] for x in restic.call_args_list)
+    assert commands == [
+        HOST.forget_args(7, ["etc", "home"]),
+        OFFSITE.forget_args(7, ["etc"]),
+    ]
+    assert commands[0][-4:] == ["--tag", "etc", "--tag", "home"]
+
+
+def test_prune_interval(restic):
+    history = History()
+    offsite = Repository("offsite", "sftp:backup:/host", prune_after="12h")
+    planner = CleanupPlanner(prune_after="7d", history=history)
+    planner.add(make_job("etc", HOST, offsite))
+    now = time.time()
+    assert [x.prune for x in planner.plan(now)] == [True, True]
+    planner.run()
+    assert restic.call_count == 2
+    assert history.last_prune("host") is not None
+    # host is pruned weekly, offsite twice a day
+    assert [x.repo.name for x in planner.plan(now + 86400)] == ["offsite"]
+    assert len(planner.plan(now + 8 * 86400)) == 2
+    # failed prune is retried next time
+    last = history.last_prune("offsite")
+    restic.side_effect = RuntimeError("locked")
+    task = planner.plan(now + 86400)[0]
+    with pytest.raises(RuntimeError):
+        planner.execute(task)
+    assert history.last_prune("offsite") == last
+
+
+def test_repos_cleaned_concurrently(restic):
+    barrier = threading.Barrier(2, timeout=5)
+    restic.side_effect = lambda args: barrier.wait()
+    planner = CleanupPlanner(keep_daily=3)
+    planner.add(make_job("etc", HOST, OFFSITE))
+    assert planner.run() == {}
+
+
+def test_cleanup_all(restic):
+    conf = {
+        "keep-daily": 7,
+        "prune-after": 1,
+        "repos": {"host": "/backups/host", "db": {"path": "/backups/db"}},
+        "jobs": {
+            "etc": {"repo": "host", "path": "/etc"},
+            "pg": {"repo": "db", "cmd": "pg_dumpall"},
+        },
+    }
+    assert Parser(conf).cleanup_all() == {}
+    commands = [x.args[0] for x in restic.call_args_list]
+    assert len([x for x in commands if "forget" in x]) == 2
+    assert len([x for x in commands if "prune" in x]) == 2
+    restic.reset_mock()
+    Parser(conf).cleanup_all()
+    assert len([x for x in commands if "prune" in x]) == 2
+    assert all("prune" not in x.args[0] for x in restic.call_args_list)
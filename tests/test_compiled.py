@@ -0,0 +1,123 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from resticrc import compiled
+from resticrc.compiled import ConfigCache
+from resticrc.console import cli
+from resticrc.parser import Parser
+
+CONFIG = """
+repos:
+  host: /backups/host
+global:
+  repo: host
+  exclude:
+    caches: true
+jobs:
+  etc: /etc
+  home:
+    path: /home
+    exclude:
+      logs: true
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.yml"
+    path.write_text(CONFIG)
+    return path
+
+
+@pytest.fixture
+def parses(mocker):
+    return mocker.spy(Parser, "read")
+
+
+def load_parser(config, jobs=("etc", "home")):
+    """ Loads config like a command using given jobs. """
+    cache = ConfigCache(config)
+    parser = cache.get()
+    for name in jobs:
+        parser.jobs[name].exclude  # pylint: disable=pointless-statement
+    cache.update(parser)
+    return parser
+
+
+def test_cache_hit(config, parses):
+    parser = load_parser(config)
+    assert parses.call_count == 1
+    assert ConfigCache(config).path.exists()
+    cached = load_parser(config)
+    assert parses.call_count == 1
+    assert cached.jobs == parser.jobs
+    assert cached.repos == parser.repos
+    # exclusions are already processed
+    assert cached.jobs["home"]._exclude_processed is not None
+    assert cached.jobs["home"].exclude.exclude == parser.jobs["home"].exclude.exclude
+    assert "*.log" in cached.jobs["home"].exclude.exclude
+    assert cached.path == config.absolute()
+
+
+def test_cache_invalidation(config, parses):
+    load_parser(config)
+    # touched, but not changed
+    os.utime(config, ns=(1, 1))
+    load_parser(config)
+    assert parses.call_count == 1
+    config.write_text(CONFIG.replace("/etc", "/usr/local/etc"))
+    parser = load_parser(config)
+    assert parses.call_count == 2
+    assert parser.jobs["etc"].runner.paths == ["/usr/local/etc"]
+
+
+def test_cache_other_version(config, parses, monkeypatch):
+    load_parser(config)
+    monkeypatch.setattr(compiled, "__version__", "100.0")
+    load_parser(config)
+    assert parses.call_count == 2
+
+
+def test_broken_cache(config, parses):
+    cache = ConfigCache(config)
+    cache.path.parent.mkdir(parents=True)
+    cache.path.write_bytes(b"garbage")
+    assert load_parser(config).jobs
+    assert parses.call_count == 1
+
+
+def test_jobs_compiled_on_use(config, mocker):
+    parser = load_parser(config, jobs=["home"])
+    assert set(parser.jobs.parsed()) == {"home"}
+    parse_job = mocker.spy(Parser, "parse_job")
+    parser = load_parser(config, jobs=["home"])
+    assert not parse_job.called
+    assert set(parser.jobs.parsed()) == {"home"}
+    # other job is parsed once and added to the cache
+    load_parser(config, jobs=["etc"])
+    load_parser(config, jobs=["etc"])
+    assert parse_job.call_count == 1
+    assert set(ConfigCache(config).get().jobs.parsed()) == {"etc", "home"}
+
+
+def test_cli_compiles_used_job(config):
+    args = ["-c", str(config), "run", "-n", "etc"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert set(ConfigCache(config).get().jobs.parsed()) == {"etc"}
+
+
+def test_no_cache(config, parses):
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-c", str(config), "--no-cache", "stats"])
+    assert result.exit_code == 0
+    assert not ConfigCache(config).path.exists()
+
+
+def test_compile_command(config):
+    result = CliRunner().invoke(cli, ["-c", str(config), "config", "compile"])
+    assert result.exit_code == 0
+    assert str(ConfigCache(config).path) in result.output
+    assert set(ConfigCache(config).get().jobs.parsed()) == {"etc", "home"}
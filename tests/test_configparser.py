@@ -1,5 +1,7 @@
+import pytest
+
 from resticrc.models import Repository, Job
-from resticrc.runner import FileRunner, PipedRunner
+from resticrc.runner import FileRunner, ItemsRunner, PipedRunner
 from resticrc.parser import Parser
 
 
@@ -28,6 +30,27 @@ def test_repo_password_file():
     )
 
 
+def test_repo_concurrency():
+    conf = dict(repos=dict(host={"path": "/backups/host", "concurrency": 2}))
+    repos = LazyParser(conf).parse_repos()
+    assert repos["host"].concurrency == 2
+    conf["repos"]["host"]["concurrency"] = 0
+    with pytest.raises(ValueError, match="concurrency"):
+        LazyParser(conf).parse_repos()
+    with pytest.raises(ValueError, match="workers"):
+        Parser({"workers": 0, "repos": {"host": "/backups/host"}})
+
+
+def test_job_after():
+    parser = LazyParser(
+        dict(jobs={"home": {"repo": "host", "path": "/home", "after": "etc"}})
+    )
+    parser.repos = {"host": Repository("host", path="/backups/host")}
+    job = parser.parse_jobs()["home"]
+    assert job.after == ["etc"]
+    assert "after" not in job.conf
+
+
 def test_job_parser():
     parser = LazyParser(
         dict(jobs={"testjob": {"repo": "testrepo", "paths": ["/var/lib/test"]}})
@@ -51,7 +74,46 @@ def test_job_cmd():
     parser = LazyParser(dict(jobs=jobs))
     parser.repos = {"db": None}
     job = parser.parse_jobs()["postgres"]
-    assert job.runner.target == "sudo -u postgres pg_dumpall"
+    assert job.runner.target == ["sudo", "-u", "postgres", "pg_dumpall"]
+
+
+def test_job_items():
+    jobs = {
+        "databases": {
+            "repo": "db",
+            "cmd": "pg_dump -d '{item}'",
+            "items": ["app", "wiki"],
+            "items-cmd": ["psql", "-Atc", "select datname from pg_database"],
+            "parallel": 2,
+        },
+        "broken": {"repo": "db", "cmd": "pg_dumpall", "items": ["app"]},
+    }
+    parser = LazyParser(dict(jobs=jobs))
+    parser.repos = {"db": None}
+    runner = parser.parse_job("databases", jobs["databases"]).runner
+    assert runner == ItemsRunner(
+        target=["pg_dump", "-d", "{item}"],
+        items=["app", "wiki"],
+        discover=["psql", "-Atc", "select datname from pg_database"],
+        filename="{item}",
+        workers=2,
+    )
+    with pytest.raises(ValueError, match="should contain"):
+        parser.parse_job("broken", jobs["broken"])
+
+
+def test_job_repos():
+    jobs = {"etc": {"repo": ["host", "offsite"], "path": "/etc"}, "home": "/home"}
+    parser = LazyParser(dict(jobs=jobs, **{"global": {"repo": "host"}}))
+    parser.repos = {
+        "host": Repository("host", path="/backups/host"),
+        "offsite": Repository("offsite", path="sftp:backup:/host"),
+    }
+    parser.global_settings = parser.conf["global"]
+    jobs = parser.parse_jobs()
+    assert jobs["etc"].repo == parser.repos["host"]
+    assert [x.name for x in jobs["etc"].repos] == ["host", "offsite"]
+    assert jobs["home"].repos == [parser.repos["host"]]
 
 
 def test_parser_full():
@@ -99,3 +161,30 @@ def test_exclude():
     assert result["paths"] == [conf]
     result = parser.parse_exclude([conf])
     assert result["paths"] == [conf]
+
+
+def test_exclude_aliases():
+    conf = {
+        "repos": {"host": "/backups/host"},
+        "global": {"repo": "host", "ignore": {"logs": True}},
+        "jobs": {
+            "home": {
+                "path": "/home",
+                "skip": [{"larger": "500M", "caches": True}, "igor/Data/Media"],
+                "exclude": ["share"],
+            },
+            "data": {"path": "/data", "skip": "vms"},
+        },
+    }
+    parser = Parser(conf)
+    home = parser.jobs["home"]
+    assert dict(home.exclude) == {
+        "larger": "500M",
+        "caches": True,
+        "logs": True,
+        "paths": ["share", "igor/Data/Media"],
+    }
+    assert home.exclude.larger == 500 * 1024**2
+    assert "--exclude-larger-than" in home.exclude.as_args()
+    assert parser.jobs["data"].exclude["paths"] == ["vms"]
+    assert parser.jobs["data"].exclude.larger is None
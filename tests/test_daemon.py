@@ -0,0 +1,245 @@
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pytest
+
+from resticrc import daemon
+from resticrc.cron import Cron
+from resticrc.daemon import IDLE, QUEUED, WAITING, Daemon, request
+from resticrc.models import Repository
+from resticrc.parser import Parser
+from resticrc.scheduler import CANCELLED, DONE, JobResult
+from resticrc.state import DurationStore
+
+CONFIG = """
+repos:
+  host: /backups/host
+  media: {path: /backups/media, concurrency: 2}
+global:
+  repo: host
+jobs:
+  etc:
+    path: /etc
+    schedule: "30 2 * * *"
+  home:
+    path: /home
+    schedule: "@hourly"
+  music:
+    path: /music
+    repo: media
+"""
+
+
+def test_cron():
+    now = datetime.datetime(2026, 10, 17, 3, 0, 20)  # Saturday
+    assert Cron.parse("30 2 * * *").next(now) == datetime.datetime(2026, 10, 18, 2, 30)
+    workdays = Cron.parse("*/15 8-18 * * mon-fri")
+    assert workdays.next(now) == datetime.datetime(2026, 10, 19, 8, 0)
+    assert workdays.next(datetime.datetime(2026, 10, 19, 8, 0)) == (
+        datetime.datetime(2026, 10, 19, 8, 15)
+    )
+    # either the day or the weekday, like cron does
+    assert Cron.parse("0 0 1 * sun").next(now) == datetime.datetime(2026, 10, 18)
+    assert Cron.parse("@monthly").next(now) == datetime.datetime(2026, 11, 1)
+    assert Cron.parse("0 0 * * 7") == Cron.parse(" 0  0 * * 7")
+    # February 29 is found in a leap year
+    assert Cron.parse("0 0 29 2 *").next(now) == datetime.datetime(2028, 2, 29)
+    schedules = ["* * *", "61 * * * *", "*/0 * * * *", "5-1 * * * *"]
+    # never matches, e.g. the 31st of February
+    for invalid in schedules + ["0 0 31 2,4 *"]:
+        with pytest.raises(ValueError, match="Invalid schedule"):
+            Cron.parse(invalid)
+
+
+def test_parse_schedule(tmp_path):
+    parser = Parser(write_config(tmp_path, CONFIG))
+    assert str(parser.jobs["etc"].schedule) == "30 2 * * *"
+    assert parser.jobs["music"].schedule is None
+    assert "schedule" not in parser.jobs["etc"].conf
+    conf = {"repos": {"host": "/h"}, "jobs": {"bad": {"repo": "host", "schedule": 1}}}
+    with pytest.raises(ValueError, match="bad"):
+        Parser(conf).jobs["bad"]  # pylint: disable=expression-not-assigned
+
+
+def write_config(tmp_path, text):
+    path = tmp_path / "config.yml"
+    path.write_text(text)
+    return path
+
+
+def make_daemon(tmp_path, text=CONFIG, **kwargs):
+    path = write_config(tmp_path, text)
+    return Daemon(
+        path,
+        partial(Parser, path),
+        control_socket=tmp_path / "control.sock",
+        durations=DurationStore(tmp_path / "durations.json"),
+        **kwargs,
+    )
+
+
+def test_reload_changed_jobs(tmp_path):
+    server = make_daemon(tmp_path)
+    assert server.reload() == ["etc", "home", "music"]
+    assert server.reload() == []
+    jobs = {name: x.job for name, x in server.jobs.items()}
+    next_run = server.jobs["etc"].next_run
+    assert next_run.time() == datetime.time(2, 30)
+
+    text = CONFIG.replace("path: /home", "path: /srv/home").replace(
+        "concurrency: 2", "concurrency: 3"
+    )
+    write_config(tmp_path, text)
+    assert server.reload() == ["home", "music"]
+    assert server.jobs["etc"].job is jobs["etc"]
+    assert server.jobs["etc"].next_run == next_run
+    assert server.jobs["home"].job.runner.paths == ["/srv/home"]
+    assert server.concurrency(Repository("media", "/old", concurrency=2)) == 3
+
+    # broken jobs keep the previous version
+    write_config(tmp_path, text.replace('"30 2 * * *"', "never") + "  usr: /usr\n")
+    assert server.reload() == ["usr"]
+    assert server.jobs["etc"].job is jobs["etc"]
+
+    write_config(tmp_path, "repos: {host: /h}\njobs: {etc: {repo: host, path: /x}}")
+    assert server.reload() == ["etc"]
+    assert list(server.jobs) == ["etc"]
+    assert server.jobs["etc"].next_run is None
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """ Replaces job execution, jobs wait until the event is set. """
+    record = {"started": [], "running": {}, "max": {}}
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def run_job(name, job):
+        repo = job.repo.name
+        with lock:
+            record["started"].append(name)
+            record["running"][repo] = record["running"].get(repo, 0) + 1
+            record["max"][repo] = max(
+                record["max"].get(repo, 0), record["running"][repo]
+            )
+        release.wait(5)
+        with lock:
+            record["running"][repo] -= 1
+        return JobResult(name, DONE, 0.1)
+
+    monkeypatch.setattr(daemon, "run_job", run_job)
+    record["release"] = release
+    return record
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def answers(path) -> bool:
+    # the socket file exists between bind() and listen() already
+    try:
+        request(path, "status")
+    except OSError:
+        return False
+    return True
+
+
+def test_tick(tmp_path, runs):
+    server = make_daemon(tmp_path)
+    server.reload()
+    server.pool = ThreadPoolExecutor(4)
+    due = server.jobs["home"].next_run
+    assert server.tick(due - datetime.timedelta(seconds=1)) == due
+    assert runs["started"] == []
+    server.tick(due)
+    wait_for(lambda: runs["started"] == ["home"])
+    # the next run was planned, a job is not started while it is running
+    assert server.jobs["home"].next_run == due + datetime.timedelta(hours=1)
+    assert not server.start("home")
+    runs["release"].set()
+    server.pool.shutdown(wait=True)
+    assert server.jobs["home"].status == IDLE
+    assert server.jobs["home"].last.ok
+    assert server.durations.get("home") == 0.1
+
+
+def test_after(tmp_path, runs):
+    text = CONFIG + "  media:\n    path: /media\n    after: [music, etc]\n"
+    server = make_daemon(tmp_path, text)
+    server.reload()
+    server.pool = ThreadPoolExecutor(4)
+    # dependencies never ran
+    assert not server.start("media")
+    assert server.jobs["media"].last.status == CANCELLED
+    server.jobs["etc"].last = JobResult("etc", DONE)
+    assert server.start("music")
+    wait_for(lambda: runs["started"] == ["music"])
+    assert server.start("media")
+    assert server.jobs["media"].status == WAITING
+    # started when the dependency finishes
+    runs["release"].set()
+    wait_for(lambda: runs["started"] == ["music", "media"])
+    server.pool.shutdown(wait=True)
+    assert server.jobs["media"].last.ok
+
+
+def test_busy_repository(tmp_path, runs):
+    server = make_daemon(tmp_path, workers=2)
+    server.reload()
+    server.pool = ThreadPoolExecutor(2)
+    for name in ("etc", "home", "music"):
+        assert server.start(name)
+    # 'home' waits for the repository without taking the other worker
+    wait_for(lambda: sorted(runs["started"]) == ["etc", "music"])
+    assert server.jobs["home"].status == QUEUED
+    runs["release"].set()
+    wait_for(lambda: len(runs["started"]) == 3)
+    wait_for(lambda: all(x.status == IDLE for x in server.jobs.values()))
+    server.pool.shutdown(wait=True)
+    assert runs["max"] == {"host": 1, "media": 1}
+
+
+def test_control_socket(tmp_path, runs):
+    server = make_daemon(tmp_path, workers=4, reload_interval=0.05)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    try:
+        wait_for(lambda: answers(server.socket))
+        for name in ("etc", "home", "music"):
+            assert request(server.socket, "run", job=name) == {
+                "ok": True,
+                "started": True,
+            }
+        assert request(server.socket, "run", job="etc")["started"] is False
+        assert request(server.socket, "run", job="usr") == {
+            "ok": False,
+            "error": "Unknown job 'usr'",
+        }
+        wait_for(lambda: len(runs["started"]) == 2)
+        jobs = {x["job"]: x for x in request(server.socket, "status")["jobs"]}
+        # jobs of the same repository wait for each other
+        assert sorted(x["status"] for x in jobs.values()) == [
+            "queued",
+            "running",
+            "running",
+        ]
+        assert jobs["music"]["status"] == "running"
+        assert jobs["home"]["schedule"] == "@hourly"
+        runs["release"].set()
+        wait_for(lambda: len(runs["started"]) == 3)
+        wait_for(lambda: all(x.status == IDLE for x in server.jobs.values()))
+        (status,) = request(server.socket, "status", job="etc")["jobs"]
+        assert status["last"]["status"] == DONE
+        assert runs["max"] == {"host": 1, "media": 1}
+    finally:
+        server.stop()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert not server.socket.exists()
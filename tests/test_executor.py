@@ -0,0 +1,143 @@
+import subprocess
+import threading
+import time
+
+import pytest
+
+from resticrc.executor import ConsoleExecutor, OutputBuffer
+
+
+@pytest.fixture
+def executor():
+    return ConsoleExecutor(grace_period=1)
+
+
+def test_run_capture(executor):
+    output = OutputBuffer(name="job", echo=False)
+    with executor.capture(output):
+        result = executor.run(["sh", "-c", "echo out; echo err >&2"])
+    assert result.returncodes == [0]
+    assert output.text("stdout") == "out\n"
+    assert output.text("stderr") == "err\n"
+
+
+def test_worker_threads(executor):
+    # jobs, datasets and items run commands from threads of their pools,
+    # child processes must be reaped there too (not only in the main thread)
+    results = []
+
+    def run(i):
+        results.append(executor.pipeline([["echo", str(i)], ["cat"]], timeout=10))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=20)
+    assert [x.returncodes for x in results] == [[0, 0]] * 8
+
+
+def test_output_limit():
+    output = OutputBuffer(limit=10, echo=False)
+    for i in range(10):
+        output.append("stdout", b"line %d\n" % i)
+    assert output.text() == "line 9\n"
+
+
+def test_failure(executor):
+    output = OutputBuffer(echo=False)
+    with executor.capture(output), pytest.raises(subprocess.CalledProcessError) as e:
+        executor.run(["sh", "-c", "echo fatal >&2; exit 3"])
+    assert e.value.returncode == 3
+    assert e.value.stderr == "fatal\n"
+
+
+def test_pipeline_stdin(executor):
+    output = OutputBuffer(echo=False)
+    chunks = (b"%d\n" % i for i in range(1000))
+    with executor.capture(output):
+        result = executor.pipeline([["cat"], ["wc", "-l"]], stdin=chunks)
+    assert int(output.text("stdout")) == 1000
+    assert result.fed == 1000
+
+
+def test_pipeline_reports_consumer(executor):
+    # producer is killed by SIGPIPE, but the real error is in consumer
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        executor.pipeline([["yes"], ["sh", "-c", "head -n1 >/dev/null; exit 2"]])
+    assert e.value.returncode == 2
+
+
+def test_fanout(executor):
+    lines = [[], []]
+    result = executor.fanout(
+        ["seq", "100000"],
+        [["wc", "-l"], ["sh", "-c", "sleep 0.1; wc -l"]],
+        on_output=[x.append for x in lines],
+        pump={"buffer": 4096, "queue": 1},
+    )
+    assert result.returncodes == [0, 0, 0]
+    assert lines == [[b"100000\n"], [b"100000\n"]]
+    assert result.stats[0].bytes == len("".join(f"{i}\n" for i in range(1, 100001)))
+
+
+def test_fanout_stdin(executor):
+    output = OutputBuffer(echo=False)
+    chunks = (b"%d\n" % i for i in range(1000))
+    with executor.capture(output):
+        result = executor.fanout(None, [["wc", "-l"], ["wc", "-l"]], stdin=chunks)
+    assert output.text("stdout") == "1000\n1000\n"
+    assert result.fed == 1000
+
+
+def test_fanout_failed_consumer(executor):
+    lines = []
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        executor.fanout(
+            ["seq", "100000"],
+            [["sh", "-c", "exit 4"], ["wc", "-l"]],
+            on_output=[None, lines.append],
+        )
+    assert e.value.returncode == 4
+    # the other consumer gets the whole stream
+    assert lines == [b"100000\n"]
+    result = executor.fanout(
+        ["seq", "10"], [["sh", "-c", "exit 4"], ["cat"]], check=False
+    )
+    assert result.returncodes[1:] == [4, 0]
+
+
+def test_timeout(executor):
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        executor.pipeline([["sleep", "10"], ["cat"]], timeout=0.2)
+    assert time.monotonic() - start < 5
+    assert not executor._pids
+
+
+def test_shutdown(executor):
+    thread_errors = []
+
+    def target():
+        try:
+            executor.run(["sleep", "10"])
+        except subprocess.CalledProcessError as e:
+            thread_errors.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    while not executor._pids:
+        time.sleep(0.01)
+    executor.shutdown()
+    thread.join()
+    assert thread_errors[0].returncode < 0
+    with pytest.raises(RuntimeError):
+        executor.run(["true"])
+
+
+def test_dry_run(executor, capsys):
+    executor.dry_run = True
+    executor.pipeline([["tar", "-c", "/etc"], ["restic", "backup", "--stdin"]])
+    out = capsys.readouterr().out
+    assert "Executing: ['tar', '-c', '/etc']" in out
+    assert "Executing: ['restic', 'backup', '--stdin']" in out
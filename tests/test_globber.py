@@ -0,0 +1,129 @@
+import glob
+import os
+
+import pytest
+
+from resticrc.commands import unglob
+from resticrc.globber import DENIED, MISSING, NOTHING, WIDE, Globber
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for path in [
+        "home/alice/.config/app/settings.ini",
+        "home/alice/docs/a.txt",
+        "home/alice/docs/b.md",
+        "home/bob/.config/app/settings.ini",
+        "home/bob/docs/deep/c.txt",
+        "home/bob/.hidden/d.txt",
+        "srv/www/index.html",
+    ]:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+    (root / "home" / "carol").mkdir()
+    (root / "srv" / "link").symlink_to(root / "home")
+    return root
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "home/*/.config",
+        "home/*/docs/*.txt",
+        "home/*/docs/**",
+        "home/**/*.txt",
+        "home/*/.config/**/*.ini",
+        "srv/*",
+        "home/[ab]*",
+        "home/?ob/docs",
+        "srv/www/index.html",
+        "home/*/",
+        "home/*/docs/*/",
+        "srv/*/",
+        "srv/www/",
+        "srv/www/index.html/",
+        "home/**/",
+    ],
+)
+def test_same_as_glob(tree, pattern):
+    expected = set(glob.glob(f"{tree}/{pattern}", recursive=True))
+    if not pattern.endswith("/"):
+        # glob adds '/' to directories matched by trailing '**'
+        expected = {x.rstrip("/") for x in expected}
+    found = set(Globber(threads=4).expand([f"{tree}/{pattern}"]))
+    assert found == expected
+
+
+def test_wide_level(tmp_path):
+    for i in range(WIDE * 2):
+        (tmp_path / f"d{i:03}" / "sub").mkdir(parents=True)
+        (tmp_path / f"d{i:03}" / "file").touch()
+    pattern = f"{tmp_path}/*/*"
+    found = list(Globber(threads=4).expand([pattern]))
+    # chunks of directories are yielded in order of the serial expansion
+    assert found == list(Globber(threads=1).expand([pattern]))
+    assert sorted(found) == sorted(glob.glob(pattern))
+
+
+def test_directories_listed_once(tree):
+    globber = Globber(threads=4)
+    patterns = [f"{tree}/home/*/d*", f"{tree}/home/*/.c*", f"{tree}/home/*"]
+    found = list(globber.expand(patterns))
+    assert len(found) == len(set(found)) == 2 + 2 + 3
+    # home and every user directory
+    assert globber.listed == 4
+    # listings are not kept after the expansion, they could be stale
+    (tree / "home" / "dave").mkdir()
+    assert f"{tree}/home/dave" in globber.expand([f"{tree}/home/*"])
+    assert globber.listed == 4 + 1
+
+
+def test_relative(tree):
+    expansion = Globber().expand(["home/*/docs/*.md", "srv"], cwd=str(tree))
+    assert sorted(expansion) == ["home/alice/docs/b.md", "srv"]
+
+
+def test_unmatched(tree):
+    expansion = Globber().expand(
+        [f"{tree}/home/*/docs", f"{tree}/nothing/*", f"{tree}/home/*/*.iso"]
+    )
+    assert len(list(expansion)) == 2
+    assert expansion.unmatched == {
+        f"{tree}/nothing/*": f"{MISSING}: {tree}/nothing",
+        f"{tree}/home/*/*.iso": NOTHING,
+    }
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason="root can list anything")
+def test_permission_denied(tree):
+    locked = tree / "home" / "carol"
+    locked.chmod(0)
+    try:
+        expansion = Globber().expand([f"{tree}/home/carol/*"])
+        assert not list(expansion)
+        assert expansion.unmatched[f"{tree}/home/carol/*"].startswith(DENIED)
+    finally:
+        locked.chmod(0o755)
+
+
+def test_symlinks_not_followed(tree):
+    found = Globber().expand([f"{tree}/srv/**"])
+    srv = tree / "srv"
+    assert {os.path.relpath(x, srv) for x in found} == {
+        ".",
+        "link",
+        "www",
+        "www/index.html",
+    }
+
+
+def test_early_close(tree):
+    stream = iter(Globber(threads=2).expand([f"{tree}/**"]))
+    assert next(stream)
+    stream.close()
+
+
+def test_unglob_keeps_unmatched(tree):
+    paths = list(unglob([f"{tree}/srv/*", f"{tree}/missing"]))
+    assert sorted(paths) == [f"{tree}/missing", f"{tree}/srv/link", f"{tree}/srv/www"]
@@ -0,0 +1,120 @@
+import json
+import os
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from resticrc.commands import BackupStatus
+from resticrc.console import cli
+from resticrc.executor import executor
+from resticrc.history import History
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+
+SUMMARY = {
+    "message_type": "summary",
+    "files_new": 3,
+    "files_changed": 1,
+    "files_unmodified": 10,
+    "dirs_new": 0,
+    "dirs_changed": 1,
+    "dirs_unmodified": 2,
+    "data_added": 2048,
+    "total_files_processed": 14,
+    "total_bytes_processed": 100000,
+    "total_duration": 1.5,
+    "snapshot_id": "0123456789abcdef",
+}
+
+
+@pytest.fixture
+def fake_restic(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    restic = bindir / "restic"
+    lines = [
+        {"message_type": "status", "percent_done": 0.5, "files_done": 7},
+        SUMMARY,
+    ]
+    script = "\n".join(f"echo '{json.dumps(x)}'" for x in lines)
+    restic.write_text(f"#!/bin/sh\necho 'not a json'\n{script}\n")
+    restic.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(executor, "dry_run", False)
+    return restic
+
+
+def test_backup_status(capsys):
+    status = BackupStatus("etc")
+    status(b'{"message_type": "status", "percent_done": 0.1}\n')
+    status(b'{"message_type": "error", "item": "/etc/shadow", "error": {}}\n')
+    status(json.dumps(SUMMARY).encode())
+    status(b"warning\n")
+    assert status.summary == SUMMARY
+    assert capsys.readouterr().out == "warning\n"
+    assert "3 new, 1 changed, 10 unmodified" in status.describe(SUMMARY)
+
+
+def test_job_recorded(fake_restic, tmp_path):
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["etc"],
+        runner=FileRunner([str(tmp_path)]),
+    )
+    job.run()
+    runs = History().runs("etc")
+    assert len(runs) == 1
+    assert runs[0]["snapshot_id"] == SUMMARY["snapshot_id"]
+    assert runs[0]["data_added"] == 2048
+    assert runs[0]["repo"] == "host"
+    assert runs[0]["status"] == 0
+
+
+def test_multiple_repos(fake_restic, tmp_path):
+    # restic saves the list of files it got from the pre-walk
+    fake_restic.write_text(f"#!/bin/sh\ncat > \"$2\"\necho '{json.dumps(SUMMARY)}'\n")
+    tree = tmp_path / "tree"
+    for i in range(100):
+        (tree / str(i % 7)).mkdir(parents=True, exist_ok=True)
+        (tree / str(i % 7) / f"{i}.txt").write_text("data")
+    repos = [Repository(x, str(tmp_path / x)) for x in ("host", "offsite")]
+    job = Job(repo=repos[0], repos=repos, tags=["tree"], runner=FileRunner([str(tree)]))
+    job.run()
+    host, offsite = [(tmp_path / x).read_bytes() for x in ("host", "offsite")]
+    assert host == offsite
+    assert len(host.split(b"\0")) == 101
+    assert sorted(x["repo"] for x in History().runs("tree")) == ["host", "offsite"]
+
+
+def test_regressions(tmp_path):
+    history = History(tmp_path / "history.sqlite")
+    now = time.time()
+    for i, duration in enumerate([10, 11, 9, 10, 25]):
+        history.record("home", "host", now + i, duration, summary={"snapshot_id": i})
+    for i, duration in enumerate([5, 5, 5, 6]):
+        history.record("etc", "host", now + i, duration, summary={"snapshot_id": i})
+    history.record("etc", "host", now + 10, 1, status=1)
+    stats = {x.job: x for x in history.stats()}
+    assert stats["home"].median_duration == 10
+    assert stats["etc"].failures == 1
+    assert stats["home"].slowdown == 2.5
+    regressions = history.regressions()
+    assert [(x.job, median) for x, median in regressions] == [("home", 10)]
+
+
+def test_stats_command(tmp_path):
+    config = tmp_path / "config.yml"
+    config.write_text("repos:\n  host: /backups/host\n")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-c", str(config), "stats"])
+    assert result.output == "No backups recorded yet.\n"
+    history = History()
+    for i, duration in enumerate([10, 10, 10, 30]):
+        history.record("home", "host", i, duration, summary={"snapshot_id": i})
+    result = runner.invoke(cli, ["-c", str(config), "stats"])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert lines[0].startswith("JOB")
+    assert lines[1].startswith("home")
+    assert lines[2] == "Regression: home took 30.0s, usually 10.0s"
@@ -0,0 +1,91 @@
+import json
+import os
+
+import pytest
+
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.runner import ItemsRunner
+
+# saves stdin as $RESTIC_OUT/<stdin-filename>, logs arguments and
+# the number of restics running at the same time
+RESTIC = """#!/bin/sh
+touch "$RESTIC_RUNNING/$$"
+echo "$(ls "$RESTIC_RUNNING" | wc -l) $*" >> "$RESTIC_LOG"
+while [ $# -gt 0 ]; do
+    [ "$1" = "--stdin-filename" ] && name="$2"
+    shift
+done
+cat > "$RESTIC_OUT/$name"
+sleep 0.2
+rm "$RESTIC_RUNNING/$$"
+[ "$name" = "broken" ] && exit 1
+echo '{summary}'
+"""
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    summary = json.dumps({"message_type": "summary", "snapshot_id": "0123"})
+    (bindir / "restic").write_text(RESTIC.format(summary=summary))
+    (bindir / "restic").chmod(0o755)
+    for name in ("running", "out"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("RESTIC_LOG", str(tmp_path / "restic.log"))
+    monkeypatch.setenv("RESTIC_RUNNING", str(tmp_path / "running"))
+    monkeypatch.setenv("RESTIC_OUT", str(tmp_path / "out"))
+    monkeypatch.setattr(executor, "dry_run", False)
+    monkeypatch.setattr("resticrc.commands.Restic.record", lambda *args: None)
+    return tmp_path
+
+
+def restic_calls(stub):
+    lines = (stub / "restic.log").read_text().splitlines()
+    return [(int(x.split()[0]), x.partition(" ")[2]) for x in lines]
+
+
+def make_job(runner):
+    return Job(repo=Repository("db", "/backups/db"), tags=["dump"], runner=runner)
+
+
+def test_items(stub):
+    runner = ItemsRunner(
+        target=["printf", "%s dump", "{item}"],
+        items=["app", "wiki"],
+        # discovered items are added to the listed ones
+        discover="printf 'wiki\\nmail box\\n\\nlogs\\n'",
+        filename="{item}.sql",
+        workers=2,
+    )
+    make_job(runner).run()
+    out = stub / "out"
+    assert sorted(os.listdir(out)) == [
+        f"{x}.sql" for x in ("app", "logs", "mail box", "wiki")
+    ]
+    # arguments are passed as is, without a shell
+    assert (out / "mail box.sql").read_text() == "mail box dump"
+    calls = restic_calls(stub)
+    assert max(x for x, _ in calls) <= 2
+    for item in ("app", "logs", "mail box", "wiki"):
+        suffix = f"--tag item:{item} --group-by host,tags --stdin --stdin-filename"
+        assert [x for _, x in calls if x.endswith(f"{suffix} {item}.sql")]
+
+
+def test_failed_item(stub):
+    runner = ItemsRunner(target=["echo", "{item}"], items=["broken", "ok"])
+    with pytest.raises(Exception):
+        make_job(runner).run()
+    # other items are backed up anyway
+    assert sorted(os.listdir(stub / "out")) == ["broken", "ok"]
+
+
+def test_dry_run(capsys, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", True)
+    runner = ItemsRunner(target="pg_dump {item}", discover="psql -Atc 'select 1'")
+    make_job(runner).run()
+    out = capsys.readouterr().out
+    assert "'psql', '-Atc', 'select 1'" in out
+    assert "'pg_dump', '{item}'" in out
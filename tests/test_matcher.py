@@ -0,0 +1,89 @@
+import pytest
+
+from resticrc.commands import exclude_paths
+from resticrc.filtering.matcher import ExclusionMatcher
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+
+
+@pytest.mark.parametrize(
+    "pattern,path,expected",
+    [
+        ("/home/user/share", "/home/user/share", True),
+        ("/home/user/share", "/home/user/share/docs/a.txt", True),
+        ("/home/user", "/home/user2", False),
+        ("/var", "/home/var", False),
+        (".cache", "/home/user/.cache", True),
+        (".cache", "/home/user/.cache/pip/x", True),
+        (".cache", "/home/user/.cached", False),
+        ("*.log", "/var/log/syslog.log", True),
+        ("*.log", "/var/log/syslog", False),
+        (".config/*/Cache", "/home/u/.config/Code/Cache", True),
+        (".config/*/Cache", "/home/u/.config/Code/User/Cache", False),
+        ("/home/*/go", "/home/user/go/pkg", True),
+        ("/home/*/go", "/srv/home/user/go", False),
+        ("foo/**/bar", "/x/foo/bar", True),
+        ("foo/**/bar", "/x/foo/a/b/bar/c", True),
+        ("/data/**", "/data/a", True),
+        ("ba[rz]", "/x/baz", True),
+        ("ba[^rz]", "/x/baz", False),
+        ("$HOME/share", "/root/share", True),
+    ],
+)
+def test_restic_rules(pattern, path, expected, monkeypatch):
+    monkeypatch.setenv("HOME", "/root")
+    assert ExclusionMatcher([pattern]).match(path) is expected
+
+
+def test_ignore_case_and_negation():
+    matcher = ExclusionMatcher(["*.log", "!keep.log"], iexclude=["*CACHE*"])
+    assert matcher.match("/var/log/a.log")
+    assert not matcher.match("/var/log/keep.log")
+    assert matcher.match("/home/u/.cache")
+    assert matcher.match("/home/u/ShaderCache/x")
+    assert not matcher.match("/home/u/docs")
+
+
+def test_last_pattern_decides():
+    matcher = ExclusionMatcher(["/data", "!/data/keep", "/data/keep/tmp"])
+    assert matcher.match("/data/other")
+    assert not matcher.match("/data/keep/file")
+    assert matcher.match("/data/keep/tmp/x")
+    # a re-include before the pattern does not apply
+    assert ExclusionMatcher(["!keep.log", "*.log"]).match("/var/keep.log")
+    assert not ExclusionMatcher(["!keep.log"])
+
+
+def test_negation_and_ignore_case():
+    # excluded ignoring case, although the exclude list re-includes it
+    matcher = ExclusionMatcher(["*.log", "!Keep.log"], iexclude=["keep.*"])
+    assert matcher.match("/var/Keep.log")
+    assert not ExclusionMatcher(["*.log", "!Keep.log"]).match("/var/Keep.log")
+
+
+def test_batch():
+    matcher = ExclusionMatcher(["node_modules", "/srv/tmp", "*.pyc"])
+    paths = ["/srv/app", "/srv/tmp", "/srv/app/node_modules", "/srv/a.pyc", "/srv"]
+    assert matcher.filter(paths) == ["/srv/app", "/srv"]
+    assert matcher.excluded(paths) == [
+        "/srv/tmp",
+        "/srv/app/node_modules",
+        "/srv/a.pyc",
+    ]
+    assert ExclusionMatcher().filter(paths) == paths
+
+
+def test_exclude_paths_plugins():
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["home"],
+        runner=FileRunner(["/home/*/.config/*"]),
+        exclude={"caches": True},
+    )
+    paths = {
+        "/home/u/.config/Code/Cache",
+        "/home/u/.config/Code/User",
+        "/home/u/.cache",
+    }
+    exclude_paths(job, paths)
+    assert paths == {"/home/u/.config/Code/User"}
@@ -0,0 +1,136 @@
+import os
+import subprocess
+import urllib.request
+
+import pytest
+
+from resticrc import metrics
+from resticrc.executor import executor
+from resticrc.metrics import CONTENT_TYPE, Run, add_summary, phase
+from resticrc.models import Job, Repository
+from resticrc.runner import PipedRunner
+
+RESTIC = """#!/bin/sh
+cat > /dev/null
+echo '{"message_type":"summary","snapshot_id":"0123","data_added":100,\
+"total_bytes_processed":4096,"total_files_processed":1}'
+"""
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics.registry, "path", tmp_path / "state" / "metrics.json")
+    monkeypatch.setattr(metrics.registry, "enabled", True)
+    monkeypatch.setattr(metrics.registry, "pending", [])
+    monkeypatch.setattr(metrics.registry, "state", {})
+    return metrics.registry
+
+
+class Runner:
+    def __init__(self, error=None):
+        self.error = error
+
+    def __call__(self, job):
+        with phase("snapshot"):
+            pass
+        summary = {
+            "data_added": 10,
+            "total_bytes_processed": 300,
+            "total_files_processed": 3,
+        }
+        for repo in job.repos:
+            add_summary(job.name, repo.name, summary)
+        if self.error:
+            raise self.error
+
+
+def make_job(name, runner, repos=("host",)):
+    repos = [Repository(x, f"/backups/{x}") for x in repos]
+    return Job(repo=repos[0], repos=repos, tags=[name], runner=runner)
+
+
+def test_totals():
+    run = Run("data")
+    for part, repo, processed, added in [
+        ("a", "host", 100, 1),
+        ("a", "usb", 100, 2),
+        ("b", "host", 50, 4),
+    ]:
+        run.add_summary(
+            part, repo, {"total_bytes_processed": processed, "data_added": added}
+        )
+    # every part is read once, data is added to every repository
+    assert run.totals() == {
+        "processed_bytes": 150,
+        "added_bytes": 7,
+        "scanned_files": 0,
+    }
+
+
+def test_textfile(registry, tmp_path):
+    make_job("etc", Runner(), repos=["host", "usb"]).run()
+    failing = make_job("db", Runner(subprocess.CalledProcessError(3, ["restic"])))
+    with pytest.raises(subprocess.CalledProcessError):
+        failing.run()
+    textfile = tmp_path / "textfile" / "resticrc.prom"
+    registry.flush(textfile)
+    text = textfile.read_text()
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF"
+    assert 'resticrc_job_added_bytes{job="etc"} 20' in lines
+    assert 'resticrc_job_processed_bytes{job="etc"} 300' in lines
+    assert 'resticrc_job_scanned_files{job="etc"} 3' in lines
+    assert 'resticrc_job_exit_status{job="db"} 3' in lines
+    assert "# UNIT resticrc_job_duration_seconds seconds" in lines
+    success = [x for x in lines if x.startswith("resticrc_job_last_success")]
+    assert len(success) == 1 and 'job="etc"' in success[0]
+    assert 'resticrc_job_duration_seconds_bucket{job="db",le="1.0"} 1' in lines
+    assert 'resticrc_job_duration_seconds_bucket{job="db",le="+Inf"} 1' in lines
+    phase_count = "resticrc_job_phase_duration_seconds_count"
+    assert f'{phase_count}{{job="etc",phase="snapshot"}} 1' in lines
+    assert oct(os.stat(textfile).st_mode & 0o777) == "0o644"
+    assert os.listdir(textfile.parent) == ["resticrc.prom"]
+
+    # histograms keep counting between processes, removed jobs are forgotten
+    registry.state = {}
+    make_job("etc", Runner()).run()
+    registry.flush(textfile, jobs={"etc"})
+    lines = textfile.read_text().splitlines()
+    assert 'resticrc_job_duration_seconds_count{job="etc"} 2' in lines
+    assert not [x for x in lines if 'job="db"' in x]
+
+
+def test_disabled(registry):
+    registry.enabled = False
+    make_job("etc", Runner()).run()
+    assert registry.pending == []
+
+
+def test_restic_phases(registry, tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "restic").write_text(RESTIC)
+    (bindir / "restic").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(executor, "dry_run", False)
+    monkeypatch.setattr("resticrc.commands.Restic.record", lambda *args: None)
+    make_job("dump", PipedRunner("echo dump")).run()
+    (run,) = registry.pending
+    assert set(run.phases) == {"producer", "restic"}
+    assert run.phases["producer"] <= run.phases["restic"] <= run.duration
+    assert run.totals()["processed_bytes"] == 4096
+
+
+def test_http(registry):
+    make_job("etc", Runner()).run()
+    registry.flush()
+    server = metrics.serve("127.0.0.1:0")
+    try:
+        host, port = server.server_address[:2]
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+            assert response.headers["Content-Type"] == CONTENT_TYPE
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'resticrc_job_added_bytes{job="etc"} 10' in body
@@ -0,0 +1,125 @@
+import errno
+import os
+import subprocess
+import threading
+
+import pytest
+
+from resticrc.executor import OutputBuffer, executor
+from resticrc.pump import Pump, Tee, coalesce, humanize
+
+SIZE = 3 * 1024 * 1024 + 17
+
+
+def writer(fd, size):
+    with os.fdopen(fd, "wb") as out:
+        out.write(os.urandom(size))
+
+
+def reader(fd, result):
+    with os.fdopen(fd, "rb") as inp:
+        result.append(len(inp.read()))
+
+
+@pytest.mark.parametrize("splice", [True, False])
+def test_pump_pipes(splice):
+    src_r, src_w = os.pipe()
+    dst_r, dst_w = os.pipe()
+    result = []
+    threads = [
+        threading.Thread(target=writer, args=(src_w, SIZE)),
+        threading.Thread(target=reader, args=(dst_r, result)),
+    ]
+    for thread in threads:
+        thread.start()
+    stats = Pump(src_r, dst_w, chunk_size=64 * 1024, splice=splice).run()
+    os.close(src_r)
+    os.close(dst_w)
+    for thread in threads:
+        thread.join()
+    assert result == [SIZE]
+    assert stats.bytes == SIZE
+    assert stats.method == ("splice" if splice and hasattr(os, "splice") else "buffer")
+    assert stats.duration >= stats.read_wait
+    assert "MiB" in str(stats)
+
+
+def test_pipeline_with_pump(monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    output = OutputBuffer(echo=False)
+    with executor.capture(output):
+        result = executor.pipeline(
+            [["head", "-c", str(SIZE), "/dev/zero"], ["wc", "-c"]],
+            pump={"buffer": 65536},
+        )
+    assert int(output.text("stdout")) == SIZE
+    assert result.returncodes == [0, 0]
+    assert result.stats[0].bytes == SIZE
+
+
+def test_pipeline_with_pump_producer_failure(monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        executor.pipeline([["false"], ["cat"]], pump={}, stdout=subprocess.DEVNULL)
+    assert e.value.cmd == ["false"]
+
+
+def test_tee():
+    data = os.urandom(SIZE)
+    chunks = [data[i : i + 65536] for i in range(0, SIZE, 65536)]
+    pipes = [os.pipe() for _ in range(3)]
+    results = [[] for _ in pipes]
+    threads = [
+        threading.Thread(target=reader, args=(r, out))
+        for (r, _), out in zip(pipes, results)
+    ]
+    for thread in threads:
+        thread.start()
+    stats = Tee(chunks, [w for _, w in pipes], queue_size=2).run()
+    for thread in threads:
+        thread.join()
+    assert results == [[SIZE]] * 3
+    assert stats.bytes == SIZE
+    assert not stats.dropped
+    assert "slowest consumer" in str(stats)
+
+
+def test_tee_drops_closed_consumer():
+    (r1, w1), (r2, w2) = os.pipe(), os.pipe()
+    os.close(r1)
+    result = []
+    thread = threading.Thread(target=reader, args=(r2, result))
+    thread.start()
+    stats = Tee([b"x" * 1000] * 100, [w1, w2]).run()
+    thread.join()
+    assert stats.dropped == [0]
+    assert result == [100000]
+
+
+@pytest.mark.skipif(not os.path.exists("/dev/full"), reason="no /dev/full")
+def test_tee_failed_consumer():
+    full = os.open("/dev/full", os.O_WRONLY)
+    r, w = os.pipe()
+    result = []
+    thread = threading.Thread(target=reader, args=(r, result))
+    thread.start()
+    tee = Tee([b"x" * 1000] * 100, [full, w], queue_size=2)
+    with pytest.raises(OSError) as e:
+        tee.run()
+    thread.join()
+    assert e.value.errno == errno.ENOSPC
+    assert tee.stats.dropped == [0]
+    # the other consumer gets the whole stream
+    assert result == [100000]
+
+
+def test_coalesce():
+    items = [b"%d\0" % i for i in range(1000)]
+    chunks = list(coalesce(items, 1024))
+    assert b"".join(chunks) == b"".join(items)
+    assert all(len(x) >= 1024 for x in chunks[:-1])
+
+
+def test_humanize():
+    assert humanize(512) == "512.0B"
+    assert humanize(3 * 1024**3) == "3.0GiB"
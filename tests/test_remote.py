@@ -0,0 +1,178 @@
+import os
+
+import pytest
+
+from resticrc import remote
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.parser import Parser
+from resticrc.remote import LocalTransport, Remote, connections, remote_command
+from resticrc.resources import Resources
+from resticrc.runner import FileRunner, PipedRunner
+from resticrc.scheduler import Scheduler
+from resticrc.state import DurationStore, runtime_dir
+
+# logs where and how it was started, saves stdin of stdin backups;
+# waits until $RESTIC_PARALLEL restics are started
+RESTIC = """#!/bin/sh
+echo "$(pwd) $*" >> "$RESTIC_LOG"
+case "$*" in *--stdin*) cat > "$RESTIC_LOG.stdin" ;; esac
+touch "$RESTIC_STARTED/$$"
+for i in $(seq 100); do
+    [ "$(ls "$RESTIC_STARTED" | wc -l)" -ge "${RESTIC_PARALLEL:-1}" ] && break
+    sleep 0.05
+done
+[ "$(ls "$RESTIC_STARTED" | wc -l)" -ge "${RESTIC_PARALLEL:-1}" ] || exit 1
+echo '{"message_type":"summary","snapshot_id":"0123"}'
+"""
+
+
+class CountingTransport(LocalTransport):
+    connected = []
+
+    def connect(self):
+        self.connected.append(self.remote.host)
+
+
+@pytest.fixture(autouse=True)
+def transports():
+    remote.register("counting", CountingTransport)
+    CountingTransport.connected = []
+    yield
+    connections.close()
+    del remote.TRANSPORTS["counting"]
+
+
+@pytest.fixture
+def restic(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "restic").write_text(RESTIC)
+    (bindir / "restic").chmod(0o755)
+    (tmp_path / "started").mkdir()
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("RESTIC_LOG", str(tmp_path / "restic.log"))
+    monkeypatch.setenv("RESTIC_STARTED", str(tmp_path / "started"))
+    monkeypatch.setattr(executor, "dry_run", False)
+    return tmp_path / "restic.log"
+
+
+def make_job(name, runner, host="juno", **conf):
+    return Job(
+        repo=Repository("host", "/backups/host"),
+        tags=[name],
+        runner=runner,
+        remote=Remote(host, transport="counting"),
+        conf=conf,
+    )
+
+
+def test_remote_command():
+    assert remote_command(["echo", "a b"]) == "echo 'a b'"
+    assert remote_command(["ls"], "/srv/my dir") == "cd '/srv/my dir' && exec ls"
+
+
+def test_parse():
+    conf = {
+        "repos": {"juno": "/backups/juno"},
+        "jobs": {
+            "juno-home": {
+                "repo": "juno",
+                "ssh": "192.168.100.254",
+                "ssh-options": "-p 2222",
+                "shell": "echo hi > packages.txt",
+                "path": "/home/igor",
+            },
+            "local": {"repo": "juno", "path": "/etc"},
+        },
+    }
+    parser = Parser(conf)
+    job = parser.jobs["juno-home"]
+    assert job.remote == Remote("192.168.100.254", options=("-p", "2222"))
+    assert job.conf["shell"] == "echo hi > packages.txt"
+    assert parser.jobs["local"].remote is None
+    conf["jobs"]["juno-home"]["transport"] = "telnet"
+    with pytest.raises(ValueError, match="telnet"):
+        Parser(conf).jobs["juno-home"]  # pylint: disable=expression-not-assigned
+
+
+def test_file_job(restic, tmp_path):
+    marker = tmp_path / "packages.txt"
+    job = make_job(
+        "home", FileRunner(["/home/*/data"]), shell=f"echo installed > {marker}"
+    )
+    job.run()
+    assert marker.read_text() == "installed\n"
+    cwd, *args = restic.read_text().split()
+    # globs are expanded by the remote side, not by this host
+    assert args[-1] == "/home/*/data"
+    assert "--tag" in args
+
+
+def test_stdin_job(restic):
+    job = make_job("db", PipedRunner("echo dump of the database", filename="db.sql"))
+    job.run()
+    # producer runs remotely, its output is backed up by the local restic
+    assert (restic.parent / "restic.log.stdin").read_text() == (
+        "dump of the database\n"
+    )
+
+
+def test_shared_connections(restic, monkeypatch, tmp_path):
+    monkeypatch.setenv("RESTIC_PARALLEL", "3")
+    jobs = {
+        name: make_job(name, FileRunner([f"/{name}"]), host=host)
+        for name, host in [("a1", "a"), ("a2", "a"), ("b1", "b")]
+    }
+    for i, job in enumerate(jobs.values()):
+        job.repos = [Repository(f"repo{i}", f"/backups/{i}")]
+    scheduler = Scheduler(
+        jobs, workers=3, durations=DurationStore(tmp_path / "durations.json")
+    )
+    results = scheduler.run()
+    assert all(x.ok for x in results.values())
+    # all three were running at once, each host was connected once
+    assert len(restic.read_text().splitlines()) == 3
+    assert sorted(CountingTransport.connected) == ["a", "b"]
+
+
+def test_ssh_dry_run(capsys, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    monkeypatch.setattr(executor, "dry_run", True)
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["etc"],
+        runner=FileRunner(["/etc"]),
+        remote=Remote("juno"),
+        resources=Resources(nice=10),
+    )
+    job.run()
+    master, restic = capsys.readouterr().out.splitlines()
+    assert "'ControlMaster=yes'" in master and "'-N'" in master
+    # the master is shared by jobs, it is not limited like the first of them
+    assert "'nice'" not in master and "'nice', '-n', '10'" in restic
+    assert f"'ControlPath={tmp_path}/resticrc/ssh/%C'" in restic
+    command = "restic --repo /backups/host backup --json --tag etc /etc"
+    assert restic.endswith(f"'juno', '--', '{command}']")
+
+
+def test_runtime_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr("tempfile.gettempdir", lambda: str(tmp_path))
+    path = tmp_path / f"resticrc-{os.getuid()}"
+    path.mkdir(mode=0o755)
+    os.chmod(path, 0o755)
+    assert runtime_dir() == path
+    assert path.stat().st_mode & 0o777 == 0o700
+    path.rmdir()
+    # planted by somebody else
+    (tmp_path / "elsewhere").mkdir()
+    path.symlink_to(tmp_path / "elsewhere")
+    with pytest.raises(PermissionError):
+        runtime_dir()
+    if os.getuid() == 0:
+        path.unlink()
+        path.mkdir(mode=0o700)
+        os.chown(path, 12345, 12345)
+        with pytest.raises(PermissionError):
+            runtime_dir()
@@ -0,0 +1,108 @@
+import os
+import shutil
+
+import pytest
+
+from resticrc.executor import ConsoleExecutor, OutputBuffer, executor
+from resticrc.parser import Parser
+from resticrc.resources import Resources, parse_cpus
+
+
+def test_parse_cpus():
+    assert parse_cpus("0-3,6") == [0, 1, 2, 3, 6]
+    assert parse_cpus([2, "0"]) == [0, 2]
+    assert parse_cpus(1) == sorted(os.sched_getaffinity(0))[-1:]
+
+
+def test_from_dict():
+    resources = Resources.from_dict(
+        {
+            "nice": 10,
+            "ionice": "best-effort:7",
+            "cpus": "0-1",
+            "limit-upload": "10M",
+            "memory-max": "2G",
+        }
+    )
+    assert resources.limit_upload == 10240
+    assert resources.memory_max == 2 << 30
+    assert resources.restic_args() == ["--limit-upload", "10240"]
+    assert resources.threads(8) == 2
+    with pytest.raises(ValueError):
+        Resources.from_dict({"ionice": "lowest"})
+    with pytest.raises(ValueError):
+        Resources.from_dict({"nic": 10})
+
+
+def test_prefix():
+    resources = Resources(nice=10, ionice="idle", cpus=[0, 1])
+    assert resources.wrap(["restic", "backup"]) == [
+        "nice",
+        "-n",
+        "10",
+        "ionice",
+        "-c",
+        "3",
+        "taskset",
+        "-c",
+        "0,1",
+        "restic",
+        "backup",
+    ]
+
+
+def test_cgroup(tmp_path):
+    resources = Resources(memory_max=1 << 30, io_weight=50, cgroup=str(tmp_path))
+    prefix = resources.prefix("etc")
+    assert prefix[:3] == ["sh", "-c", 'echo $$ > "$1/cgroup.procs" && shift && exec "$@"']
+    assert prefix[4] == str(tmp_path / "etc")
+    assert (tmp_path / "cgroup.subtree_control").read_text() == "+memory +io"
+    assert (tmp_path / "etc" / "memory.max").read_text() == str(1 << 30)
+    assert (tmp_path / "etc" / "io.weight").read_text() == "default 50"
+    # cgroup is skipped if it could not be created
+    resources.cgroup = str(tmp_path / "etc" / "memory.max")
+    assert resources.prefix("etc") == []
+
+
+def test_cgroup_dry_run(tmp_path, capsys):
+    resources = Resources(memory_max=1 << 30, cgroup=str(tmp_path / "resticrc"))
+    runner = ConsoleExecutor()
+    runner.dry_run = True
+    with runner.limit(resources, "etc"):
+        runner.run(["restic", "backup"])
+        runner.fanout(["cat"], [["restic", "backup"]])
+    assert str(tmp_path / "resticrc" / "etc") in capsys.readouterr().out
+    assert not (tmp_path / "resticrc").exists()
+
+
+@pytest.mark.skipif(not shutil.which("nice"), reason="needs nice")
+def test_applied_to_commands():
+    output = OutputBuffer(echo=False)
+    base = os.nice(0)
+    runner = ConsoleExecutor()
+    with runner.capture(output), runner.limit(Resources(nice=3)):
+        runner.run(["nice"])
+    assert int(output.text("stdout")) == min(base + 3, 19)
+
+
+def test_job_settings(capsys, monkeypatch):
+    conf = {
+        "repos": {"host": "/backups/host"},
+        "global": {"repo": "host", "resources": {"nice": 10, "limit-upload": "1M"}},
+        "jobs": {
+            "home": {"path": "/home", "zstd": True, "resources": {"cpus": [0]}},
+            "db": {"cmd": "pg_dumpall", "resources": {"nice": 5}},
+        },
+    }
+    monkeypatch.setattr(executor, "dry_run", True)
+    parser = Parser(conf)
+    assert parser.jobs["home"].resources == Resources(
+        nice=10, cpus=[0], limit_upload=1024
+    )
+    parser.jobs["home"].run()
+    tar, restic = capsys.readouterr().out.splitlines()
+    assert "'nice', '-n', '10', 'taskset', '-c', '0', 'tar'" in tar
+    assert "'zstd -T1'" in tar
+    assert "'--limit-upload', '1024'" in restic
+    parser.jobs["db"].run()
+    assert "['nice', '-n', '5', 'pg_dumpall']" in capsys.readouterr().out
@@ -0,0 +1,152 @@
+import threading
+import time
+
+import pytest
+
+from resticrc.models import Job, Repository
+from resticrc.scheduler import Scheduler, CANCELLED, DONE, FAILED
+from resticrc.state import DurationStore
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+
+class FakeRunner:
+    def __init__(self, recorder, name, fail=False, sleep=0.01):
+        self.recorder = recorder
+        self.name = name
+        self.fail = fail
+        self.sleep = sleep
+
+    def __call__(self, job):
+        rec = self.recorder
+        with rec.lock:
+            rec.started.append(self.name)
+            rec.running += 1
+            rec.max_running = max(rec.max_running, rec.running)
+        time.sleep(self.sleep)
+        with rec.lock:
+            rec.running -= 1
+        if self.fail:
+            raise RuntimeError("boom")
+
+
+def make_jobs(rec, spec, repos=None):
+    repos = repos or {"host": Repository("host", "/backups/host")}
+    jobs = {}
+    for name, opts in spec.items():
+        opts = dict(opts)
+        repo = repos[opts.pop("repo", "host")]
+        after = opts.pop("after", [])
+        jobs[name] = Job(
+            repo=repo, tags=[name], runner=FakeRunner(rec, name, **opts), after=after
+        )
+    return jobs
+
+
+def test_dependencies_order(tmp_path):
+    rec = Recorder()
+    jobs = make_jobs(rec, {"b": {"after": ["a"]}, "a": {}, "c": {"after": ["b"]}})
+    sched = Scheduler(jobs, workers=4, durations=DurationStore(tmp_path / "d.json"))
+    results = sched.run()
+    assert rec.started == ["a", "b", "c"]
+    assert all(x.status == DONE for x in results.values())
+
+
+def test_failure_cancels_dependents_only(tmp_path):
+    rec = Recorder()
+    jobs = make_jobs(
+        rec,
+        {
+            "a": {"fail": True},
+            "b": {"after": ["a"]},
+            "c": {"after": ["b"]},
+            "d": {},
+        },
+    )
+    results = Scheduler(
+        jobs, workers=2, durations=DurationStore(tmp_path / "d.json")
+    ).run()
+    assert results["a"].status == FAILED
+    assert results["b"].status == CANCELLED
+    assert results["c"].status == CANCELLED
+    assert results["d"].status == DONE
+
+
+def test_repo_concurrency(tmp_path):
+    rec = Recorder()
+    repos = {
+        "host": Repository("host", "/backups/host", concurrency=1),
+        "db": Repository("db", "/backups/db", concurrency=2),
+    }
+    spec = {f"h{i}": {"repo": "host"} for i in range(3)}
+    spec.update({f"d{i}": {"repo": "db"} for i in range(3)})
+    jobs = make_jobs(rec, spec, repos)
+    sched = Scheduler(jobs, workers=8, durations=DurationStore(tmp_path / "d.json"))
+    ready = sched.ready(set(jobs), [])
+    assert len([x for x in ready if x.startswith("h")]) == 1
+    assert len([x for x in ready if x.startswith("d")]) == 2
+    sched.run()
+    assert rec.max_running <= 3
+
+
+def test_multiple_repos_concurrency(tmp_path):
+    rec = Recorder()
+    host = Repository("host", "/backups/host", concurrency=1)
+    offsite = Repository("offsite", "sftp:backup:/host", concurrency=1)
+    jobs = make_jobs(rec, {"a": {}, "b": {}}, {"host": host})
+    jobs["a"].repos = [host, offsite]
+    jobs["c"] = make_jobs(rec, {"c": {"repo": "offsite"}}, {"offsite": offsite})["c"]
+    sched = Scheduler(jobs, workers=8, durations=DurationStore(tmp_path / "d.json"))
+    # 'a' writes to both repositories
+    assert sched.ready({"b", "c"}, ["a"]) == []
+    assert sched.ready({"a", "c"}, ["b"]) == ["c"]
+
+
+def test_longest_first(tmp_path):
+    store = DurationStore(tmp_path / "d.json")
+    store.record("short", 1)
+    store.record("long", 100)
+    store.record("tail", 50)
+    rec = Recorder()
+    jobs = make_jobs(rec, {"short": {}, "long": {}, "mid": {"after": []}})
+    jobs.update(make_jobs(rec, {"tail": {"after": ["short"]}}))
+    sched = Scheduler(jobs, workers=1, durations=store)
+    # short is before mid since 'tail' depends on it
+    assert sched.ready(set(jobs), []) == ["long"]
+    sched.run()
+    assert rec.started.index("short") < rec.started.index("mid")
+    assert DurationStore(tmp_path / "d.json").get("mid") is not None
+
+
+def test_dependency_cycle(tmp_path):
+    rec = Recorder()
+    jobs = make_jobs(rec, {"a": {"after": ["b"]}, "b": {"after": ["a"]}})
+    with pytest.raises(ValueError, match="cycle"):
+        Scheduler(jobs, durations=DurationStore(tmp_path / "d.json"))
+    jobs = make_jobs(rec, {"a": {"after": ["missing"]}})
+    with pytest.raises(ValueError, match="Unknown dependency"):
+        Scheduler(jobs, durations=DurationStore(tmp_path / "d.json"))
+
+
+def test_jobs_that_never_start(tmp_path):
+    rec = Recorder()
+    stuck = Repository("stuck", "/backups/stuck", concurrency=0)
+    jobs = make_jobs(rec, {"a": {"repo": "stuck"}}, repos={"stuck": stuck})
+    with pytest.raises(ValueError, match="concurrency"):
+        Scheduler(jobs, durations=DurationStore(tmp_path / "d.json"))
+    with pytest.raises(ValueError, match="workers"):
+        Scheduler({}, workers=0, durations=DurationStore(tmp_path / "d.json"))
+    # a limit changed after the check leaves the job without a result otherwise
+    stuck.concurrency = 1
+    jobs.update(make_jobs(rec, {"b": {"after": ["a"]}}, repos={"host": stuck}))
+    sched = Scheduler(jobs, durations=DurationStore(tmp_path / "d.json"))
+    stuck.concurrency = 0
+    results = sched.run()
+    assert {x: results[x].status for x in results} == {"a": FAILED, "b": FAILED}
+    assert rec.started == []
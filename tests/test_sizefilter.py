@@ -0,0 +1,94 @@
+import logging
+
+import pytest
+
+from resticrc import commands
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+from resticrc.sizefilter import parse_size, scan_larger
+
+
+def test_parse_size():
+    assert parse_size(512) == 512
+    assert parse_size("500M") == 500 << 20
+    assert parse_size("1.5GiB") == 3 << 29
+    with pytest.raises(ValueError):
+        parse_size("big")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "media").mkdir(parents=True)
+    (root / "media" / "movie.mkv").write_bytes(b"x" * 4096)
+    (root / "media" / "cache").mkdir()
+    (root / "media" / "cache" / "big.bin").write_bytes(b"x" * 4096)
+    (root / "notes.txt").write_bytes(b"x" * 10)
+    (root / "disk.img").write_bytes(b"x" * 2048)
+    return root
+
+
+@pytest.fixture
+def run(mocker, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    mocker.patch.object(executor, "pipeline")
+    return mocker.patch.object(executor, "run")
+
+
+def make_job(tree, larger="1K", **conf):
+    return Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([str(tree)]),
+        exclude={"larger": larger, "paths": ["cache"]},
+        conf=conf,
+    )
+
+
+def test_scan(tree):
+    job = make_job(tree)
+    report = scan_larger(job.exclude.matcher, [str(tree)], 1024)
+    assert sorted(report.paths) == [
+        str(tree / "disk.img"),
+        str(tree / "media/movie.mkv"),
+    ]
+    assert report.saved == 4096 + 2048
+
+
+def test_restic_option(tree, run, caplog, mocker):
+    caplog.set_level(logging.INFO, logger="resticrc")
+    scan = mocker.spy(commands, "scan_larger")
+    make_job(tree).run()
+    args = run.call_args[0][0]
+    assert args[args.index("--exclude-larger-than") + 1] == "1024"
+    # restic skips them by itself, the tree is not walked again
+    assert scan.call_count == 0
+    assert "larger than" not in caplog.text
+    make_job(tree, larger={"size": "1K", "report": True}).run()
+    assert scan.call_count == 1
+    assert "2 files larger than 1.0KiB skipped, 6.0KiB saved" in caplog.text
+    with pytest.raises(ValueError, match="limit"):
+        make_job(tree, larger={"limit": "1K"}).run()
+
+
+def test_prewalk(tree, run):
+    make_job(tree, prewalk=True).run()
+    sent = b"".join(run.call_args[1]["stdin"]).split(b"\0")[:-1]
+    assert sent == [str(tree / "notes.txt").encode()]
+
+
+def test_tar(tree, run):
+    make_job(tree, zstd=True).run()
+    tar = executor.pipeline.call_args[0][0][0]
+    start = tar.index("--anchored")
+    assert tar[start : start + 6] == [
+        "--anchored",
+        "--no-wildcards",
+        "--exclude",
+        str(tree / "disk.img"),
+        "--exclude",
+        str(tree / "media/movie.mkv"),
+    ]
+    # job exclusions are not anchored
+    assert tar.index("cache") < start
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+CONFIG = """
+repos:
+  host: /backups/host
+global:
+  repo: host
+  exclude:
+    caches: true
+jobs:
+  etc: /etc
+  home:
+    path: /home
+    exclude:
+      logs: true
+"""
+
+# seconds over the bare interpreter startup, the CLI is started by cron for every job
+MARGIN = {
+    "version": float(os.environ.get("RESTICRC_STARTUP_MARGIN", 0.08)),
+    "run": float(os.environ.get("RESTICRC_RUN_MARGIN", 0.2)),
+}
+
+HEAVY = (
+    "yaml",
+    "pluggy",
+    "sqlite3",
+    "asyncio",
+    "resticrc.filtering.api",
+    "resticrc.remote",
+)
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.yml"
+    path.write_text(CONFIG)
+    return path
+
+
+@pytest.fixture(scope="module")
+def baseline() -> float:
+    return best([sys.executable, "-c", "pass"])
+
+
+def best(command) -> float:
+    """ Returns the best wall time of a few runs of the command. """
+    times = []
+    for _ in range(5):
+        start = time.monotonic()
+        subprocess.run(command, check=True, capture_output=True)
+        times.append(time.monotonic() - start)
+    return min(times)
+
+
+def resticrc(*args) -> float:
+    return best([sys.executable, "-m", "resticrc", *args])
+
+
+def imported(code: str):
+    """ Returns heavy modules imported by the code. """
+    check = f"{code}\nimport sys\nprint(*[x for x in {HEAVY!r} if x in sys.modules])"
+    result = subprocess.run(
+        [sys.executable, "-c", check], check=True, capture_output=True, text=True
+    )
+    return result.stdout.splitlines()[-1].split()
+
+
+def test_console_import():
+    assert imported("import resticrc.console") == []
+
+
+def test_cached_dry_run_imports(config):
+    args = ["-c", str(config), "run", "-n", "etc"]
+    resticrc(*args)
+    # compiled config has the job with processed exclusions
+    code = f"from resticrc.console import cli\ncli({args!r}, standalone_mode=False)"
+    assert imported(code) == []
+
+
+def test_version_budget(baseline):
+    assert resticrc("--version") < baseline + MARGIN["version"]
+
+
+def test_dry_run_budget(config, baseline):
+    resticrc("-c", str(config), "run", "-n", "etc")
+    assert resticrc("-c", str(config), "run", "-n", "etc") < baseline + MARGIN["run"]
@@ -0,0 +1,166 @@
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+from resticrc.tarstream import RECORD, TarStream, compress
+from resticrc.walker import Walker
+
+LONG = "directory-with-a-long-name/" * 5 + "file.txt"
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "empty").mkdir()
+    (root / "a" / "big.bin").write_bytes(os.urandom(50000))
+    (root / "a" / "b" / "small.txt").write_text("small")
+    os.link(root / "a" / "b" / "small.txt", root / "a" / "hard.txt")
+    os.symlink("b/small.txt", root / "a" / "link")
+    (root / os.path.dirname(LONG)).mkdir(parents=True)
+    (root / LONG).write_text("long")
+    return root
+
+
+def archive(tree, cwd=None, **kwargs):
+    stream = TarStream(threads=4, cwd=cwd, **kwargs)
+    entries = Walker(stat=True, cwd=cwd).walk_sorted([str(tree)], dirs=True)
+    data = b"".join(stream.stream(entries))
+    return stream, data
+
+
+def test_archive(tree):
+    stream, data = archive(tree, buffer=8192, chunk=4096)
+    assert len(data) % RECORD == 0
+    # read-ahead is bounded by the buffer and one chunk
+    assert 8192 <= stream.read_ahead.peak < 8192 + 4096
+    members = tarfile.open(fileobj=io.BytesIO(data)).getmembers()
+    root = str(tree).lstrip("/")
+    names = [os.path.relpath(x.name, root) for x in members]
+    assert names == [
+        ".",
+        "a",
+        "a/b",
+        "a/b/small.txt",
+        "a/big.bin",
+        "a/hard.txt",
+        "a/link",
+        *[LONG.rsplit("/", x)[0] for x in range(5, -1, -1)],
+        "empty",
+    ]
+    by_name = dict(zip(names, members))
+    assert by_name["a/hard.txt"].islnk()
+    assert by_name["a/link"].linkname == "b/small.txt"
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert (
+            tar.extractfile(by_name["a/big.bin"]).read()
+            == (tree / "a" / "big.bin").read_bytes()
+        )
+        assert tar.extractfile(by_name[LONG]).read() == b"long"
+    # the same files make the same archive
+    assert archive(tree, buffer=100000)[1] == data
+
+
+def test_streamed(tmp_path):
+    for i in range(20):
+        (tmp_path / f"file{i:02}").write_bytes(bytes(5000))
+    walked = []
+    entries = Walker(stat=True).walk_sorted([str(tmp_path)], dirs=True)
+    stream = TarStream(buffer=8192, chunk=4096).stream(
+        walked.append(x) or x for x in entries
+    )
+    assert next(stream)
+    # the archive is written while the tree is walked
+    assert len(walked) < 21
+    assert len(b"".join(stream)) > 20 * 5000
+
+
+@pytest.mark.skipif(shutil.which("tar") is None, reason="tar is not installed")
+def test_gnu_tar(tree, tmp_path):
+    _, data = archive(tree)
+    target = tmp_path / "extracted"
+    target.mkdir()
+    subprocess.run(["tar", "-x", "-C", str(target)], input=data, check=True)
+    diff = ["diff", "-r", "--no-dereference", str(tree), f"{target}{tree}"]
+    assert subprocess.run(diff, check=False).returncode == 0
+
+
+def test_changed_files(tree, caplog):
+    caplog.set_level(logging.WARNING, logger="resticrc")
+    entries = list(Walker(stat=True).walk_sorted([str(tree)], dirs=True))
+    big, small = str(tree / "a" / "big.bin"), str(tree / "a" / "b" / "small.txt")
+    os.truncate(big, 1000)
+    os.unlink(small)
+    stream = TarStream(chunk=4096)
+    data = b"".join(stream.stream(entries))
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        member = tar.getmember(big.lstrip("/"))
+        # the size of the header is kept
+        assert member.size == 50000
+        assert tar.extractfile(member).read()[1000:] == bytes(49000)
+        assert small.lstrip("/") not in tar.getnames()
+    assert "big.bin changed while it was read" in caplog.text
+    assert "Failed to read " + small in caplog.text
+
+
+@pytest.fixture
+def restic(tmp_path, monkeypatch):
+    """ Saves stdin of restic to a file. """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    out = tmp_path / "stdin"
+    (bindir / "restic").write_text(f"#!/bin/sh\ncat > {out}\n")
+    (bindir / "restic").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(executor, "dry_run", False)
+    monkeypatch.setattr("resticrc.commands.Restic.record", lambda *args: None)
+    return out
+
+
+@pytest.mark.parametrize(
+    "compress",
+    [
+        False,
+        pytest.param(
+            True,
+            marks=pytest.mark.skipif(
+                shutil.which("zstd") is None, reason="zstd is not installed"
+            ),
+        ),
+    ],
+)
+def test_job(tree, restic, compress):
+    job = Job(
+        repo=Repository("host", "/backups/host"),
+        tags=["tree"],
+        runner=FileRunner([str(tree)]),
+        exclude={"larger": "10K", "paths": ["empty"]},
+        conf={"zstd": {"prefetch": {"threads": 2}, "compress": compress}},
+    )
+    job.run()
+    data = restic.read_bytes()
+    if compress:
+        data = subprocess.run(
+            ["zstd", "-d"], input=data, capture_output=True, check=True
+        ).stdout
+    names = tarfile.open(fileobj=io.BytesIO(data)).getnames()
+    root = str(tree).lstrip("/")
+    assert f"{root}/a/b/small.txt" in names
+    assert f"{root}/a/big.bin" not in names
+    assert f"{root}/empty" not in names
+
+
+def test_zstandard():
+    zstandard = pytest.importorskip("zstandard")
+    chunks = [os.urandom(1000), b"x" * 100000]
+    data = b"".join(compress(iter(chunks), threads=2))
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+    assert reader.read() == b"".join(chunks)
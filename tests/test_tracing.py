@@ -0,0 +1,88 @@
+import json
+import threading
+
+from click.testing import CliRunner
+
+from resticrc import tracing
+from resticrc.console import cli
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.scheduler import Scheduler
+from resticrc.state import DurationStore
+from resticrc.tracing import NO_SPAN, profile, span
+
+
+class Runner:
+    """ Waits until all jobs are started, so they overlap. """
+
+    def __init__(self, barrier):
+        self.barrier = barrier
+
+    def __call__(self, job):
+        with span("wait", job=job.name):
+            self.barrier.wait(5)
+        executor.run(["true"])
+
+
+def spans(trace, phase="X"):
+    return [x for x in trace["traceEvents"] if x["ph"] == phase]
+
+
+def test_disabled():
+    assert tracing.tracer is None
+    assert span("anything") is NO_SPAN
+    with profile(None) as tracer:
+        assert tracer is None
+        assert span("anything") is NO_SPAN
+
+
+def test_concurrent_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    barrier = threading.Barrier(2)
+    jobs = {
+        name: Job(
+            repo=Repository(name, f"/backups/{name}"),
+            tags=[name],
+            runner=Runner(barrier),
+        )
+        for name in ("a", "b")
+    }
+    scheduler = Scheduler(
+        jobs, workers=2, durations=DurationStore(tmp_path / "durations.json")
+    )
+    path = tmp_path / "trace.json"
+    with profile(path):
+        assert all(x.ok for x in scheduler.run().values())
+    assert tracing.tracer is None
+    trace = json.loads(path.read_text())
+    by_name = {x["name"]: x for x in spans(trace)}
+    # jobs are separate tracks, named by their threads
+    assert by_name["job a"]["tid"] != by_name["job b"]["tid"]
+    threads = {x["tid"]: x["args"]["name"] for x in spans(trace, "M")}
+    assert threads[by_name["job a"]["tid"]].startswith("job")
+    wait = by_name["wait"]
+    assert wait["args"]["job"] in ("a", "b")
+    assert wait["dur"] > 0
+    # commands are async events
+    starts = spans(trace, "b")
+    assert [x["name"] for x in starts] == ["true", "true"]
+    assert starts[0]["args"]["command"] == ["true"]
+    assert len(spans(trace, "e")) == 2
+
+
+def test_profile_flag(tmp_path, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", False)
+    (tmp_path / "etc").mkdir()
+    config = tmp_path / "config.yml"
+    config.write_text(
+        f"repos:\n  host: /backups/host\n"
+        f"jobs:\n  etc:\n    repo: host\n    path: {tmp_path}/e*\n"
+    )
+    path = tmp_path / "trace.json"
+    result = CliRunner().invoke(
+        cli, ["-c", str(config), "run", "-n", "--profile", str(path), "etc"]
+    )
+    assert result.exit_code == 0, result.output
+    names = [x["name"] for x in spans(json.loads(path.read_text()))]
+    for name in ("load config", "parse job", "job etc", "expand globs"):
+        assert name in names
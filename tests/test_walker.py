@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from resticrc.filtering.matcher import ExclusionMatcher
+from resticrc.models import Job, Repository
+from resticrc.runner import FileRunner
+from resticrc.walker import Walker
+
+
+@pytest.fixture
+def tree(tmp_path):
+    files = [
+        "src/app.py",
+        "src/__pycache__/app.cpython-37.pyc",
+        "web/node_modules/left-pad/index.js",
+        "web/index.js",
+        "web/debug.log",
+        "docs/a/b/c.txt",
+    ]
+    for name in files:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    (tmp_path / "empty").mkdir()
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "x.log").write_text("x")
+    os.symlink("src", tmp_path / "link")
+    return tmp_path
+
+
+def test_walk_prunes_excluded(tree):
+    matcher = ExclusionMatcher(["node_modules", "__pycache__", "*.log"])
+    walker = Walker(matcher, threads=3, cwd=str(tree))
+    result = sorted(walker.walk(["."]))
+    assert result == [
+        "./docs/a/b/c.txt",
+        "./empty",
+        "./link",
+        "./logs",
+        "./src/app.py",
+        "./web/index.js",
+    ]
+
+
+def test_walk_sorted(tree):
+    matcher = ExclusionMatcher(["node_modules", "__pycache__", "*.log"])
+    walker = Walker(matcher, threads=2, cwd=str(tree))
+    result = list(walker.walk_sorted(["."]))
+    assert result == sorted(walker.walk(["."]), key=lambda x: x.split("/"))
+    # directories come before their contents, a nested root is walked once
+    assert list(walker.walk_sorted(["./docs", ".", "./docs/a"], dirs=True)) == [
+        ".",
+        "./docs",
+        "./docs/a",
+        "./docs/a/b",
+        "./docs/a/b/c.txt",
+        "./empty",
+        "./link",
+        "./logs",
+        "./src",
+        "./src/app.py",
+        "./web",
+        "./web/index.js",
+    ]
+
+
+def test_walk_early_close(tree):
+    walker = Walker(threads=2)
+    gen = walker.walk([str(tree)])
+    assert next(gen)
+    gen.close()
+
+
+def test_prewalk_job(tree, helpers):
+    job = Job(
+        repo=Repository("host", path="/backups/host"),
+        tags=["src"],
+        runner=FileRunner(paths=[str(tree / "src"), str(tree / "web")]),
+        exclude={"npm": True, "python": True},
+        conf={"prewalk": {"threads": 2}},
+    )
+    job.run()
+    args = helpers.exec.call_args[0][0]
+    assert args[-2:] == ["--files-from-raw", "-"]
+    assert "--exclude" in args
+    written = b"".join(helpers.exec.call_args[1]["stdin"])
+    paths = sorted(written.split(b"\0")[:-1])
+    assert paths == [
+        os.fsencode(tree / "src/app.py"),
+        os.fsencode(tree / "web/debug.log"),
+        os.fsencode(tree / "web/index.js"),
+    ]
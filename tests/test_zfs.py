@@ -0,0 +1,212 @@
+import json
+import os
+import shlex
+import sys
+
+import pytest
+
+from resticrc import metrics
+from resticrc.changes import ChangeDetector
+from resticrc.executor import executor
+from resticrc.models import Job, Repository
+from resticrc.runner import Runner, ZFSSnapshotRunner
+
+# datasets are listed in $ZFS_STUB as 'name<TAB>mountpoint<TAB>mounted' lines,
+# snapshots are copies of the mountpoint in .zfs/snapshot/<name>
+ZFS = """#!{python}
+import os, shutil, sys
+
+with open(os.environ["ZFS_LOG"], "a") as log:
+    log.write(" ".join(["zfs"] + sys.argv[1:]) + "\\n")
+with open(os.environ["ZFS_STUB"]) as stub:
+    datasets = [line.rstrip("\\n").split("\\t") for line in stub]
+command, args = sys.argv[1], sys.argv[2:]
+recursive = "-r" in args
+names = [x for x in args if not x.startswith("-") and x != "name,mountpoint,mounted"]
+names = [x for x in names if x != "filesystem"]
+
+
+def matching(name):
+    return [
+        x for x in datasets
+        if x[0] == name or (recursive and x[0].startswith(name + "/"))
+    ]
+
+
+if command == "list":
+    for name in names:
+        for dataset in matching(name):
+            print("\\t".join(dataset))
+    sys.exit(0)
+for snapshot in names:
+    name, _, snap = snapshot.partition("@")
+    for _, mountpoint, mounted in matching(name):
+        path = os.path.join(mountpoint, ".zfs", "snapshot", snap)
+        if command == "snapshot" and mounted == "yes":
+            shutil.copytree(mountpoint, path, ignore=shutil.ignore_patterns(".zfs"))
+        elif command == "destroy":
+            shutil.rmtree(path, ignore_errors=True)
+"""
+
+# waits until $RESTIC_PARALLEL restics are started, so datasets must be concurrent
+RESTIC = """#!/bin/sh
+echo "$(pwd) $*" >> "$RESTIC_LOG"
+touch "$RESTIC_STARTED/$$"
+for i in $(seq 100); do
+    [ "$(ls "$RESTIC_STARTED" | wc -l)" -ge "${{RESTIC_PARALLEL:-1}}" ] && break
+    sleep 0.05
+done
+[ -f FAIL ] && exit 1
+echo '{summary}'
+"""
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "zfs").write_text(ZFS.format(python=sys.executable))
+    summary = json.dumps({"message_type": "summary", "snapshot_id": "0123"})
+    (bindir / "restic").write_text(RESTIC.format(summary=summary))
+    for path in bindir.iterdir():
+        path.chmod(0o755)
+    (tmp_path / "started").mkdir()
+    datasets = []
+    for name, mounted in [
+        ("tank", "yes"),
+        ("tank/home", "yes"),
+        ("tank/vms", "no"),
+        ("backup", "yes"),
+    ]:
+        mountpoint = tmp_path / "mnt" / name
+        mountpoint.mkdir(parents=True)
+        (mountpoint / "data.txt").write_text(name)
+        datasets.append(f"{name}\t{mountpoint}\t{mounted}")
+    (tmp_path / "datasets").write_text("\n".join(datasets) + "\n")
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("ZFS_STUB", str(tmp_path / "datasets"))
+    monkeypatch.setenv("ZFS_LOG", str(tmp_path / "zfs.log"))
+    monkeypatch.setenv("RESTIC_LOG", str(tmp_path / "restic.log"))
+    monkeypatch.setenv("RESTIC_STARTED", str(tmp_path / "started"))
+    monkeypatch.setattr(executor, "dry_run", False)
+    return tmp_path
+
+
+def zfs_calls(pool):
+    return [x.split()[:2] for x in (pool / "zfs.log").read_text().splitlines()]
+
+
+def restic_calls(pool):
+    return [shlex.split(x) for x in (pool / "restic.log").read_text().splitlines()]
+
+
+def make_job(runner):
+    return Job(repo=Repository("host", "/backups/host"), tags=["zfs"], runner=runner)
+
+
+def test_datasets(pool, monkeypatch):
+    monkeypatch.setenv("RESTIC_PARALLEL", "2")
+    make_job(ZFSSnapshotRunner(["tank", "backup"])).run()
+    log = (pool / "zfs.log").read_text().splitlines()
+    snapshot = [x for x in log if x.startswith("zfs snapshot")]
+    # both datasets are snapshotted atomically by one call
+    assert len(snapshot) == 1
+    tank, backup = snapshot[0].split()[2:]
+    name = tank.partition("@")[2]
+    assert (tank, backup) == (f"tank@{name}", f"backup@{name}")
+    calls = {x[0]: x for x in restic_calls(pool)}
+    assert sorted(calls) == [
+        str(pool / "mnt" / x / ".zfs" / "snapshot" / name) for x in ("backup", "tank")
+    ]
+    for cwd, call in calls.items():
+        dataset = "tank" if "/tank/" in cwd else "backup"
+        assert f"zfs:{dataset}" in call
+        assert call[call.index("--group-by") + 1] == "host,tags"
+    # snapshots are destroyed, nothing is mounted
+    assert [x[1] for x in zfs_calls(pool)] == [
+        "list",
+        "snapshot",
+        "destroy",
+        "destroy",
+    ]
+    assert not list((pool / "mnt" / "tank" / ".zfs" / "snapshot").iterdir())
+
+
+def test_recursive(pool, monkeypatch):
+    monkeypatch.setenv("RESTIC_PARALLEL", "2")
+    make_job(ZFSSnapshotRunner("tank", recursive=True, skip_unmounted=True)).run()
+    log = (pool / "zfs.log").read_text().splitlines()
+    assert [x.split()[:3] for x in log if "snapshot" in x or "destroy" in x] == [
+        ["zfs", "snapshot", "-r"],
+        ["zfs", "destroy", "-r"],
+    ]
+    # not mounted dataset is skipped
+    cwds = sorted(x[0] for x in restic_calls(pool))
+    assert [os.path.relpath(x, pool / "mnt").split("/.zfs")[0] for x in cwds] == [
+        "tank",
+        "tank/home",
+    ]
+
+
+def test_unmounted(pool, monkeypatch):
+    monkeypatch.setenv("RESTIC_PARALLEL", "2")
+    with pytest.raises(ValueError, match="tank/vms is not mounted"):
+        make_job(ZFSSnapshotRunner("tank", recursive=True)).run()
+    # the mounted ones are backed up anyway
+    assert len(restic_calls(pool)) == 2
+    assert [x[1] for x in zfs_calls(pool)][-1] == "destroy"
+    (pool / "zfs.log").unlink()
+    with pytest.raises(ValueError, match="No mounted datasets"):
+        make_job(ZFSSnapshotRunner("tank/vms", skip_unmounted=True)).run()
+    # nothing is snapshotted
+    assert [x[1] for x in zfs_calls(pool)] == ["list"]
+
+
+def test_phases(pool, monkeypatch):
+    monkeypatch.setattr(metrics.registry, "enabled", True)
+    monkeypatch.setattr(metrics.registry, "pending", [])
+    make_job(ZFSSnapshotRunner("backup")).run()
+    (run,) = metrics.registry.pending
+    # listing datasets is timed apart from the snapshot, nothing is mounted
+    assert {"list", "snapshot", "cleanup"} <= set(run.phases)
+    assert "mount" not in run.phases
+
+
+def test_skip_unchanged(pool, monkeypatch):
+    monkeypatch.setenv("RESTIC_PARALLEL", "2")
+    job = make_job(ZFSSnapshotRunner(["tank", "backup"]))
+    job.conf["skip-unchanged"] = True
+    job.run()
+    # every dataset has its own index
+    for dataset in ("tank", "backup"):
+        assert ChangeDetector.index_path(f"{job.name}:{dataset}").exists()
+
+
+def test_failed_dataset(pool):
+    name = ZFSSnapshotRunner.snapshot_name()
+    # every snapshot of 'backup' has the marker file
+    (pool / "mnt" / "backup" / "FAIL").write_text("")
+    with pytest.raises(Exception):
+        make_job(ZFSSnapshotRunner(["tank", "backup"])).run()
+    assert len(restic_calls(pool)) == 2
+    assert [x[1] for x in zfs_calls(pool)][-2:] == ["destroy", "destroy"]
+    assert name != ZFSSnapshotRunner.snapshot_name()
+
+
+def test_dry_run(capsys, monkeypatch):
+    monkeypatch.setattr(executor, "dry_run", True)
+    make_job(ZFSSnapshotRunner(["tank/a", "tank/b"])).run()
+    out = capsys.readouterr().out
+    assert "'zfs', 'snapshot', 'tank/a@resticrc-" in out
+    assert "'zfs:tank/b'" in out
+    assert "'mount'" not in out and "'umount'" not in out
+
+
+def test_from_dict():
+    runner = Runner.from_dict({"zfs-dataset": ["tank/a", "tank/b"], "zfs-workers": 2})
+    assert runner == ZFSSnapshotRunner(["tank/a", "tank/b"], workers=2, paths=["."])
+    runner = Runner.from_dict(
+        {"zfs-dataset": "tank", "zfs-recursive": True, "zfs-skip-unmounted": True}
+    )
+    assert runner.datasets == ["tank"]
+    assert runner.recursive and runner.skip_unmounted